@@ -15,7 +15,7 @@ import os
 from subprocess import Popen, PIPE
 import tempfile
 import shutil
-from threading import Event
+from threading import Event, Lock
 import time
 from termcolor import colored
 from datetime import timedelta
@@ -41,6 +41,11 @@ print_log = False
 # List for keeping track of subscriptions to IPFS topics, so that subscriptions can be ended
 subscriptions = list([])
 
+# how many seconds this node's peer ID, multiaddresses and IPFS version, and
+# the IP address of the host of the IPFS daemon's HTTP API, are cached before
+# being looked up again (see invalidate_daemon_info())
+DAEMON_INFO_TTL_SEC = 300
+
 
 def publish(path: str):
     """Upload a file or a directory to IPFS, returning its CID.
@@ -265,7 +270,7 @@ def my_id():
     Returns:
         str: the peer ID of this node
     """
-    return http_client.id()["ID"]
+    return _daemon_info.get("id", http_client.id)["ID"]
 
 
 def is_ipfs_running():
@@ -273,7 +278,10 @@ def is_ipfs_running():
     Returns:
         bool: whether or not the IPFS daemon is currently running
     """
-    return len(my_multiaddrs()) > 0
+    # always ask the daemon, refreshing the cached info
+    info = http_client.id()
+    _daemon_info.put("id", info)
+    return len(info["Addresses"]) > 0
 
 
 def my_multiaddrs():
@@ -281,7 +289,18 @@ def my_multiaddrs():
     Returns:
         str: the peer ID of this node
     """
-    return http_client.id()["Addresses"]
+    return _daemon_info.get("id", http_client.id)["Addresses"]
+
+
+def invalidate_daemon_info():
+    """Forgets the cached information about the IPFS daemon (peer ID,
+    multiaddresses, version, the IP address of its HTTP API's host), so that
+    it is looked up again the next time it is needed.
+    Call this when the IPFS daemon has been restarted or reconfigured.
+    The cache is also cleared whenever `http_client` is replaced, and by
+    `wait_till_ipfs_is_running()` if the daemon wasn't running.
+    """
+    _daemon_info.invalidate()
 
 
 def list_peers():
@@ -495,7 +514,7 @@ class PubsubListener():
         """blocks the calling thread"""
         while not self._terminate:
             try:
-                if int(http_client.version()["Version"].split(".")[1]) >= 11:
+                if int(_ipfs_version().split(".")[1]) >= 11:
                     with http_client.pubsub.subscribe(self.topic, timeout=self._REFRESH_RATE) as self.sub:
                         for message in self.sub:
                             if self._terminate:
@@ -562,7 +581,7 @@ def pubsub_publish(topic, data):
             When using an older version of IPFS < v0.11.0 however,
             only plain data as a string is accepted.
     """
-    if int(http_client.version()["Version"].split(".")[1]) < 11:
+    if int(_ipfs_version().split(".")[1]) < 11:
         return http_client.pubsub.publish_old(topic, data)
 
     if isinstance(data, str) and not os.path.exists(data):
@@ -667,7 +686,8 @@ def wait_till_ipfs_is_running(timeout_sec=None):
             if is_ipfs_running():
                 return
         except ipfshttpclient.exceptions.ConnectionError as error:
-            pass
+            # it may come back with a different identity or configuration
+            invalidate_daemon_info()
         time.sleep(1)
         count += 1
         if timeout_sec and count == timeout_sec:
@@ -680,8 +700,69 @@ def _ipfs_api_url() -> ParseResult:
 
 
 def _ipfs_host_ip() -> str:
-    ip_address = socket.gethostbyname(_ipfs_api_url().hostname)
-    return ip_address
+    return _daemon_info.get(
+        "host_ip", lambda: socket.gethostbyname(_ipfs_api_url().hostname))
+
+
+def _ipfs_version() -> str:
+    return _daemon_info.get("version", http_client.version)["Version"]
+
+
+class _DaemonInfoCache:
+    """Caches information about the IPFS daemon which rarely changes while it
+    is running, so that looking it up, e.g. `my_id()`, which
+    ipfs_datatransmission needs for every transmission, doesn't cost an HTTP
+    request to the daemon every time.
+    Entries expire after DAEMON_INFO_TTL_SEC, and all are dropped when
+    `http_client` is replaced or `invalidate_daemon_info()` is called.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._client = None     # the HTTP client the entries were loaded with
+        self._entries = dict()  # key: (time loaded, value)
+        # statistics
+        self.hits = 0   # lookups served from the cache
+        self.misses = 0     # lookups which needed a request to the daemon
+
+    def get(self, key, load):
+        """Returns the cached value for the given key, calling `load()` to
+        look it up if it isn't cached or has expired."""
+        with self._lock:
+            self._check_client()
+            entry = self._entries.get(key)
+            if entry and time.monotonic() - entry[0] < DAEMON_INFO_TTL_SEC:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            client = self._client
+        value = load()
+        with self._lock:
+            if self._client is client:  # not invalidated in the meantime
+                self._entries[key] = (time.monotonic(), value)
+        return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._check_client()
+            self._entries[key] = (time.monotonic(), value)
+
+    def _check_client(self):
+        if self._client is not http_client:
+            self._client = http_client
+            self._entries.clear()
+
+    def invalidate(self):
+        with self._lock:
+            self._client = None
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+_daemon_info = _DaemonInfoCache()
 
 
 def try_run_ipfs():
@@ -7,20 +7,40 @@ ipfs config --json Experimental.Libp2pStreamMounting true
 # from pdb import set_trace as debug
 from ipfs_api import _ipfs_host_ip
 import shutil
-from queue import Queue, Empty as QueueEmpty
+from queue import Queue, Empty as QueueEmpty, Full as QueueFull
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import selectors
 import socket
+import struct
 import threading
 from threading import Thread, Event
 from datetime import datetime, UTC
 import time
 import traceback
+import atexit
 import os
+import errno
+import math
+import mmap
+import zlib
+import hashlib
+import json
+import weakref
 # import inspect
-from inspect import signature
+from inspect import signature, CO_VARARGS, CO_VARKEYWORDS
+from types import FunctionType
 try:
     import ipfs_api
 except:
     import IPFS_API_Remote_Client as ipfs_api
+try:
+    from cryptography.exceptions import InvalidSignature, InvalidTag
+    from cryptography.hazmat.primitives.ciphers import (
+        Cipher, algorithms, modes)
+    from cryptography.hazmat.primitives.poly1305 import Poly1305
+except ImportError:   # only needed for StreamCipher
+    Cipher = None
 
 
 # -------------- Settings ---------------------------------------------------------------------------------------------------
@@ -42,10 +62,79 @@ TRANSM_SEND_TIMEOUT_SEC = 10
 TRANSM_RECV_TIMEOUT_SEC = 10
 
 BUFFER_SIZE = 4096  # the communication buffer size
+# the largest transmission request, stream acknowledgement or other control
+# message accepted from peers, which never need more than a few hundred bytes
+CONTROL_FRAME_MAX_SIZE = 65536  # 64KiB
 # the size of the chunks into which files should be split before transmission
 BLOCK_SIZE = 1048576    # 1MiB
 
 sending_ports = [x for x in range(20001, 20500)]
+# how long a port-forwarding to a peer's protocol is kept open after its last
+# use, so that the next transmission to it can reuse it
+FORWARD_IDLE_TIMEOUT_SEC = 10
+# how many sockets, each registered as an IPFS listening connection, are kept
+# ready for TransmissionListeners to receive transmissions on, so that
+# accepting a transmission request needs no HTTP calls to the IPFS daemon
+RECEIVER_POOL_SIZE = 4
+# whether all listeners in this process (TransmissionListeners, and with them
+# conversations and file listeners, and BufferReceivers) share a single
+# socket, thread and IPFS listening connection, which routes each incoming
+# connection to its listener by the name the sender announces at its start,
+# instead of each listener having its own (see _Demultiplexer).
+# Senders use it too when this is enabled, so it must be enabled on all peers
+# communicating with each other.
+LISTENER_DEMUX = False
+
+# how eventhandlers and progress callbacks are called:
+# "pool": on a shared pool of EVENTHANDLER_POOL_SIZE threads, one call at a time
+#         and in the order the data was received for each listener/conversation
+# "inline": directly on the thread which received the data, delaying the
+#         reception of further data until the eventhandler returns
+# "thread": on a new thread for every call, in no guaranteed order
+EVENTHANDLER_DISPATCH = "pool"
+EVENTHANDLER_POOL_SIZE = 16
+
+# the checksums with which the integrity of the data transmitted on persistent
+# streams can be verified, in order of preference, negotiated with the peer
+# when opening a stream (options: "crc32", "adler32", "sum")
+STREAM_CHECKSUMS = ["crc32", "adler32"]
+
+# coalescing of conversation messages (`start_conversation(coalesce=True)`):
+# how long `Conversation.say()` waits for further messages to send together
+# with a message, and how many bytes of messages it sends together at most
+SAY_COALESCE_DELAY_SEC = 0.005
+SAY_COALESCE_MAX_SIZE = 65536  # 64KiB
+
+# flow control of the messages and files a conversation receives: once this
+# many wait to be consumed (by the eventhandler, or if there is none, by
+# `listen()`/`listen_for_file()`), the conversation stops acknowledging further
+# transmissions, throttling the sender, until no more than the low watermark
+# are left; None for no limit (see _FlowControl)
+CONVERSATION_QUEUE_HIGH_WATERMARK = 1000
+CONVERSATION_QUEUE_LOW_WATERMARK = 500
+
+# where metrics about transmissions are reported (timings of IPFS daemon
+# HTTP calls and of the phases of transmissions, bytes transmitted, retries,
+# queue depths, thread counts), e.g. a PrometheusMetricsSink or a
+# JSONLinesMetricsSink; None to not collect any (see MetricsSink)
+METRICS_SINK = None
+
+# pipelined file transmission (`transmit_file(pipelined=True)`):
+# the number of blocks kept in flight, None to auto-tune it from the measured
+# round-trip time and throughput
+FILE_WINDOW_SIZE = None
+FILE_WINDOW_MAX = 32
+# the range within which the block size is auto-tuned (`block_size=None`)
+FILE_BLOCK_SIZE_MIN = 65536  # 64KiB
+FILE_BLOCK_SIZE_MAX = 4194304  # 4MiB
+# whether to record a hash of every block of a file received, in a checkpoint
+# file next to the partially received file, so that an interrupted file
+# transmission can be resumed where it left off instead of starting over
+FILE_CHECKPOINTS = True
+# whether to send unencrypted files straight from the file, with
+# `socket.sendfile()` on persistent streams, instead of copying every block
+# into a new buffer
+FILE_ZERO_COPY = True
 
 # -------------- User Functions ----------------------------------------------------------------------------------------------
 
@@ -55,7 +144,8 @@ def transmit_data(
         peer_id: str,
         req_lis_name: str,
         timeout_sec: int = TRANSM_SEND_TIMEOUT_SEC,
-        max_retries: int = TRANSM_REQ_MAX_RETRIES):
+        max_retries: int = TRANSM_REQ_MAX_RETRIES,
+        persistent: bool = False):
     """
     Transmits the input data (a bytearray of any length) to the computer with the specified IPFS peer ID.
     Args:
@@ -64,6 +154,13 @@ def transmit_data(
         string listener_name (str): the name of the IPFS-Data-Transmission-Listener instance running on the recipient computer to send the data to (allows distinguishing multiple IPFS-Data-Transmission-Listeners running on the same computer for different applications)
         transm_send_timeout_sec (int): connection attempt timeout, multiplied with the maximum number of retries will result in the total time required for a failed attempt
         transm_req_max_retries (int): how often the transmission should be reattempted when the timeout is reached
+        persistent (bool): whether to reuse a persistent libp2p stream to the
+            recipient's listener, which is opened on the first transmission
+            and over which all later transmissions to the same listener are
+            multiplexed, instead of setting up a new stream for every
+            transmission. Falls back to the normal way of transmitting if the
+            recipient doesn't support persistent streams.
+            See `close_transmission_streams()`.
     Returns:
         bool: whether or not the transmission succeeded
     """
@@ -71,6 +168,21 @@ def transmit_data(
         raise InvalidPeer(
             message="You cannot use your own IPFS peer ID as the recipient.")
 
+    if persistent:
+        # try twice, in case a previously opened stream has broken down
+        for attempt in range(2):
+            stream = _get_transmission_stream(
+                peer_id, req_lis_name, timeout_sec, max_retries)
+            if not stream:  # recipient doesn't support persistent streams
+                break
+            try:
+                return stream.transmit(data, timeout_sec)
+            except _StreamClosed:
+                if attempt == 1:
+                    raise CommunicationTimeout(
+                        "The persistent stream to the peer broke down.")
+                _count("retries_total", operation="stream_reopen")
+
     def SendTransmissionRequest():
         """
         Sends transmission request to the recipient.
@@ -82,7 +194,8 @@ def transmit_data(
         while max_retries == -1 or tries < max_retries:
             if PRINT_LOG_TRANSMISSIONS:
                 print("Sending transmission request to " + str(req_lis_name))
-            sock = _create_sending_connection(peer_id, req_lis_name)
+            sock = _connect_to_listener(peer_id, req_lis_name)
+            start = _timer()
             # sock.sendall(request_data)
             sock.settimeout(timeout_sec)
             _tcp_send_all(sock, request_data)
@@ -95,15 +208,19 @@ def transmit_data(
                                                  timeout=timeout_sec)
             except socket.timeout:
                 sock.close()
-                _close_sending_connection(peer_id, req_lis_name)
+                _close_sending_connection(
+                    peer_id, _listener_protocol(req_lis_name))
                 raise CommunicationTimeout(
                     "Received no response from peer while sending transmission request.")
 
+            _observe_since("transmission_phase_seconds", start,
+                           phase="handshake")
             # reply = _tcp_recv_all(sock, timeout_sec)
             # _tcp_recv_all
             sock.close()
             del sock
-            _close_sending_connection(peer_id, req_lis_name)
+            _close_sending_connection(
+                peer_id, _listener_protocol(req_lis_name))
             if reply:
                 try:
                     their_trsm_port = reply[30:].decode()  # signal success
@@ -121,22 +238,28 @@ def transmit_data(
                     print("Transmission request send " +
                           str(req_lis_name) + "timeout_sec reached.")
             tries += 1
-        _close_sending_connection(peer_id, req_lis_name)
+            _count("retries_total", operation="transmission_request")
         raise CommunicationTimeout(
             "Received no response from peer while sending transmission request.")
 
     their_trsm_port = SendTransmissionRequest()
-    sock = _create_sending_connection(peer_id, their_trsm_port)
+    sock = _connect_to_listener(peer_id, their_trsm_port)
     sock.settimeout(timeout_sec)
+    start = _timer()
     # sock.sendall(data)  # transmit Data
     _tcp_send_all(sock, data)
     if PRINT_LOG_TRANSMISSIONS:
         print("Sent Transmission Data", data)
+    _observe_since("transmission_phase_seconds", start, phase="send")
+    start = _timer()
     response = sock.recv(BUFFER_SIZE)
+    _observe_since("transmission_phase_seconds", start, phase="ack")
     if response and response == b"Finished!":
+        _count("transmissions_total", mode="single")
+        _count("bytes_sent_total", len(data), mode="single")
         # conn.close()
         sock.close()
-        _close_sending_connection(peer_id, their_trsm_port)
+        _close_sending_connection(peer_id, _listener_protocol(their_trsm_port))
         if PRINT_LOG_TRANSMISSIONS:
             print(": Finished transmission.")
         return True  # signal success
@@ -148,6 +271,43 @@ def transmit_data(
     # _close_sending_connection(peer_id, their_trsm_port)
 
 
+def close_transmission_streams(peer_id: str = None):
+    """Closes the persistent streams opened by `transmit_data(persistent=True)`.
+    Args:
+        peer_id (str): only close the streams to this peer (default: all)
+    """
+    with _transmission_streams_lock:
+        streams = [
+            stream for key, stream in _transmission_streams.items()
+            if not peer_id or key[0] == peer_id
+        ]
+    for stream in streams:
+        stream.close()
+
+
+def receiver_pool_stats():
+    """Returns statistics about the pool of sockets on which
+    TransmissionListeners receive transmissions (see RECEIVER_POOL_SIZE).
+    Returns:
+        dict: hits: requests served from the pool,
+            misses: requests for which a socket had to be registered,
+            idle: sockets currently in the pool,
+            accept_latency_avg, accept_latency_max: seconds taken to get a
+                socket ready for a transmission request
+    """
+    return _receiver_pool.stats()
+
+
+def report_metrics_gauges():
+    """Reports the current number of threads, depths of queues and other
+    levels to METRICS_SINK as gauges (see MetricsSink).
+    PrometheusMetricsSink does this itself whenever its `text()` is read,
+    with other sinks call this periodically.
+    """
+    if METRICS_SINK is not None:
+        _report_gauges(METRICS_SINK)
+
+
 def listen_for_transmissions(listener_name, eventhandler):
     """
     Listens for incoming transmission requests (senders requesting to transmit
@@ -192,6 +352,14 @@ class TransmissionListener:
         self._listener_name = listener_name
         self.eventhandler = eventhandler
         self.port = 0  # not yet set
+        self._streams = set()  # connections of persistent streams we serve
+        # a _FlowControl which may make us wait before accepting transmissions
+        self.flow_control = None
+        if LISTENER_DEMUX:
+            self._listener = None
+            self.port = _demultiplexer.register(
+                listener_name, self._handle_connection)
+            return
         self._listener = Thread(target=self._listen, args=(),
                                 name=f"DataTransmissionListener-{listener_name}")
         self._listener.start()
@@ -202,15 +370,9 @@ class TransmissionListener:
         # decoding the transission request buffer
         try:
             # Performing buffer integrity check
-            integrity_byte = data[0]
-            data = data[1:]
-            sum = 0
-            for byte in data:
-                sum += byte
-                if sum > 65000:  # if the sum is reaching the upper limit of an unsigned 16-bit integer
-                    sum = sum % 256   # reduce the sum to its modulus256 so that the calculation above doesn't take too much processing power in later iterations of this for loop
+            data = _verify_integritybyte(data)
             # if the integrity byte doesn't match the buffer, exit the function ignoring the buffer
-            if sum % 256 != integrity_byte:
+            if data is None:
                 if PRINT_LOG:
                     print(
                         self._listener_name + ": Received a buffer with a non-matching integrity buffer")
@@ -221,11 +383,13 @@ class TransmissionListener:
             if PRINT_LOG_TRANSMISSIONS:
                 print(
                     self._listener_name + ": Received transmission request.")
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.bind((_ipfs_host_ip(), 0))
+            if LISTENER_DEMUX:
+                eventhandler = self.eventhandler
+                return _demultiplexer.register_once(
+                    lambda conn: self._receive_data(peer_id, conn, eventhandler),
+                    2 * TRANSM_RECV_TIMEOUT_SEC)
+            sock = _receiver_pool.acquire()
             our_port = sock.getsockname()[1]
-            _create_listening_connection(str(our_port), our_port)
-            sock.listen()
 
             listener = Thread(target=self._receive_transmission, args=(
                 peer_id, sock, our_port, self.eventhandler), name=f"DataTransmissionReceiver-{our_port}")
@@ -253,43 +417,150 @@ class TransmissionListener:
         # sock.sendall(b"start transmission")
         if PRINT_LOG_TRANSMISSIONS:
             print("waiting to receive actual transmission")
-        conn, addr = sock.accept()
+        sock.settimeout(2 * TRANSM_RECV_TIMEOUT_SEC)
+        try:
+            conn, addr = sock.accept()
+        except OSError:  # the sender never connected
+            _receiver_pool.release(sock)
+            return
         if PRINT_LOG_TRANSMISSIONS:
             print("received connection response fro actual transmission")
+        self._receive_data(peer_id, conn, eventhandler)
+        _receiver_pool.release(sock)
 
-        data = _tcp_recv_all(conn, timeout=TRANSM_RECV_TIMEOUT_SEC)
-        conn.send("Finished!".encode())
-        # conn.close()
-        Thread(target=eventhandler, args=(data, peer_id),
-               name="TransmissionListener.ReceivedTransmission").start()
-        _close_listening_connection(str(our_port), our_port)
-        sock.close()
+    def _receive_data(self, peer_id, conn, eventhandler):
+        """Receives the data of a transmission on the connection the sender
+        made for it, acknowledging it."""
+        try:
+            data = _tcp_recv_all(conn, timeout=TRANSM_RECV_TIMEOUT_SEC)
+        except (UnreadableReply, OSError) as error:
+            if PRINT_LOG:
+                print(self._listener_name + ": " + str(error))
+            conn.close()
+            return
+        _count("transmissions_received_total", mode="single")
+        _count("bytes_received_total", len(data), mode="single")
+        if self.flow_control:
+            self.flow_control.wait()
+        # dispatch before acknowledging, so that the sender's next
+        # transmission can't overtake this one
+        _dispatch(self, eventhandler, data, peer_id)
+        try:
+            conn.send("Finished!".encode())
+        except OSError:
+            pass
+        conn.close()
+
+    def _accept_stream(self, conn, data):
+        """Processes a request to open a persistent stream, on which the
+        sender will then multiplex many transmissions."""
+        data = _verify_integritybyte(data)
+        if data is None:
+            if PRINT_LOG:
+                print(
+                    self._listener_name + ": Received a buffer with a non-matching integrity buffer")
+            conn.close()
+            return
+        peer_id, checksums = _parse_stream_request(data)
+        checksum = _choose_stream_checksum(checksums)
+        conn.sendall(_stream_accepted_reply(checksum))
+        self._streams.add(conn)
+        Thread(target=self._serve_stream, args=(conn, peer_id, checksum),
+               name=f"DataTransmissionStream-{self._listener_name}").start()
+
+    def _serve_stream(self, conn, peer_id, checksum=None):
+        """Receives the transmissions multiplexed on a persistent stream,
+        acknowledging each one.
+        Args:
+            conn (socket.socket): the stream
+            peer_id (str): the IPFS peer ID of the sender
+            checksum (str): the checksum negotiated for this stream, if any
+        """
+        if PRINT_LOG_TRANSMISSIONS:
+            print(self._listener_name + ": serving persistent stream")
+        conn.settimeout(None)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        while not self._terminate:
+            try:
+                frame, complete = _tcp_recv_frame(conn)
+            except (UnreadableReply, OSError):
+                break
+            if not complete:   # sender closed the stream
+                break
+            msg_id, data, intact = _unpack_stream_message(frame, checksum)
+            if intact:
+                _count("transmissions_received_total", mode="stream")
+                _count("bytes_received_total", len(data), mode="stream")
+                if self.flow_control:
+                    self.flow_control.wait()
+                _dispatch(self, self.eventhandler, data, peer_id)
+            elif PRINT_LOG:
+                print(self._listener_name
+                      + ": Received a corrupted message on persistent stream")
+            try:
+                _tcp_send_all(conn, _pack_stream_ack(msg_id, checksum, intact))
+            except OSError:
+                break
+        self._streams.discard(conn)
+        conn.close()
 
     def _listen(self):
         if PRINT_LOG_TRANSMISSIONS:
             print("Creating Listener")
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.bind((_ipfs_host_ip(), 0))
-        self.port = self.socket.getsockname()[1]
-        _create_listening_connection(self._listener_name, self.port)
+        # listen and register the listening connection before publishing the
+        # port, so that connections to it (e.g. from terminate() or senders
+        # waiting for it) can't be refused
+        self.socket.listen()
+        port = self.socket.getsockname()[1]
+        _create_listening_connection(self._listener_name, port)
+        self.port = port
+        if self._terminate:     # terminated before the port was published
+            _close_listening_connection(self._listener_name, port)
+            self.socket.close()
+            return
+        _receiver_pool.prewarm()
 
         if PRINT_LOG_TRANSMISSIONS:
             print(self._listener_name
                   + ": Listening for transmission requests as " + self._listener_name)
-        self.socket.listen()
         while True:
             conn, addr = self.socket.accept()
-            data = _tcp_recv_all(conn, timeout=TRANSM_RECV_TIMEOUT_SEC)
+            self._handle_connection(conn)
             if self._terminate:
-                # conn.sendall(b"Righto.")
-                conn.close()
                 self.socket.close()
                 return
+
+    def _handle_connection(self, conn):
+        """Reads and processes the transmission or stream request a sender
+        sent on a new connection."""
+        try:
+            data = _tcp_recv_all(conn, timeout=TRANSM_RECV_TIMEOUT_SEC,
+                                 max_size=CONTROL_FRAME_MAX_SIZE)
+        except (UnreadableReply, OSError) as error:
+            # don't let a misbehaving peer take down the listener
+            if PRINT_LOG:
+                print(self._listener_name + ": " + str(error))
+            conn.close()
+            return
+        if self._terminate:
+            # conn.sendall(b"Righto.")
+            conn.close()
+            return
+        try:
+            if data[1:1 + len(_STREAM_REQUEST)] == _STREAM_REQUEST:
+                self._accept_stream(conn, data)
+                return
             port = self.__receive_transmission_requests(data)
             if port:
                 conn.send(f"Transmission request accepted.{port}".encode())
             else:
                 conn.send(b"Transmission request not accepted.")
+        except (OSError, ValueError) as error:
+            if PRINT_LOG:
+                print(self._listener_name + ": " + str(error))
+            conn.close()
 
     def terminate(self):
         """Stop listening for transmissions and clean up IPFS connection
@@ -299,6 +570,20 @@ class TransmissionListener:
             return
         self._terminate = True
 
+        # stop receiving on the persistent streams we serve, but let them
+        # send the acknowledgement of the transmission they may currently be
+        # processing, e.g. if we're being terminated by its eventhandler
+        for conn in list(self._streams):
+            try:
+                conn.shutdown(socket.SHUT_RD)
+            except OSError:
+                pass
+
+        if not self._listener:  # hosted by the demultiplexer
+            _demultiplexer.unregister(self._listener_name,
+                                      self._handle_connection)
+            return
+
         # if socket hasn't been initialised yet
         if not self.port:
             return
@@ -329,7 +614,9 @@ def start_conversation(conv_name,
                        encryption_callbacks=None,
                        timeout_sec=TRANSM_SEND_TIMEOUT_SEC,
                        max_retries=TRANSM_REQ_MAX_RETRIES,
-                       dir="."):
+                       dir=".",
+                       persistent=False,
+                       coalesce=False):
     """Starts a conversation object with which 2 peers can repetatively make
     data transmissions to each other asynchronously and bidirectionally.
     Sends a conversation request to the other peer's conversation request
@@ -359,6 +646,7 @@ def start_conversation(conv_name,
                                     function(plaintext:bytearray):bytearray,
                                     function(cipher:bytearray):bytearray
                                 )
+                                or a StreamCipher
         transm_send_timeout_sec (int): (low level) data transmission -
                                 connection attempt timeout, multiplied with the
                                 maximum number of retries will result in the
@@ -367,6 +655,11 @@ def start_conversation(conv_name,
                                 how often the transmission should be
                                 reattempted when the timeout is reached
         dir (str): the path where received files should be downloaded to
+        persistent (bool): whether to multiplex our messages over a persistent
+                                libp2p stream to the other peer instead of
+                                opening a new stream for every message
+        coalesce (bool): whether `say()` should send messages said in quick
+                                succession together, see Conversation.say()
     Returns:
         Conversation: an object through which messages and files can be sent
     """
@@ -380,7 +673,9 @@ def start_conversation(conv_name,
                encryption_callbacks=encryption_callbacks,
                transm_send_timeout_sec=timeout_sec,
                transm_req_max_retries=max_retries,
-               dir=dir
+               dir=dir,
+               persistent=persistent,
+               coalesce=coalesce
                )
     return conv
 
@@ -394,7 +689,9 @@ def join_conversation(conv_name,
                       encryption_callbacks=None,
                       timeout_sec=TRANSM_SEND_TIMEOUT_SEC,
                       max_retries=TRANSM_REQ_MAX_RETRIES,
-                      dir="."):
+                      dir=".",
+                      persistent=False,
+                      coalesce=False):
     """Join a conversation object started by another peer.
     Call `.terminate()` on the returned Conversation object when you
     no longer need it to clean up IPFS connection configurations.
@@ -420,6 +717,7 @@ def join_conversation(conv_name,
                                     function(plaintext:bytearray):bytearray,
                                     function(cipher:bytearray):bytearray
                                 )
+                                or a StreamCipher
         transm_send_timeout_sec (int): (low level) data transmission -
                                 connection attempt timeout, multiplied with the
                                 maximum number of retries will result in the
@@ -428,6 +726,11 @@ def join_conversation(conv_name,
                                 how often the transmission should be
                                 reattempted when the timeout is reached
         dir (str): the path where received files should be downloaded to
+        persistent (bool): whether to multiplex our messages over a persistent
+                                libp2p stream to the other peer instead of
+                                opening a new stream for every message
+        coalesce (bool): whether `say()` should send messages said in quick
+                                succession together, see Conversation.say()
     Returns:
         Conversation: an object through which messages and files can be sent
     """
@@ -441,7 +744,9 @@ def join_conversation(conv_name,
               encryption_callbacks=encryption_callbacks,
               transm_send_timeout_sec=timeout_sec,
               transm_req_max_retries=max_retries,
-              dir=dir
+              dir=dir,
+              persistent=persistent,
+              coalesce=coalesce
               )
     return conv
 
@@ -478,8 +783,16 @@ class Conversation:
     file_progress_callback = None
     _transm_send_timeout_sec = TRANSM_SEND_TIMEOUT_SEC
     _transm_req_max_retries = TRANSM_REQ_MAX_RETRIES
+    _persistent = False
+    _peer_binary_frames = False  # whether the peer understands binary frames
+    # whether the peer processes our messages in the order they are received
+    _peer_ordered_delivery = False
+    # whether we and the peer understand each other's message batches
+    _peer_message_batches = False
+    coalesce = False
     _listener = None
     __encryption_callback = None
+    _encryption_callbacks = None  # as passed to start() or join()
     __decryption_callback = None
     _terminate = False
 
@@ -494,6 +807,17 @@ class Conversation:
         self.file_progress_callback = None
         self.message_queue = Queue()
         self._file_queue = Queue()
+        self._message_flow = _FlowControl(self.message_queue)
+        self._file_flow = _FlowControl(self._file_queue)
+        _conversations.add(self)
+        # messages say() collects to send together, see _say_coalesced()
+        self._batch = []
+        self._batch_size = 0
+        self._batch_start_time = 0
+        self._batch_condition = threading.Condition()
+        self._batch_sending_lock = threading.Lock()  # keeps batches in order
+        self._batch_sender = None   # thread sending batches when due
+        self._batch_error = None    # raised by the next say()
 
     def start(self,
               conv_name,
@@ -505,7 +829,9 @@ class Conversation:
               encryption_callbacks=None,
               transm_send_timeout_sec=_transm_send_timeout_sec,
               transm_req_max_retries=_transm_req_max_retries,
-              dir="."):
+              dir=".",
+              persistent=False,
+              coalesce=False):
         """Initialises this conversation object so that it can be used.
         Code execution blocks until the other peer joins the conversation or
         timeout is reached.
@@ -531,6 +857,7 @@ class Conversation:
                                 function(plaintext:bytearray):bytearray,
                                 function(cipher:bytearray):bytearray
                             )
+                            or a StreamCipher
             transm_send_timeout_sec (int): (low level) data transmission
                             connection attempt timeout, multiplied with the
                             maximum number of retries will result in the
@@ -539,6 +866,11 @@ class Conversation:
                             transmission how often the transmission should be
                             reattempted when the timeout is reached
             dir (str): the path where received files should be downloaded to
+            persistent (bool): whether to multiplex our messages over a
+                            persistent libp2p stream to the other peer instead
+                            of opening a new stream for every message
+            coalesce (bool): whether `say()` should send messages said in
+                            quick succession together, see `say()`
         """
         if peer_id == ipfs_api.my_id():
             raise InvalidPeer(
@@ -550,10 +882,14 @@ class Conversation:
         self.file_eventhandler = file_eventhandler
         self.file_progress_callback = file_progress_callback
         if encryption_callbacks:
-            self.__encryption_callback = encryption_callbacks[0]
-            self.__decryption_callback = encryption_callbacks[1]
+            (self.__encryption_callback,
+             self.__decryption_callback) = _encryption_functions(
+                encryption_callbacks)
+        self._encryption_callbacks = encryption_callbacks
         self._transm_send_timeout_sec = transm_send_timeout_sec
         self._transm_req_max_retries = transm_req_max_retries
+        self._persistent = persistent
+        self.coalesce = coalesce
         self.peer_id = peer_id
         if PRINT_LOG_CONVERSATIONS:
             print(conv_name + ": sending conversation request")
@@ -567,15 +903,20 @@ class Conversation:
             dir=dir,
             encryption_callbacks=encryption_callbacks
         )
+        self._listener.flow_control = self._message_flow
+        self.file_listener._listener.flow_control = self._file_flow
         # self._listener = listen_for_transmissions(conv_name, self.hear_eventhandler)
         data = bytearray("I want to start a conversation".encode(
             'utf-8')) + bytearray([255]) + bytearray(conv_name.encode('utf-8'))
+        # capabilities for the joining peer (ignored by old peers)
+        data += bytearray([255]) + _MESSAGE_BATCHES_CAPABILITY
         try:
             transmit_data(data,
                           peer_id,
                           others_req_listener,
                           self._transm_send_timeout_sec,
-                          self._transm_req_max_retries
+                          self._transm_req_max_retries,
+                          persistent=self._persistent
                           )
         except Exception as e:
             self.terminate()
@@ -599,7 +940,9 @@ class Conversation:
              encryption_callbacks=None,
              transm_send_timeout_sec=_transm_send_timeout_sec,
              transm_req_max_retries=_transm_req_max_retries,
-             dir="."):
+             dir=".",
+             persistent=False,
+             coalesce=False):
         """Joins a conversation which another peer started, given their peer ID
         and conversation's transmission-listener's name.
         Used by a conversation listener.
@@ -626,6 +969,7 @@ class Conversation:
                                 function(plaintext:bytearray):bytearray,
                                 function(cipher:bytearray):bytearray
                             )
+                            or a StreamCipher
             transm_send_timeout_sec (int): (low level) data transmission
                             connection attempt timeout, multiplied with the
                             maximum number of retries will result in the
@@ -634,6 +978,11 @@ class Conversation:
                             transmission how often the transmission should be
                             reattempted when the timeout is reached
             dir (str): the path where received files should be downloaded to
+            persistent (bool): whether to multiplex our messages over a
+                            persistent libp2p stream to the other peer instead
+                            of opening a new stream for every message
+            coalesce (bool): whether `say()` should send messages said in
+                            quick succession together, see `say()`
         """
         self.conv_name = conv_name
         if PRINT_LOG_CONVERSATIONS:
@@ -643,10 +992,18 @@ class Conversation:
         self.file_eventhandler = file_eventhandler
         self.file_progress_callback = file_progress_callback
         if encryption_callbacks:
-            self.__encryption_callback = encryption_callbacks[0]
-            self.__decryption_callback = encryption_callbacks[1]
+            (self.__encryption_callback,
+             self.__decryption_callback) = _encryption_functions(
+                encryption_callbacks)
+        self._encryption_callbacks = encryption_callbacks
         self._transm_send_timeout_sec = transm_send_timeout_sec
         self._transm_req_max_retries = transm_req_max_retries
+        self._persistent = persistent
+        self.coalesce = coalesce
+        # the capabilities the peer sent with its conversation request
+        capabilities = _conversation_request_capabilities.pop(
+            others_trsm_listener, ())
+        self._peer_message_batches = _MESSAGE_BATCHES_CAPABILITY in capabilities
         self._listener = listen_for_transmissions(conv_name,
                                                   self._hear,
                                                   )
@@ -656,13 +1013,21 @@ class Conversation:
             dir=dir,
             encryption_callbacks=encryption_callbacks
         )
+        self._listener.flow_control = self._message_flow
+        self.file_listener._listener.flow_control = self._file_flow
 
         self.others_trsm_listener = others_trsm_listener
         self.peer_id = peer_id
         data = bytearray("I'm listening".encode(
             'utf-8')) + bytearray([255]) + bytearray(conv_name.encode('utf-8'))
+        data += bytearray([255]) + _BINARY_FRAMES_CAPABILITY
+        if EVENTHANDLER_DISPATCH != "thread":
+            data += bytearray([255]) + _ORDERED_DELIVERY_CAPABILITY
+        if self._peer_message_batches:
+            data += bytearray([255]) + _MESSAGE_BATCHES_CAPABILITY
         self._conversation_started = True
-        transmit_data(data, peer_id, others_trsm_listener)
+        transmit_data(data, peer_id, others_trsm_listener,
+                      persistent=self._persistent)
         self._last_coms_time = datetime.now(UTC)
         if PRINT_LOG_CONVERSATIONS:
             print(conv_name + ": Joined conversation "
@@ -688,6 +1053,12 @@ class Conversation:
             info = _split_by_255(data)
             if bytearray(info[0]) == bytearray("I'm listening".encode('utf-8')):
                 self.others_trsm_listener = info[1].decode('utf-8')
+                # capabilities the peer advertises (ignored by old peers)
+                self._peer_binary_frames = _BINARY_FRAMES_CAPABILITY in info[2:]
+                self._peer_ordered_delivery = (
+                    _ORDERED_DELIVERY_CAPABILITY in info[2:])
+                self._peer_message_batches = (
+                    _MESSAGE_BATCHES_CAPABILITY in info[2:])
                 # self.hear_eventhandler = self._hear
                 self._conversation_started = True
                 if PRINT_LOG_CONVERSATIONS:
@@ -705,16 +1076,32 @@ class Conversation:
                 if PRINT_LOG_CONVERSATIONS:
                     print("Conv._hear: decrypting message")
                 data = self.__decryption_callback(data)
-            self.message_queue.put(data)
-
-            if self.data_received_eventhandler:
-                # if the data_received_eventhandler has 2 parameters
-                if len(signature(self.data_received_eventhandler).parameters) == 2:
-                    Thread(target=self.data_received_eventhandler,
-                           args=(self, data), name="Converstion.data_received_eventhandler").start()
-                else:
-                    Thread(target=self.data_received_eventhandler, args=(
-                        self, data, arg3), name="Converstion.data_received_eventhandler").start()
+            if self._peer_message_batches and _is_message_batch(data):
+                try:
+                    frame_type, messages = _decode_frame(data)
+                except UnreadableReply as error:
+                    if PRINT_LOG_CONVERSATIONS:
+                        print(f"{self.conv_name}: {error}")
+                    return
+                for message in messages:
+                    self._deliver(bytearray(message), arg3)
+                return
+            self._deliver(data, arg3)
+
+    def _deliver(self, data, arg3=""):
+        """Passes a received message to `listen()` and the
+        data_received_eventhandler."""
+        eventhandler = self.data_received_eventhandler
+        self._message_flow.put(data, eventhandler)
+
+        if eventhandler:
+            # if the data_received_eventhandler has 2 parameters
+            if _count_parameters(eventhandler) == 2:
+                _dispatch(self, _consume, self._message_flow, eventhandler,
+                          self, data)
+            else:
+                _dispatch(self, _consume, self._message_flow, eventhandler,
+                          self, data, arg3)
 
     def listen(self, timeout=None):
         """Waits until the conversation peer sends a message, then returns that
@@ -736,6 +1123,7 @@ class Conversation:
                 data = self.message_queue.get(timeout=timeout)
             except:  # timeout reached
                 raise ConvListenTimeout("Didn't receive any data.") from None
+        self._message_flow.taken()
 
         if data:
             return data
@@ -750,10 +1138,12 @@ class Conversation:
 
         if PRINT_LOG_CONVERSATIONS:
             print(f"{self.conv_name}: Received file: ", filepath)
-        self._file_queue.put({'filepath': filepath, 'metadata': metadata})
-        if self.file_eventhandler:
-            Thread(target=self.file_eventhandler, args=(self, filepath, metadata),
-                   name='Conversation.file_eventhandler').start()
+        eventhandler = self.file_eventhandler
+        self._file_flow.put({'filepath': filepath, 'metadata': metadata},
+                            eventhandler)
+        if eventhandler:
+            _dispatch(self, _consume, self._file_flow, eventhandler,
+                      self, filepath, metadata)
 
     def listen_for_file(self, abs_timeout=None, no_coms_timeout=None):
         """
@@ -768,6 +1158,7 @@ class Conversation:
         start_time = datetime.now(UTC)
         if not (abs_timeout or no_coms_timeout):    # if no timeouts are specified
             data = self._file_queue.get()
+            self._file_flow.taken()
         else:   # timeouts are specified
             while True:
                 # calculate timeouts relative to current time
@@ -790,6 +1181,7 @@ class Conversation:
                     timeout = min(_no_coms_timeout, _abs_timeout)
                 try:
                     data = self._file_queue.get(timeout=timeout)
+                    self._file_flow.taken()
                     break
                 except QueueEmpty:  # qeue timeout reached
                     # check if any of the user's timeouts were reached
@@ -809,15 +1201,13 @@ class Conversation:
     def _on_file_progress_received(self, peer_id: str, filename: str, filesize: str, progress):
         self._last_coms_time = datetime.now(UTC)
         if self.file_progress_callback:
-            # run callback on a new thread, specifying only as many parameters as the callback wants
-            Thread(target=call_progress_callback,
-                   args=(self.file_progress_callback,
-                         peer_id,
-                         filename,
-                         filesize,
-                         progress),
-                   name='Conversation.progress_handler'
-                   ).start()
+            # specifying only as many parameters as the callback wants
+            _dispatch(self, call_progress_callback,
+                      self.file_progress_callback,
+                      peer_id,
+                      filename,
+                      filesize,
+                      progress)
 
             # if len(signature(self.progress_handler).parameters) == 1:
             #     self.file_progress_callback(progress)
@@ -835,6 +1225,14 @@ class Conversation:
         """
         Transmits the provided data (a bytearray of any length) to this
         conversation's peer.
+        If this conversation coalesces messages (`coalesce=True`) and the peer
+        supports it, small messages are instead collected for up to
+        SAY_COALESCE_DELAY_SEC, or until SAY_COALESCE_MAX_SIZE bytes have
+        been collected, and then sent together in a single transmission, of
+        which the peer delivers every message individually.
+        In that case this returns once the message is collected, raising
+        errors that occurred while sending earlier messages.
+        Call `flush()` to send the collected messages immediately.
         Args:
             bytearray data: the data to be transmitted to the receiver
             timeout_sec: connection attempt timeout, multiplied with the
@@ -849,26 +1247,120 @@ class Conversation:
             if PRINT_LOG:
                 print("Wanted to say something but conversation was not yet started")
             time.sleep(0.01)
-        if self.__encryption_callback:
-            if PRINT_LOG_CONVERSATIONS:
-                print("Conv.say: encrypting message")
-            data = self.__encryption_callback(data)
+        if self.coalesce and self._peer_message_batches:
+            return self._say_coalesced(data, timeout_sec, max_retries)
+        if self._peer_message_batches and _is_message_batch(data):
+            # a message the peer would mistake for a batch
+            data = _encode_frame(_FRAME_MESSAGE_BATCH, data)
+        data = self._encrypt(data)
         transmit_data(data, self.peer_id, self.others_trsm_listener,
-                      timeout_sec, max_retries)
+                      timeout_sec, max_retries, persistent=self._persistent)
         self._last_coms_time = datetime.now(UTC)
         return True
 
+    def _say_coalesced(self, data, timeout_sec, max_retries):
+        """Collects a message to be sent together with the other messages
+        said within SAY_COALESCE_DELAY_SEC by the batch sender thread, or
+        sends the collected messages if they exceed SAY_COALESCE_MAX_SIZE."""
+        with self._batch_condition:
+            if self._batch_error:
+                error, self._batch_error = self._batch_error, None
+                raise error
+            if not self._batch:
+                self._batch_start_time = time.monotonic()
+            self._batch.append(bytes(data))
+            self._batch_size += len(data)
+            full = self._batch_size >= SAY_COALESCE_MAX_SIZE
+            if not full:
+                if not self._batch_sender:
+                    self._batch_sender = Thread(
+                        target=self._send_batches, daemon=True,
+                        name=f"DataTransmissionBatches-{self.conv_name}")
+                    self._batch_sender.start()
+                self._batch_condition.notify()
+        if full:
+            self.flush(timeout_sec, max_retries)
+        return True
+
+    def _send_batches(self):
+        """Sends the messages collected by `say()` once they are due."""
+        while True:
+            with self._batch_condition:
+                while not self._batch:
+                    if self._terminate:
+                        return
+                    self._batch_condition.wait()
+                delay = (self._batch_start_time + SAY_COALESCE_DELAY_SEC
+                         - time.monotonic())
+                if delay > 0:
+                    self._batch_condition.wait(delay)
+                    continue
+            try:
+                self.flush()
+            except Exception as error:
+                with self._batch_condition:
+                    self._batch_error = error
+
+    def flush(self,
+              timeout_sec=_transm_send_timeout_sec,
+              max_retries=_transm_req_max_retries):
+        """Sends the messages `say()` has collected to send together
+        (see `coalesce`) immediately, returning once they have been sent.
+        Args:
+            timeout_sec: see `say()`
+            max_retries: see `say()`
+        """
+        with self._batch_sending_lock:
+            with self._batch_condition:
+                batch = self._batch
+                self._batch = []
+                self._batch_size = 0
+            if not batch:
+                return
+            if len(batch) == 1 and not _is_message_batch(batch[0]):
+                data = batch[0]
+            else:
+                data = _encode_frame(_FRAME_MESSAGE_BATCH, *batch)
+            transmit_data(self._encrypt(data), self.peer_id,
+                          self.others_trsm_listener, timeout_sec, max_retries,
+                          persistent=self._persistent)
+            self._last_coms_time = datetime.now(UTC)
+
+    def queue_stats(self):
+        """Returns statistics about the flow control of the messages and files
+        this conversation receives (see CONVERSATION_QUEUE_HIGH_WATERMARK).
+        Returns:
+            dict: {"messages": stats, "files": stats}, where stats is a dict:
+                depth: the number of messages/files waiting to be consumed,
+                dropped: how many were dropped from the queue read by
+                    `listen()`/`listen_for_file()` because it was full,
+                blocked: how often receiving was paused to throttle the peer,
+                blocked_sec: the seconds receiving was paused for in total
+        """
+        return {"messages": self._message_flow.stats(),
+                "files": self._file_flow.stats()}
+
+    def _encrypt(self, data):
+        """Encrypts the given data if this conversation is encrypted."""
+        if self.__encryption_callback:
+            if PRINT_LOG_CONVERSATIONS:
+                print("Conv.say: encrypting message")
+            return self.__encryption_callback(data)
+        return data
+
     def transmit_file(self,
                       filepath,
                       metadata=bytearray(),
                       progress_handler=file_progress_callback,
                       block_size=BLOCK_SIZE,
                       transm_send_timeout_sec=_transm_send_timeout_sec,
-                      transm_req_max_retries=_transm_req_max_retries
+                      transm_req_max_retries=_transm_req_max_retries,
+                      pipelined=False,
+                      stripes=1
                       ):
         """
         Transmits the provided file to the other computer in this conversation.
-
+        See `transmit_file()` for the parameters.
         """
         while not self._conversation_started:
             if PRINT_LOG:
@@ -881,37 +1373,48 @@ class Conversation:
         def _progress_handler(peer_id: str, filename: str, filesize: str, progress):
             self._last_coms_time = datetime.now(UTC)
             if progress_handler:
-                # run callback on a new thread, specifying only as many parameters as the callback wants
-                Thread(target=call_progress_callback,
-                       args=(progress_handler,
-                             peer_id,
-                             filename,
-                             filesize,
-                             progress),
-                       name='Conversation.progress_handler'
-                       ).start()
+                # specifying only as many parameters as the callback wants
+                _dispatch(self, call_progress_callback,
+                          progress_handler,
+                          peer_id,
+                          filename,
+                          filesize,
+                          progress)
         return transmit_file(
             filepath,
             self.peer_id,
             f"{self.others_trsm_listener}:files",
             metadata,
             _progress_handler,
-            encryption_callbacks=(self.__encryption_callback,
-                                  self.__decryption_callback),
+            encryption_callbacks=self._encryption_callbacks,
             block_size=block_size,
             transm_send_timeout_sec=transm_send_timeout_sec,
-            transm_req_max_retries=transm_req_max_retries)
+            transm_req_max_retries=transm_req_max_retries,
+            pipelined=pipelined,
+            stripes=stripes)
 
     def terminate(self):
         """Stop the conversation and clean up IPFS connection configurations.
         """
         if self._terminate:
             return
+        if self._batch:
+            try:
+                self.flush()
+            except Exception as error:
+                if PRINT_LOG_CONVERSATIONS:
+                    print(f"{self.conv_name}: failed to send messages: {error}")
         self._terminate = True
+        with self._batch_condition:
+            self._batch_condition.notify()  # let the batch sender finish
+        self._message_flow.close()
+        self._file_flow.close()
         if self._listener:
             self._listener.terminate()
         if self.file_listener:
             self.file_listener.terminate()
+        if self._persistent and self._conversation_started:
+            _close_transmission_stream(self.peer_id, self.others_trsm_listener)
 
     def close(self):
         """Stop the conversation and clean up IPFS connection configurations.
@@ -949,6 +1452,7 @@ class ConversationListener:
                 print(
                     f"ConvLisReceived {self._listener_name}: Starting conversation...")
             conv_name = info[1].decode('utf-8')
+            _record_conversation_request(conv_name, info[2:])
             self.eventhandler(conv_name, peer_id)
         elif PRINT_LOG_CONVERSATIONS:
             print(
@@ -965,6 +1469,145 @@ class ConversationListener:
         self.terminate()
 
 
+# the capabilities sent with conversation requests, by the name of the
+# requested conversation, until the conversation is joined
+_conversation_request_capabilities = {}
+# how many conversation requests' capabilities are remembered
+_CONVERSATION_REQUESTS_MAX = 1024
+
+
+class _FlowControl:
+    """Flow control for the messages or files a conversation receives.
+    Counts the items waiting to be consumed: the eventhandler calls which
+    haven't returned yet, or if there is no eventhandler, the items in the
+    queue from which `listen()`/`listen_for_file()` take them.
+    Once CONVERSATION_QUEUE_HIGH_WATERMARK items are waiting, the threads
+    receiving further transmissions wait before acknowledging them until no
+    more than CONVERSATION_QUEUE_LOW_WATERMARK are left, which throttles the
+    sender. They wait for at most half of TRANSM_RECV_TIMEOUT_SEC at a time,
+    so that the sender doesn't time out.
+    If there is an eventhandler, the queue keeps only the most recent
+    CONVERSATION_QUEUE_HIGH_WATERMARK items, as it may never be read.
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self._condition = threading.Condition()
+        self._pending = 0   # eventhandler calls which haven't returned yet
+        self._queue_consumed = True     # whether the queue is read instead
+        self._throttling = False
+        self._closed = False
+        # the most items the queue keeps if there is an eventhandler
+        # (default: CONVERSATION_QUEUE_HIGH_WATERMARK)
+        self.queue_limit = None
+        # statistics
+        self.dropped = 0
+        self.blocked = 0
+        self.blocked_sec = 0.0
+
+    def depth(self):
+        """Returns the number of items waiting to be consumed."""
+        if self._queue_consumed:
+            return self._pending + self.queue.qsize()
+        return self._pending
+
+    def put(self, item, eventhandler):
+        """Queues a received item, which is also passed to the eventhandler
+        (if any), whose call must be wrapped with `_consume()`."""
+        with self._condition:
+            self._queue_consumed = not eventhandler
+            if eventhandler:
+                self._pending += 1
+                limit = self.queue_limit
+                if limit is None:
+                    limit = CONVERSATION_QUEUE_HIGH_WATERMARK
+                if limit == 0:
+                    self._update()
+                    return
+                while limit is not None and self.queue.qsize() >= limit:
+                    try:
+                        self.queue.get_nowait()
+                    except QueueEmpty:
+                        break
+                    self.dropped += 1
+                    _count("conversation_items_dropped_total")
+            self.queue.put(item)
+            self._update()
+
+    def done(self):
+        """Counts an eventhandler call as returned."""
+        with self._condition:
+            self._pending -= 1
+            self._update()
+
+    def taken(self):
+        """Is called after an item has been taken from the queue."""
+        with self._condition:
+            self._update()
+
+    def _update(self):
+        high_watermark = CONVERSATION_QUEUE_HIGH_WATERMARK
+        depth = self.depth()
+        if self._closed or high_watermark is None:
+            self._throttling = False
+        elif depth >= high_watermark:
+            self._throttling = True
+        elif self._throttling and depth <= CONVERSATION_QUEUE_LOW_WATERMARK:
+            self._throttling = False
+        if not self._throttling:
+            self._condition.notify_all()
+
+    def wait(self):
+        """Waits while the consumer has fallen behind (see above)."""
+        with self._condition:
+            self._update()  # in case items were taken from the queue directly
+            if not self._throttling:
+                return
+            self.blocked += 1
+            start_time = time.monotonic()
+            self._condition.wait_for(lambda: not self._throttling,
+                                     TRANSM_RECV_TIMEOUT_SEC / 2)
+            duration = time.monotonic() - start_time
+            self.blocked_sec += duration
+            _observe("flow_control_blocked_seconds", duration)
+
+    def close(self):
+        """Stops throttling, releasing waiting threads."""
+        with self._condition:
+            self._closed = True
+            self._update()
+
+    def stats(self):
+        with self._condition:
+            return {
+                "depth": self.depth(),
+                "dropped": self.dropped,
+                "blocked": self.blocked,
+                "blocked_sec": self.blocked_sec,
+            }
+
+
+def _consume(flow_control, eventhandler, *args):
+    """Calls an eventhandler for a received item, then counts the item as
+    consumed by the given _FlowControl."""
+    try:
+        eventhandler(*args)
+    finally:
+        flow_control.done()
+
+
+def _record_conversation_request(conv_name, capabilities):
+    """Remembers the capabilities a peer sent with a conversation request,
+    for `Conversation.join()`."""
+    _conversation_request_capabilities.pop(conv_name, None)
+    _conversation_request_capabilities[conv_name] = [
+        bytes(capability) for capability in capabilities]
+    while len(_conversation_request_capabilities) > _CONVERSATION_REQUESTS_MAX:
+        # forget the oldest request that was never joined
+        _conversation_request_capabilities.pop(
+            next(iter(_conversation_request_capabilities)), None)
+
+
 def transmit_file(filepath,
                   peer_id,
                   others_req_listener,
@@ -973,7 +1616,9 @@ def transmit_file(filepath,
                   encryption_callbacks=None,
                   block_size=BLOCK_SIZE,
                   transm_send_timeout_sec=TRANSM_SEND_TIMEOUT_SEC,
-                  transm_req_max_retries=TRANSM_REQ_MAX_RETRIES
+                  transm_req_max_retries=TRANSM_REQ_MAX_RETRIES,
+                  pipelined=False,
+                  stripes=1
                   ):
     """Transmits the provided file to the specified peer.
     Args:
@@ -991,10 +1636,12 @@ def transmit_file(filepath,
                             function(plaintext:bytearray):bytearray,
                             function(cipher:bytearray):bytearray
                         )
+                        or a StreamCipher
         block_size (int): the FileTransmitter sends the file in chunks. This is
                         the size of those chunks in bytes (default 1MiB).
                         Increasing this speeds up transmission but reduces the
                         frequency of progress update messages.
+                        None: auto-tune it (pipelined transmissions only)
         transm_send_timeout_sec (int): (low level) data transmission -
                         connection attempt timeout, multiplied with the maximum
                         number of retries will result in the total time
@@ -1002,6 +1649,16 @@ def transmit_file(filepath,
         transm_req_max_retries (int): (low level) data transmission -
                         how often the transmission should be reattempted when
                         the timeout is reached
+        pipelined (bool): whether to keep several blocks in flight on a
+                        persistent stream instead of waiting for each block to
+                        be acknowledged before sending the next, see
+                        FILE_WINDOW_SIZE. Falls back to sending one block at a
+                        time if the receiver doesn't support it.
+        stripes (int): the number of persistent streams to send the file's
+                        blocks over in parallel (implies `pipelined`), for
+                        links on which a single stream can't use the full
+                        bandwidth. Falls back to a single stream if the
+                        receiver doesn't support it.
     Returns:
         FileTransmitter: object which manages the filetransmission
     """
@@ -1014,7 +1671,9 @@ def transmit_file(filepath,
         encryption_callbacks=encryption_callbacks,
         block_size=block_size,
         transm_send_timeout_sec=transm_send_timeout_sec,
-        transm_req_max_retries=transm_req_max_retries
+        transm_req_max_retries=transm_req_max_retries,
+        pipelined=pipelined,
+        stripes=stripes
     )
 
 
@@ -1045,6 +1704,7 @@ def listen_for_file_transmissions(listener_name,
                                 function(plaintext:bytearray):bytearray,
                                 function(cipher:bytearray):bytearray
                             )
+                            or a StreamCipher
     Returns:
         ConversationListener: an object which listens for incoming file
                             requests
@@ -1067,6 +1727,13 @@ class FileTransmitter:
     """Object for managing file transmission (sending only, not receiving)
     """
     status = "not started"  # "transmitting" "finished" "aborted"
+    throughput = None  # bytes/sec achieved, set when finished
+    window_size = 1  # the number of blocks kept in flight
+    resumed_at = 0  # the position from which an interrupted transmission
+    # was resumed, i.e. how many bytes the receiver already had
+    _positioned_blocks = False  # whether blocks are prefixed with positions
+    _next_position = 0  # the position of the next block to send
+    _delivered = 0  # the number of bytes the receiver has acknowledged
 
     def __init__(self,
                  filepath,
@@ -1077,7 +1744,9 @@ class FileTransmitter:
                  encryption_callbacks=None,
                  block_size=BLOCK_SIZE,
                  transm_send_timeout_sec=TRANSM_SEND_TIMEOUT_SEC,
-                 transm_req_max_retries=TRANSM_REQ_MAX_RETRIES
+                 transm_req_max_retries=TRANSM_REQ_MAX_RETRIES,
+                 pipelined=False,
+                 stripes=1
                  ):
         """
         Args:
@@ -1095,10 +1764,12 @@ class FileTransmitter:
                                 function(plaintext:bytearray):bytearray,
                                 function(cipher:bytearray):bytearray
                             )
+                            or a StreamCipher
             block_size (int): the FileTransmitter sends the file in chunks. This is
                             the size of those chunks in bytes (default 1MiB).
                             Increasing this speeds up transmission but reduces the
                             frequency of progress update messages.
+                            None: auto-tune it (pipelined transmissions only)
             transm_send_timeout_sec (int): (low level) data transmission -
                             connection attempt timeout, multiplied with the maximum
                             number of retries will result in the total time
@@ -1106,6 +1777,10 @@ class FileTransmitter:
             transm_req_max_retries (int): (low level) data transmission -
                             how often the transmission should be reattempted when
                             the timeout is reached
+            pipelined (bool): whether to keep several blocks in flight on a
+                            persistent stream, see `transmit_file()`
+            stripes (int): the number of persistent streams to send the
+                            file over in parallel, see `transmit_file()`
         """
         if peer_id == ipfs_api.my_id():
             raise InvalidPeer(
@@ -1118,9 +1793,25 @@ class FileTransmitter:
         self.metadata = metadata
         self.progress_handler = progress_handler
         self.encryption_callbacks = encryption_callbacks
-        self.block_size = block_size
+        self._auto_block_size = block_size is None and (
+            pipelined or stripes > 1)
+        if self._auto_block_size:
+            block_size = 4 * FILE_BLOCK_SIZE_MIN
+        self.block_size = block_size or BLOCK_SIZE
         self._transm_send_timeout_sec = transm_send_timeout_sec
         self._transm_req_max_retries = transm_req_max_retries
+        self.pipelined = pipelined or stripes > 1
+        self.stripes = stripes
+        self._cipher = None
+        if isinstance(encryption_callbacks, StreamCipher):
+            self._cipher = encryption_callbacks
+        # send unencrypted files straight from the file with sendfile
+        self._zero_copy = FILE_ZERO_COPY and not encryption_callbacks
+        # read blocks from a memory map instead of copying them into new
+        # buffers, unless an encryption callback is going to copy them anyway
+        self._map_file = FILE_ZERO_COPY and (
+            not encryption_callbacks or self._cipher is not None)
+        self._claim_lock = threading.Lock()
 
         self.conv_name = self.filename + "_conv"
         self.conversation = Conversation()
@@ -1131,60 +1822,375 @@ class FileTransmitter:
             data_received_eventhandler=self._hear,
             encryption_callbacks=self.encryption_callbacks,
             transm_send_timeout_sec=self._transm_send_timeout_sec,
-            transm_req_max_retries=self._transm_req_max_retries
+            transm_req_max_retries=self._transm_req_max_retries,
+            persistent=self.pipelined
         )
-        self.conversation.say(
-            _to_b255_no_0s(self.filesize) + bytearray([255])
-            + bytearray(self.filename.encode()) + bytearray([255]) + self.metadata)
+        self.conversation.say(_encode_file_header(
+            self.filesize, self.filename, self.metadata,
+            binary=self.conversation._peer_binary_frames,
+            features=_FILE_FEATURES))
         if PRINT_LOG_FILES:
             print("FileTransmission: " + self.filename
                   + ": Sent transmission request")
         self._call_progress_callback(0)
 
-    def _start_transmission(self):
+    def _start_transmission(self, receiver_features=None, offered_blocks=()):
+        """Transmits the file's contents.
+        Args:
+            receiver_features (int): the `_FILE_*` features the receiver
+                supports, None if it replied to the file header the legacy way
+            offered_blocks (list): the blocks the receiver already has, if it
+                offered to resume an interrupted transmission,
+                see `_decode_file_ready()`
+        """
         if PRINT_LOG_FILES:
             print("FileTransmission: " + self.filename
                   + ": starting transmmission")
         self.status = "transmitting"
-        position = 0
-        with open(self.filepath, "rb") as reader:
-            while position < self.filesize:
-                blocksize = self.filesize - position
-                if blocksize > self.block_size:
-                    blocksize = self.block_size
-                data = reader.read(blocksize)
-                position += len(data)
-                self._call_progress_callback(position / self.filesize,)
-
-                if PRINT_LOG_FILES:
+        start_time = time.monotonic()
+        stream = None
+        try:
+            if self.pipelined and self.conversation._peer_ordered_delivery:
+                stream = _get_transmission_stream(
+                    self.peer_id, self.conversation.others_trsm_listener,
+                    self._transm_send_timeout_sec,
+                    self._transm_req_max_retries)
+            if receiver_features is not None:
+                self.resumed_at = self._count_matching_bytes(offered_blocks)
+                self._next_position = self._delivered = self.resumed_at
+                # prefixing blocks with their positions costs a copy of
+                # every block when sending them with `Conversation.say()`
+                self._positioned_blocks = bool(
+                    stream and receiver_features & _FILE_POSITIONED_BLOCKS)
+                self.conversation.say(_encode_file_resume(
+                    self.resumed_at, self._positioned_blocks))
+                if PRINT_LOG_FILES and self.resumed_at:
                     print("FileTransmission: " + self.filename
-                          + ": sending data " + str(position) + "/" + str(self.filesize))
-                self.conversation.say(data)
+                          + f": resuming transmission at {self.resumed_at}")
+                if self.resumed_at:
+                    self._call_progress_callback(
+                        self.resumed_at / self.filesize)
+            if stream and self._positioned_blocks and self.stripes > 1:
+                # blocks carry their positions, so they can take any stream
+                streams = self._open_stripes(stream)
+                try:
+                    self._transmit_striped(streams)
+                finally:
+                    for stripe in streams[1:]:
+                        stripe.close()
+            elif stream:
+                self._transmit_pipelined(stream)
+            else:
+                self._transmit_sequentially()
+        except:
+            self.status = "aborted"
+            self.conversation.close()
+            raise
+        duration = time.monotonic() - start_time
+        transmitted = self.filesize - self.resumed_at
+        self.throughput = transmitted / duration if duration else None
+        _count("file_bytes_sent_total", transmitted)
+        if self.throughput:
+            _observe("file_transmission_bytes_per_second", self.throughput)
         if PRINT_LOG_FILES:
             print("FileTransmission: " + self.filename
-                  + ": finished file transmission")
+                  + ": finished file transmission at "
+                  + f"{transmitted / max(duration, 1e-9) / 1048576:.1f}MiB/s")
         self.status = "finished"
         self.conversation.close()
 
+    def _count_matching_bytes(self, offered_blocks):
+        """Checks which of the blocks the receiver already has are identical
+        to the start of the file.
+        Returns:
+            int: the number of bytes at the start of the file which the
+                receiver has, i.e. the position from which to transmit
+        """
+        position = 0
+        with open(self.filepath, "rb") as reader:
+            for length, digest in offered_blocks:
+                if position + length > self.filesize:
+                    break
+                if hashlib.sha256(reader.read(length)).digest() != digest:
+                    break
+                position += length
+        return position
+
+    def _transmit_sequentially(self):
+        with open(self.filepath, "rb") as file:
+            blocks = self._blocks(file)
+            try:
+                for data, position in blocks:
+                    position += len(data)
+                    self._call_progress_callback(position / self.filesize,)
+
+                    if PRINT_LOG_FILES:
+                        print("FileTransmission: " + self.filename
+                              + ": sending data " + str(position) + "/" + str(self.filesize))
+                    self.conversation.say(data)
+            finally:
+                blocks.close()
+
+    def _transmit_pipelined(self, stream):
+        """Sends the file's blocks over the given persistent stream, keeping
+        up to `self.window_size` of them in flight.
+        Unencrypted files are sent straight from the file with
+        `socket.sendfile()`, files encrypted with a StreamCipher are
+        encrypted straight from a memory map of the file, and others are read
+        from disk on a separate thread while the previous blocks are being
+        sent."""
+        with open(self.filepath, "rb") as file:
+            if self._map_file:
+                blocks = self._map_blocks(file)
+            else:
+                blocks = self._read_blocks_ahead()
+            try:
+                self._send_blocks(stream, file, blocks)
+            finally:
+                blocks.close()
+
+    def _transmit_striped(self, streams):
+        """Sends the file's blocks over several persistent streams at once,
+        each stripe claiming the next block to send whenever there is room in
+        its window, see `_send_blocks()`."""
+        errors = []
+
+        def send_stripe(stream):
+            try:
+                with open(self.filepath, "rb") as file:
+                    blocks = self._blocks(file)
+                    try:
+                        self._send_blocks(stream, file, blocks)
+                    finally:
+                        blocks.close()
+            except Exception as error:
+                errors.append(error)
+                self.status = "aborted"  # stops the other stripes
+
+        threads = [
+            Thread(target=send_stripe, args=(stream,),
+                   name=f"FileTransmitter-stripe-{i}-{self.filename}")
+            for i, stream in enumerate(streams)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def _open_stripes(self, stream):
+        """Returns the given persistent stream plus up to `self.stripes - 1`
+        newly opened streams to the receiver, each on its own forwarded
+        connection."""
+        streams = [stream]
+        for i in range(self.stripes - 1):
+            stripe = _open_transmission_stream(
+                self.peer_id, self.conversation.others_trsm_listener,
+                self._transm_send_timeout_sec, self._transm_req_max_retries)
+            if not stripe:
+                break
+            streams.append(stripe)
+        return streams
+
+    def _send_blocks(self, stream, file, blocks):
+        """Sends the given blocks over the given persistent stream, keeping up
+        to `self.window_size` of them in flight."""
+        self.window_size = FILE_WINDOW_SIZE or 2
+        in_flight = deque()  # (_StreamMessage, bytes delivered when sent)
+        delivered = 0   # bytes acknowledged by the receiver on this stream
+        buffer = bytearray()  # reused for encrypting every block
+        delivery_rates = deque(maxlen=10)  # recent samples, bytes/sec
+        min_rtt = None
+        finished_reading = False
+        while True:
+            while not finished_reading and len(in_flight) < self.window_size:
+                block = next(blocks, None)
+                if block is None:
+                    finished_reading = True
+                    break
+                data, position = block
+                header = b""
+                if self._positioned_blocks:
+                    header = _FILE_BLOCK_HEADER.pack(position)
+                if self._zero_copy:
+                    message = stream.send(data, file_range=(file, position),
+                                          prefix=header)
+                elif self._cipher:
+                    encrypted = self._cipher.encrypt_into(buffer, header, data)
+                    try:
+                        message = stream.send(encrypted)
+                    finally:
+                        encrypted.release()
+                else:
+                    message = stream.send(
+                        self.conversation._encrypt(header + data))
+                in_flight.append((message, len(data), delivered))
+                if PRINT_LOG_FILES:
+                    print("FileTransmission: " + self.filename
+                          + f": sending data, {len(in_flight)} blocks in flight")
+            if not in_flight:
+                break
+            message, size, delivered_when_sent = in_flight.popleft()
+            if not stream.wait(message, self._transm_send_timeout_sec):
+                raise DataTransmissionError(
+                    "A block of the file arrived corrupted at the peer.")
+            delivered += size
+            with self._claim_lock:
+                self._delivered += size
+                progress = self._delivered / self.filesize
+            self.conversation._last_coms_time = datetime.now(UTC)
+            self._call_progress_callback(progress)
+
+            # estimate the bandwidth-delay product from the lowest round-trip
+            # time and the recent delivery rates
+            rtt = max(message.rtt, 1e-6)
+            min_rtt = rtt if min_rtt is None else min(min_rtt, rtt)
+            delivery_rates.append((delivered - delivered_when_sent) / rtt)
+            self._tune(max(delivery_rates), min_rtt)
+
+    def _tune(self, bandwidth, rtt):
+        """Adapts the block and window sizes to the estimated bandwidth
+        (bytes/sec) and round-trip time (sec)."""
+        bdp = bandwidth * rtt  # bandwidth-delay product
+        if self._auto_block_size:
+            # aim for a few blocks per round trip, but blocks large enough to
+            # take 10ms to send, to amortise the overhead per block,
+            # in powers of two
+            target = max(bdp / 4, bandwidth * 0.01, FILE_BLOCK_SIZE_MIN)
+            self.block_size = min(2**int(math.log2(target)),
+                                  FILE_BLOCK_SIZE_MAX)
+        if FILE_WINDOW_SIZE is None:
+            # twice the bandwidth-delay product, so the window can grow until
+            # queuing delays the acknowledgements
+            self.window_size = min(
+                max(math.ceil(2 * bdp / self.block_size), 2), FILE_WINDOW_MAX)
+
+    def _blocks(self, file):
+        """Yields the blocks of the given file which are still to be sent,
+        with their positions, see `_map_blocks()` and `_read_blocks()`.
+        Blocks are claimed with `_claim_block()`, so several generators can
+        share the work of reading the file."""
+        if self._map_file:
+            return self._map_blocks(file)
+        return self._read_blocks(file)
+
+    def _map_blocks(self, file):
+        """Yields the blocks of the given file from `self.resumed_at` on as
+        memoryviews of the memory-mapped file, with their positions,
+        so that sending them doesn't require allocating and copying them
+        into new buffers."""
+        if self.resumed_at >= self.filesize:
+            return
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mapped, "madvise"):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        view = memoryview(mapped)
+        try:
+            while claimed := self._claim_block():
+                position, size = claimed
+                # reading a memory-mapped file beyond its end crashes
+                if os.fstat(file.fileno()).st_size < position + size:
+                    raise DataTransmissionError(
+                        "The file got shorter while being transmitted.")
+                block = view[position:position + size]
+                try:
+                    yield block, position
+                finally:
+                    block.release()
+        finally:
+            view.release()
+            mapped.close()
+
+    def _read_blocks(self, file):
+        """Yields the blocks of the given file from `self.resumed_at` on,
+        with their positions."""
+        while claimed := self._claim_block():
+            position, size = claimed
+            file.seek(position)
+            data = file.read(size)
+            if len(data) < size:
+                raise DataTransmissionError(
+                    "The file got shorter while being transmitted.")
+            yield data, position
+
+    def _claim_block(self):
+        """Claims the next block of the file to send, which for striped
+        transmissions is shared by all stripes.
+        Returns:
+            tuple(int, int): the block's position and size, or None if there
+                are no more blocks to send
+        """
+        with self._claim_lock:
+            position = self._next_position
+            if position >= self.filesize or self.status != "transmitting":
+                return None
+            size = min(self.block_size, self.filesize - position)
+            self._next_position = position + size
+            return position, size
+
+    def _read_blocks_ahead(self):
+        """Like `_read_blocks()`, but reads the blocks on a separate thread,
+        a couple of blocks ahead of the ones requested."""
+        blocks = Queue(maxsize=2)
+        Thread(target=self._read_blocks_into, args=(blocks,),
+               name=f"FileTransmitter-reader-{self.filename}",
+               daemon=True).start()
+        while True:
+            block = blocks.get()
+            if isinstance(block, Exception):
+                raise block
+            if block is None:
+                return
+            yield block
+
+    def _read_blocks_into(self, blocks):
+        """Reads the file block by block into the given queue, followed by
+        None, or an exception if reading fails."""
+        try:
+            with open(self.filepath, "rb") as reader:
+                for block in self._read_blocks(reader):
+                    self._put_block(blocks, block)
+            self._put_block(blocks, None)
+        except Exception as error:
+            self._put_block(blocks, error)
+
+    def _put_block(self, blocks, data):
+        # stop waiting for space in the queue if the transmission was aborted
+        while self.status == "transmitting":
+            try:
+                blocks.put(data, timeout=1)
+                return
+            except QueueFull:
+                pass
+
     def _call_progress_callback(self, progress):
         if self.progress_handler:
-            # run callback on a new thread, specifying only as many parameters as the callback wants
-            Thread(target=call_progress_callback,
-                   args=(self.progress_handler,
-                         self.peer_id,
-                         self.filename,
-                         self.filesize,
-                         progress),
-                   name='Conversation.progress_handler'
-                   ).start()
+            # specifying only as many parameters as the callback wants
+            _dispatch(self, call_progress_callback,
+                      self.progress_handler,
+                      self.peer_id,
+                      self.filename,
+                      self.filesize,
+                      progress)
 
     def _hear(self, conv, data):
         if PRINT_LOG_FILES:
             print("FileTransmission: " + self.filename
                   + ": received response from receiver")
-        info = _split_by_255(data)
-        if info[0].decode('utf-8') == "ready":
-            self._start_transmission()
+        if _is_binary_frame(data):
+            # the receiver supports features of file transmissions, and
+            # may offer to resume an interrupted transmission
+            receiver_features, offered_blocks = _decode_file_ready(data)
+        elif _split_by_255(data)[0].decode('utf-8') == "ready":
+            receiver_features, offered_blocks = None, ()
+        else:
+            return
+        # transmit on a separate thread so as not to occupy an
+        # eventhandler worker for the whole transmission
+        Thread(target=self._start_transmission,
+               args=(receiver_features, offered_blocks),
+               name=f"FileTransmitter-{self.filename}").start()
 
     def __del__(self):
         if self.conversation:
@@ -1198,6 +2204,10 @@ class FileTransmissionReceiver:
     transmission_started = False
     writtenbytes = 0
     status = "not started"  # "receiving" "finished" "aborted"
+    checkpoint = None  # file recording the hashes of the received blocks
+    _offered_blocks = []  # blocks we offered to resume the transmission with
+    _awaiting_position = False  # waiting for the sender's FILE_RESUME frame
+    _positioned_blocks = False  # whether blocks are prefixed with positions
 
     def setup(self, conversation, eventhandler, progress_handler=None, dir="."):
         """Configure this object to make it work.
@@ -1220,6 +2230,9 @@ class FileTransmissionReceiver:
         self.eventhandler = eventhandler
         self.progress_handler = progress_handler
         self.conv = conversation
+        if isinstance(conversation, Conversation):
+            # the blocks are only needed by on_data_received()
+            conversation._message_flow.queue_limit = 0
         self.dir = dir
         if PRINT_LOG_FILES:
             print("FileReception: "
@@ -1230,29 +2243,32 @@ class FileTransmissionReceiver:
     def on_data_received(self, conv, data):
         if not self.transmission_started:
             try:
-                filesize, filename, metadata = _split_by_255(data)
-                self.filesize = _from_b255_no_0s(filesize)
-                self.filename = filename.decode('utf-8')
-                self.metadata = metadata
-                self.writer = open(os.path.join(
-                    self.dir, self.filename + ".PART"), "wb")
+                (self.filesize, self.filename, self.metadata,
+                 features) = _decode_file_header(data)
                 self.transmission_started = True
-                self.conv.say("ready".encode())
-                self.writtenbytes = 0
+                if features and self.filesize > 0:
+                    # tell the sender which features we support, offering to
+                    # resume an interrupted transmission if there was one,
+                    # the sender replies with the position it resumes from
+                    if features & _FILE_RESUMABLE:
+                        self._offered_blocks = self._load_checkpoint()
+                    self._awaiting_position = True
+                    self.conv.say(_encode_file_ready(
+                        features & _FILE_FEATURES, self._offered_blocks))
+                else:
+                    self._open_files(0)
+                    self.conv.say("ready".encode())
                 if PRINT_LOG_FILES:
                     print("FileReception: " + self.filename
                           + ": ready to receive file")
                 if self.progress_handler:
-                    # run callback on a new thread, specifying only as many parameters as the callback wants
-                    Thread(target=call_progress_callback,
-                           args=(self.progress_handler,
-                                 self.conv.peer_id,
-                                 self.filename,
-                                 self.filesize,
-                                 0
-                                 ),
-                           name='FileTransmissionReceiver.progress'
-                           ).start()
+                    # specifying only as many parameters as the callback wants
+                    _dispatch(self, call_progress_callback,
+                              self.progress_handler,
+                              self.conv.peer_id,
+                              self.filename,
+                              self.filesize,
+                              0)
 
                 if (self.filesize == 0):
                     self.finish()
@@ -1260,22 +2276,47 @@ class FileTransmissionReceiver:
                 if PRINT_LOG_FILES:
                     print("Received unreadable data on FileTransmissionListener ")
                     traceback.print_exc()
-
+        elif self._awaiting_position:
+            position, self._positioned_blocks = _decode_file_resume(data)
+            self._open_files(position)
+            self._awaiting_position = False
+            if PRINT_LOG_FILES and position:
+                print("FileReception: " + self.filename
+                      + f": resuming reception at {position}")
+            if self.progress_handler and position:
+                _dispatch(self, call_progress_callback,
+                          self.progress_handler,
+                          self.conv.peer_id,
+                          self.filename,
+                          self.filesize,
+                          self.writtenbytes / self.filesize)
         else:
-            self.writer.write(data)
-            self.writtenbytes += len(data)
+            if self._positioned_blocks:
+                position = _FILE_BLOCK_HEADER.unpack_from(data)[0]
+                block = memoryview(data)[_FILE_BLOCK_HEADER.size:]
+            else:
+                position = self.writtenbytes
+                block = data
+            if position + len(block) > self.filesize:
+                self.writer.close()
+                raise UnreadableReply(
+                    "Something weird happened, filesize is larger than expected.")
+            _write_at(self.writer.fileno(), block, position)
+            self.writtenbytes += len(block)
+            if self.checkpoint:
+                # record the block only once it has been written
+                self.checkpoint.write(f"{position} {len(block)} "
+                                      f"{hashlib.sha256(block).hexdigest()}\n")
+                self.checkpoint.flush()
 
             if self.progress_handler:
-                # run callback on a new thread, specifying only as many parameters as the callback wants
-                Thread(target=call_progress_callback,
-                       args=(self.progress_handler,
-                             self.conv.peer_id,
-                             self.filename,
-                             self.filesize,
-                             self.writtenbytes / self.filesize
-                             ),
-                       name='FileTransmissionReceiver.progress'
-                       ).start()
+                # specifying only as many parameters as the callback wants
+                _dispatch(self, call_progress_callback,
+                          self.progress_handler,
+                          self.conv.peer_id,
+                          self.filename,
+                          self.filesize,
+                          self.writtenbytes / self.filesize)
 
             if PRINT_LOG_FILES:
                 print("FileTransmission: " + self.filename
@@ -1283,13 +2324,75 @@ class FileTransmissionReceiver:
 
             if self.writtenbytes == self.filesize:
                 self.finish()
-            elif self.writtenbytes > self.filesize:
-                self.writer.close()
-                raise UnreadableReply(
-                    "Something weird happened, filesize is larger than expected.")
+
+    def _load_checkpoint(self):
+        """Reads the checkpoint of a previous, interrupted reception of this
+        file, and checks which blocks of the partially received file are
+        still intact.
+        Returns:
+            list: (length:int, sha256:bytes) of the intact blocks at the start
+                of the partially received file, without gaps
+        """
+        path = os.path.join(self.dir, self.filename + ".PART")
+        blocks = dict()  # position: (length, sha256)
+        try:
+            with open(path + ".checkpoint") as checkpoint, \
+                    open(path, "rb") as reader:
+                if int(checkpoint.readline()) != self.filesize:
+                    return []
+                for line in checkpoint:
+                    position, length, digest = line.split()
+                    position, length = int(position), int(length)
+                    digest = bytes.fromhex(digest)
+                    reader.seek(position)
+                    if hashlib.sha256(reader.read(length)).digest() == digest:
+                        blocks[position] = (length, digest)
+        except (OSError, ValueError):
+            # no checkpoint, or its last line is incomplete
+            pass
+        # blocks may have been received out of order,
+        # only those up to the first gap can be resumed from
+        intact_blocks = []
+        position = 0
+        while position in blocks:
+            intact_blocks.append(blocks[position])
+            position += blocks[position][0]
+        return intact_blocks
+
+    def _open_files(self, position):
+        """Opens the partially received file and its checkpoint for writing
+        the data received from the given position onwards, discarding any
+        data after it."""
+        path = os.path.join(self.dir, self.filename + ".PART")
+        kept_blocks = []
+        kept_bytes = 0
+        for length, digest in self._offered_blocks:
+            if kept_bytes == position:
+                break
+            kept_blocks.append((kept_bytes, length, digest))
+            kept_bytes += length
+        if kept_bytes != position:
+            raise UnreadableReply("The sender tried to resume the "
+                                  "transmission in the middle of a block.")
+        self.writer = open(path, "r+b" if position else "wb", buffering=0)
+        os.ftruncate(self.writer.fileno(), position)
+        # allocate the space for the whole file up front, so that blocks
+        # can be written at any position and the disk can't fill up halfway
+        _preallocate(self.writer.fileno(), self.filesize)
+        self.writtenbytes = position
+        if FILE_CHECKPOINTS:
+            self.checkpoint = open(path + ".checkpoint", "w")
+            self.checkpoint.write(f"{self.filesize}\n")
+            for block_position, length, digest in kept_blocks:
+                self.checkpoint.write(
+                    f"{block_position} {length} {digest.hex()}\n")
+            self.checkpoint.flush()
 
     def finish(self):
         self.writer.close()
+        if self.checkpoint:
+            self.checkpoint.close()
+            os.remove(self.checkpoint.name)
         shutil.move(os.path.join(self.dir, self.filename + ".PART"),
                     os.path.join(self.dir, self.filename))
         if PRINT_LOG:
@@ -1300,7 +2403,7 @@ class FileTransmissionReceiver:
         if self.eventhandler:
             filepath = os.path.abspath(os.path.join(
                 self.dir, self.filename))
-            if signature(self.eventhandler).parameters["metadata"]:
+            if _count_parameters(self.eventhandler) >= 3:
                 self.eventhandler(self.conv.peer_id, filepath, self.metadata)
             else:
                 self.eventhandler(self.conv.peer_id, filepath)
@@ -1313,13 +2416,14 @@ def call_progress_callback(callback, peer_id, filename, filesize, progress):
     """Calls the specified callback function with part of all of the rest of
     the parameters, depending on how many parameters the callback takes.
     The callback can take between 1 and 4 parameters"""
-    if len(signature(callback).parameters) == 1:
+    n_params = _count_parameters(callback)
+    if n_params == 1:
         callback(progress)
-    elif len(signature(callback).parameters) == 2:
+    elif n_params == 2:
         callback(filename, progress)
-    elif len(signature(callback).parameters) == 3:
+    elif n_params == 3:
         callback(filename, filesize, progress)
-    elif len(signature(callback).parameters) == 4:
+    elif n_params == 4:
         callback(peer_id, filename, filesize, progress)
 
 
@@ -1328,17 +2432,26 @@ class BufferSender():
     def __init__(self, peer_id, proto):
         self.peer_id = peer_id
         self.proto = proto
-        self.sock = _create_sending_connection(peer_id, proto)
+        self.sock = None
+        self.sock = _connect_to_listener(peer_id, proto)
 
     def send_buffer(self, data):
         try:
             self.sock.send(data)
         except:
-            self.sock = _create_sending_connection(self.peer_id, self.proto)
+            self.sock.close()
+            self.sock = None
+            _close_sending_connection(self.peer_id,
+                                      _listener_protocol(self.proto))
+            self.sock = _connect_to_listener(self.peer_id, self.proto)
             self.sock.send(data)
 
     def terminate(self):
-        _close_sending_connection(self.peer_id, self.proto)
+        if not self.sock:
+            return
+        self.sock.close()
+        self.sock = None
+        _close_sending_connection(self.peer_id, _listener_protocol(self.proto))
 
     def __del__(self):
         self.terminate()
@@ -1355,16 +2468,22 @@ class BufferReceiver():
         self.proto = proto
         self._listener = _ListenerTCP(
             eventhandler,
-            0,
+            None if LISTENER_DEMUX else 0,
             buffer_size=buffer_size,
             monitoring_interval=monitoring_interval,
             status_eventhandler=status_eventhandler,
             eventhandlers_on_new_threads=eventhandlers_on_new_threads
         )
-        _create_listening_connection(proto, self._listener.port)
+        if LISTENER_DEMUX:
+            _demultiplexer.register(proto, self._listener.serve)
+        else:
+            _create_listening_connection(proto, self._listener.port)
 
     def terminate(self):
-        _close_listening_connection(self.proto, self._listener.port)
+        if self._listener.port is None:     # hosted by the demultiplexer
+            _demultiplexer.unregister(self.proto, self._listener.serve)
+        else:
+            _close_listening_connection(self.proto, self._listener.port)
         self._listener.terminate()
 
     def __del__(self):
@@ -1392,7 +2511,8 @@ class _ListenerTCP(threading.Thread):
     Listens on the specified port, forwarding all data buffers received to the provided eventhandler.
     Args:
         function(bytearray data, string sender_peer_idess) eventhandler: the eventhandler that should be called when a data buffer is received
-        int port (optional, auto-assigned by OS if not specified): the port on which to listen for incoming data buffers
+        int port (optional, auto-assigned by OS if not specified): the port on which to listen for incoming data buffers,
+            or None to not listen on a port but to serve the connections passed to `serve()`
         int buffer_size (optional, default value 1024): the maximum size of buffers in bytes which this port should be able to receive
     """
     port = 0
@@ -1415,12 +2535,14 @@ class _ListenerTCP(threading.Thread):
         self.eventhandler = eventhandler
         self.buffer_size = buffer_size
         self.eventhandlers_on_new_threads = eventhandlers_on_new_threads
-        self.sock = socket.socket(
-            socket.AF_INET, socket.SOCK_STREAM)
+        self.conn = None
+        if self.port is not None:
+            self.sock = socket.socket(
+                socket.AF_INET, socket.SOCK_STREAM)
 
-        self.sock.bind((_ipfs_host_ip(), self.port))
-        # in case it had been 0 (requesting automatic port assiggnent)
-        self.port = self.sock.getsockname()[1]
+            self.sock.bind((_ipfs_host_ip(), self.port))
+            # in case it had been 0 (requesting automatic port assiggnent)
+            self.port = self.sock.getsockname()[1]
 
         if status_eventhandler != None:
             self.status_eventhandler = status_eventhandler
@@ -1430,7 +2552,8 @@ class _ListenerTCP(threading.Thread):
                 target=self.status_monitor, args=(), name='ListenerTP.status_monitor')
             self.status_monitor_thread.start()
 
-        self.start()
+        if self.port is not None:
+            self.start()
 
         if PRINT_LOG_CONNECTIONS:
             print("Created listener.")
@@ -1438,9 +2561,18 @@ class _ListenerTCP(threading.Thread):
     def run(self):
         self.sock.listen(1)
         conn, ip_addr = self.sock.accept()
+        self.serve(conn)
+        self.sock.close()
 
+    def serve(self, conn):
+        """Receives data buffers on the given connection until it is closed
+        or this listener is terminated."""
+        self.conn = conn
         while True:
-            data = conn.recv(self.buffer_size)
+            try:
+                data = conn.recv(self.buffer_size)
+            except OSError:
+                break
             self.last_time_recv = datetime.now(UTC)
             if (self._terminate == True):
                 if PRINT_LOG_CONNECTIONS:
@@ -1449,16 +2581,13 @@ class _ListenerTCP(threading.Thread):
             if not data:
                 if PRINT_LOG_CONNECTIONS:
                     print("received null data")
-                # break
+                break
             if len(data) > 0:
                 if self.eventhandlers_on_new_threads:
-                    ev = Thread(target=self.eventhandler, args=(
-                        data, ), name="TCPListener-eventhandler")
-                    ev.start()
+                    _dispatch(self, self.eventhandler, data)
                 else:
                     self.eventhandler(data)
         conn.close()
-        self.sock.close()
         if PRINT_LOG_CONNECTIONS:
             print("Closed listener.")
 
@@ -1483,7 +2612,13 @@ class _ListenerTCP(threading.Thread):
         if PRINT_LOG_CONNECTIONS:
             print("terminating listener")
         self._terminate = True   # marking the terminate flag as true
-        self.sock.close()
+        if self.sock:
+            self.sock.close()
+        if self.conn:   # wake up serve()
+            try:
+                self.conn.shutdown(socket.SHUT_RD)
+            except OSError:
+                pass
 
     def __del__(self):
         self.terminate()
@@ -1582,210 +2717,2177 @@ class IPFS_Error(Exception):
         return self.message
 
 
-##
-##
-##
-##
-##
-# ----- Utilities ------------------------------------------------------------
-##
-##
-##
-##
+class DecryptionError(Exception):
+    """Is called when a received message fails to be authenticated by a
+    StreamCipher, because it was tampered with or corrupted.
+    """
 
+    def __init__(self, message: str = "Received an encrypted message that failed authentication."):
+        self.message = message
 
-def __add_integritybyte_to_buffer(buffer):
-    # Adding an integrity byte that equals the sum of all the bytes in the buffer modulus 256
-    # to be able to detect data corruption:
-    sum = 0
-    for byte in buffer:
-        sum += byte
-        if sum > 65000:  # if the sum is reaching the upper limit of an unsigned 16-bit integer
-            sum = sum % 256   # reduce the sum to its modulus256 so that the calculation above doesn't take too much processing power in later iterations of this for loop
-    # adding the integrity byte to the start of the buffer
-    return bytearray([sum % 256]) + buffer
+    def __str__(self):
+        return self.message
 
 
-# turns a base 10 integer into a base 255 integer in  the form of an array of bytes where each byte represents a digit, and where no byte has the value 0
-def _to_b255_no_0s(number):
-    array = bytearray([])
-    while (number > 0):
-        # modulus + 1 in order to get a range of possible values from 1-256 instead of 0-255
-        array.insert(0, int(number % 255 + 1))
-        number -= number % 255
-        number = number / 255
-    return array
+# ----- Stream Ciphers ---------------------------------------------------------
+class StreamCipher:
+    """Authenticated encryption for conversations and file transmissions,
+    which can be passed wherever `encryption_callbacks` are accepted,
+    instead of a tuple of encryption and decryption functions.
+    Unlike those, a StreamCipher processes messages chunk by chunk from
+    memoryviews, so that file blocks can be encrypted straight from the
+    file into a reusable buffer.
+
+    Every message is encrypted with its own nonce, made of a random prefix
+    chosen per StreamCipher object and a message counter, and is sent as
+    nonce + ciphertext + authentication tag.
+    Both peers must use the same kind of StreamCipher with the same key.
+    Requires the `cryptography` package.
+
+    Usage:
+    ```
+    key = ChaCha20Poly1305Cipher.generate_key()  # share with the peer
+    conv.start(..., encryption_callbacks=ChaCha20Poly1305Cipher(key))
+    ```
+    """
+    NONCE_SIZE = 12
+    TAG_SIZE = 16
+    KEY_SIZES = (32,)
+
+    def __init__(self, key: bytes):
+        if Cipher is None:
+            raise ImportError(
+                "StreamCipher requires the cryptography package: "
+                "pip install cryptography")
+        if len(key) not in self.KEY_SIZES:
+            raise ValueError(f"{type(self).__name__} requires a key of "
+                             f"{' or '.join(map(str, self.KEY_SIZES))} bytes.")
+        self.key = bytes(key)
+        self._nonce_prefix = os.urandom(self.NONCE_SIZE - 4)
+        self._nonce_counter = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def generate_key(cls):
+        """Returns a new random key for this kind of cipher."""
+        return os.urandom(cls.KEY_SIZES[-1])
+
+    def encryptor(self):
+        """Returns a context for encrypting a message chunk by chunk with a
+        new nonce, see `_CipherContext`."""
+        with self._lock:
+            if self._nonce_counter == 2**32:
+                raise DataTransmissionError(
+                    "Too many messages encrypted with this StreamCipher, "
+                    "create a new one.")
+            counter = self._nonce_counter
+            self._nonce_counter += 1
+        return self._context(self._nonce_prefix + counter.to_bytes(4, "big"),
+                             encrypting=True)
+
+    def decryptor(self, nonce):
+        """Returns a context for decrypting a message chunk by chunk,
+        see `_CipherContext`."""
+        return self._context(bytes(nonce), encrypting=False)
+
+    def _context(self, nonce, encrypting):
+        raise NotImplementedError()
+
+    def encrypt(self, data):
+        """Encrypts a whole message.
+        Returns:
+            bytearray: nonce + ciphertext + tag
+        """
+        buffer = bytearray()
+        with self.encrypt_into(buffer, data):
+            pass
+        return buffer
 
+    def encrypt_into(self, buffer, *chunks):
+        """Encrypts the concatenation of the given chunks as a single message
+        into the given buffer, which is resized to fit it, so that a buffer
+        can be reused for many messages.
+        Args:
+            buffer (bytearray): the buffer to encrypt into
+            *chunks (bytes-like): the parts of the message
+        Returns:
+            memoryview: the encrypted message, nonce + ciphertext + tag, which
+                must be released before the buffer is reused
+        """
+        size = sum(len(chunk) for chunk in chunks)
+        total_size = self.NONCE_SIZE + size + self.TAG_SIZE
+        if len(buffer) != total_size:
+            buffer[total_size:] = b""
+            buffer.extend(bytes(total_size - len(buffer)))
+        view = memoryview(buffer)
+        context = self.encryptor()
+        view[:self.NONCE_SIZE] = context.nonce
+        position = self.NONCE_SIZE
+        for chunk in chunks:
+            # the output may need up to TAG_SIZE - 1 bytes of room to spare,
+            # which the space for the tag provides
+            position += context.update_into(
+                chunk, view[position:position + len(chunk) + self.TAG_SIZE])
+        view[position:] = context.finalize()
+        return view
+
+    def decrypt(self, message):
+        """Decrypts a message encrypted with `encrypt()` or `encrypt_into()`.
+        Returns:
+            bytearray: the plaintext
+        Raises:
+            DecryptionError: if the message was tampered with or is corrupted
+        """
+        view = memoryview(message)
+        if len(view) < self.NONCE_SIZE + self.TAG_SIZE:
+            raise DecryptionError("The encrypted message is too short.")
+        size = len(view) - self.NONCE_SIZE - self.TAG_SIZE
+        context = self.decryptor(view[:self.NONCE_SIZE])
+        plaintext = bytearray(size + self.TAG_SIZE)  # room to spare
+        written = context.update_into(
+            view[self.NONCE_SIZE:self.NONCE_SIZE + size], plaintext)
+        context.finalize(view[self.NONCE_SIZE + size:])
+        del plaintext[written:]
+        return plaintext
+
+
+class _CipherContext:
+    """The encryption or decryption of a single message by a StreamCipher:
+    call `update()` or `update_into()` for every chunk of the message,
+    then `finalize()`, which returns the authentication tag when encrypting
+    and verifies the given one when decrypting."""
+    nonce = None
+
+    def update(self, data):
+        """Processes the next chunk of the message.
+        Returns:
+            bytes: the processed chunk
+        """
+        raise NotImplementedError()
 
-def _from_b255_no_0s(array):
-    number = 0
-    order = 1
-    # for loop backwards through th ebytes in array
-    i = len(array) - 1  # th eindex of the last byte in the array
-    while (i >= 0):
-        # byte - 1 to change the range from 1-266 to 0-255
-        number = number + (array[i] - 1) * order
-        order = order * 255
-        i = i - 1
-    return number
+    def update_into(self, data, buffer):
+        """Processes the next chunk of the message into the given buffer,
+        which needs room for up to TAG_SIZE - 1 more bytes than the chunk.
+        Returns:
+            int: the number of bytes written to the buffer
+        """
+        raise NotImplementedError()
 
+    def finalize(self, tag=None):
+        """Completes the message.
+        Args:
+            tag (bytes): the received authentication tag (decryption only)
+        Returns:
+            bytes: the authentication tag (encryption only)
+        Raises:
+            DecryptionError: if the tag doesn't match the decrypted message
+        """
+        raise NotImplementedError()
+
+
+class ChaCha20Poly1305Cipher(StreamCipher):
+    """StreamCipher using ChaCha20-Poly1305 (RFC 8439), the faster option on
+    CPUs without AES instructions."""
+
+    def _context(self, nonce, encrypting):
+        return _ChaCha20Poly1305Context(self.key, nonce, encrypting)
+
+
+class _ChaCha20Poly1305Context(_CipherContext):
+    """ChaCha20-Poly1305 as specified by RFC 8439, built from its primitives
+    because the `cryptography` package only offers it for whole messages."""
+
+    def __init__(self, key, nonce, encrypting):
+        self.nonce = nonce
+        self.encrypting = encrypting
+        self.length = 0
+        # the first ChaCha20 block (counter 0) derives the Poly1305 key,
+        # the message is encrypted starting from counter 1
+        poly_key = Cipher(algorithms.ChaCha20(
+            key, (0).to_bytes(4, "little") + nonce), mode=None
+        ).encryptor().update(bytes(32))
+        self._mac = Poly1305(poly_key)
+        self._cipher = Cipher(algorithms.ChaCha20(
+            key, (1).to_bytes(4, "little") + nonce), mode=None).encryptor()
+
+    def update(self, data):
+        if not self.encrypting:
+            self._mac.update(data)
+        result = self._cipher.update(data)
+        if self.encrypting:
+            self._mac.update(result)
+        self.length += len(data)
+        return result
+
+    def update_into(self, data, buffer):
+        if not self.encrypting:
+            self._mac.update(data)
+        written = self._cipher.update_into(data, buffer)
+        if self.encrypting:
+            self._mac.update(memoryview(buffer)[:written])
+        self.length += len(data)
+        return written
+
+    def finalize(self, tag=None):
+        # pad the ciphertext to 16 bytes, followed by the lengths of the
+        # (empty) additional data and of the ciphertext
+        self._mac.update(bytes(-self.length % 16)
+                         + struct.pack("<QQ", 0, self.length))
+        if self.encrypting:
+            return self._mac.finalize()
+        try:
+            self._mac.verify(bytes(tag))
+        except InvalidSignature:
+            raise DecryptionError() from None
 
-def _split_by_255(bytes):
-    result = list()
-    pos = 0
-    collected = list()
-    while pos < len(bytes):
-        if bytes[pos] == 255:
-            result.append(bytearray(collected))
-            collected = list()
-        else:
-            collected.append(bytes[pos])
-        pos += 1
-    result.append(bytearray(collected))
-    return result
 
+class AESGCMCipher(StreamCipher):
+    """StreamCipher using AES-GCM, the faster option on CPUs with AES
+    instructions, which accepts 128, 192 and 256 bit keys."""
+    KEY_SIZES = (16, 24, 32)
 
-def _tcp_send_all(sock, data):
-    length = len(data)
-    sock.send(_to_b255_no_0s(length) + bytearray([0]))
-    sock.send(data)
+    def _context(self, nonce, encrypting):
+        return _AESGCMContext(self.key, nonce, encrypting)
 
 
-def _tcp_recv_all(sock, timeout=5):
-    # make socket non blocking
-    sock.setblocking(0)
+class _AESGCMContext(_CipherContext):
+    def __init__(self, key, nonce, encrypting):
+        self.nonce = nonce
+        self.encrypting = encrypting
+        cipher = Cipher(algorithms.AES(key), modes.GCM(nonce))
+        self._cipher = cipher.encryptor() if encrypting else cipher.decryptor()
 
-    # total data partwise in an array
-    total_data = bytearray()
-    data = bytearray()
-    length = 0
-    # beginning time
-    begin = time.time()
-    while 1:
-        # if you got some data, then break after timeout
-        if len(total_data) > 0 and time.time() - begin > timeout:
-            break
-
-        # if you got no data at all, wait a little longer, twice the timeout
-        elif time.time() - begin > timeout * 2:
-            break
-
-        # recv something
-        try:
-            data = sock.recv(BUFFER_SIZE)
-            if data:
-                if not length:
-                    if data.index(0):
-                        total_data += data[:data.index(0)]
-                        length = _from_b255_no_0s(total_data)
-                        total_data = data[data.index(0) + 1:]
-                    else:
-                        total_data += data
-                else:
-                    total_data += data
-
-                if length:
-                    if len(total_data) == length:
-                        return total_data
-                    if len(total_data) > length:
-                        raise Exception("Received more data than expected!")
-                    # change the beginning time for measurement
-                    begin = time.time()
-        except:
-            pass
-    print("Timeout reached")
-    # print("RECEIVED", type(total_data), total_data)
-    return total_data
+    def update(self, data):
+        return self._cipher.update(data)
 
+    def update_into(self, data, buffer):
+        return self._cipher.update_into(data, buffer)
 
-def _tcp_recv_buffer_timeout(sock, buffer_size=BUFFER_SIZE, timeout=5):
-    # make socket non blocking
-    # sock.setblocking(0)
-    sock.settimeout(timeout)
-    # beginning time
-    begin = time.time()
-    while 1:
-        # timeout is reached
-        if time.time() - begin > timeout:
-            raise TimeoutError()
-
-        # recv something
+    def finalize(self, tag=None):
+        if self.encrypting:
+            self._cipher.finalize()
+            return self._cipher.tag
         try:
-            data = sock.recv(buffer_size)
-            if data:
-                return data
-        except:
-            pass
+            self._cipher.finalize_with_tag(bytes(tag))
+        except InvalidTag:
+            raise DecryptionError() from None
+
+
+def _encryption_functions(encryption_callbacks):
+    """Returns the encryption and decryption functions for the given
+    `encryption_callbacks` parameter, which is a tuple of them or a
+    StreamCipher."""
+    if isinstance(encryption_callbacks, StreamCipher):
+        return encryption_callbacks.encrypt, encryption_callbacks.decrypt
+    return encryption_callbacks
+
+
+# ----- Metrics ----------------------------------------------------------------
+class MetricsSink:
+    """Receives the metrics this module reports while METRICS_SINK is set to
+    it. Subclass it and override `record()` to export them elsewhere, or use
+    CallbackMetricsSink, PrometheusMetricsSink or JSONLinesMetricsSink.
+    Metrics are of three kinds:
+    - "counter": an amount added to a running total, e.g. bytes sent
+    - "summary": a single observation, e.g. how long an HTTP call to the IPFS
+        daemon took in seconds
+    - "gauge": the current level of something, e.g. the number of threads,
+        reported by `report_metrics_gauges()`
+    The metrics reported are:
+    - daemon_request_seconds{command} (summary): HTTP calls to the IPFS daemon
+    - daemon_request_errors_total{command} (counter)
+    - transmission_phase_seconds{phase} (summary): the phases of
+        transmissions: "connect" (port-forwarding and connecting to it),
+        "handshake" (transmission request or opening a persistent stream),
+        "send" (sending the data) and "ack" (until the receiver's
+        acknowledgement arrives, on persistent streams counted from the
+        start of sending, as many messages may be in flight)
+    - transmissions_total{mode}, bytes_sent_total{mode},
+        transmissions_received_total{mode}, bytes_received_total{mode}
+        (counters): by mode "single" (a connection per transmission) or
+        "stream" (persistent streams)
+    - retries_total{operation} (counter)
+    - file_transmission_bytes_per_second (summary): the throughput of every
+        file transmission, file_bytes_sent_total (counter)
+    - receiver_pool_accept_seconds (summary): getting a socket to receive a
+        transmission on, see RECEIVER_POOL_SIZE
+    - flow_control_blocked_seconds (summary): how long receiving threads
+        waited for a conversation's consumer to catch up,
+        conversation_items_dropped_total (counter)
+    - threads, eventhandler_queue_depth, receiver_pool_idle, port_forwards,
+        persistent_streams, conversation_queue_depth{queue} (gauges)
+    """
 
+    def record(self, kind: str, name: str, value, labels: dict):
+        """Is called for every metric reported, on the thread reporting it,
+        so it should return quickly.
+        Args:
+            kind (str): "counter", "summary" or "gauge"
+            name (str): the metric's name, e.g. "bytes_sent_total"
+            value (float): the metric's value
+            labels (dict): the labels distinguishing the metric's series,
+                e.g. {"phase": "connect"}
+        """
+        raise NotImplementedError()
 
-# ----------IPFS Utilities-------------------------------------------
-connections_send = list()
-connections_listen = list()
 
+class CallbackMetricsSink(MetricsSink):
+    """Passes every metric to a function taking the same parameters as
+    `MetricsSink.record()`."""
 
-def _create_sending_connection(peer_id: str, protocol: str, port=None):
-    # _close_sending_connection(
-    #     peer_id=peer_id, name=protocol)
-    if port:
-        _close_sending_connection(port=port)
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    if port == None:
-        for prt in sending_ports:   # trying ports until we find a free one
-            try:
-                ipfs_api.create_tcp_sending_connection(protocol, prt, peer_id)
-                sock.connect((_ipfs_host_ip(), prt))
-                return sock
-            except Exception as e:   # ignore errors caused by port already in use
-                if not "bind: address already in use" in str(e):
-                    raise IPFS_Error(str(e))
-        raise IPFS_Error("Failed to find free port for sending connection")
-    else:
-        try:
-            ipfs_api.create_tcp_sending_connection(protocol, port, peer_id)
-            sock.connect((_ipfs_host_ip(), prt))
-            return sock
-        except Exception as e:
-            raise IPFS_Error(str(e))
+    def __init__(self, callback):
+        self.callback = callback
 
+    def record(self, kind, name, value, labels):
+        self.callback(kind, name, value, labels)
 
-def _create_listening_connection(protocol, port, force=True):
-    """
-    Args:
-        bool force: whether or not already existing conflicting connections should be closed.
-    """
-    try:
-        ipfs_api.create_tcp_listening_connection(protocol, port)
-        if PRINT_LOG_CONNECTIONS:
-            print(f"listening fas \"{protocol}\" on {port}")
-    except:
-        if force:
-            _close_listening_connection(name=protocol)
-        try:
-            time.sleep(0.1)
-            ipfs_api.create_tcp_listening_connection(protocol, port)
-            if PRINT_LOG_CONNECTIONS:
-                print(f"listening as \"{protocol}\" on {port}")
-        except:
-            raise IPFS_Error(
-                "Error registering listening connection to IPFS: "
-                f"/x/{protocol}/ip4/{_ipfs_host_ip()}/udp/{port}"
-            )
 
-    connections_listen.append((protocol, port))
+class PrometheusMetricsSink(MetricsSink):
+    """Aggregates the metrics reported to it, to be exposed to Prometheus in
+    its text exposition format with `text()`, e.g. by an HTTP handler.
+    Summaries are aggregated into their sum and count."""
+
+    def __init__(self, prefix: str = "ipfs_datatransmission_"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._metrics = dict()  # name: (kind, {labels: value})
+
+    def record(self, kind, name, value, labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._metrics.setdefault(name, (kind, dict()))[1]
+            if kind == "counter":
+                series[key] = series.get(key, 0) + value
+            elif kind == "summary":
+                total = series.setdefault(key, [0, 0])
+                total[0] += value
+                total[1] += 1
+            else:
+                series[key] = value
+
+    def text(self, report_gauges: bool = True):
+        """Returns the aggregated metrics in Prometheus' text format.
+        Args:
+            report_gauges (bool): whether to update the gauges first
+        Returns:
+            str: the metrics
+        """
+        if report_gauges:
+            _report_gauges(self)
+        lines = []
+        with self._lock:
+            for name, (kind, series) in sorted(self._metrics.items()):
+                name = self.prefix + name
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in sorted(series.items()):
+                    labels = _prometheus_labels(key)
+                    if kind == "summary":
+                        lines.append(f"{name}_sum{labels} {value[0]}")
+                        lines.append(f"{name}_count{labels} {value[1]}")
+                    else:
+                        lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(
+        f'{key}="' + str(value).replace("\\", "\\\\").replace(
+            "\"", "\\\"").replace("\n", "\\n") + '"'
+        for key, value in labels
+    ) + "}"
+
+
+class JSONLinesMetricsSink(MetricsSink):
+    """Writes every metric to a file as a line of JSON, like
+    {"time": 1700000000.0, "type": "counter", "name": "bytes_sent_total",
+    "value": 4096, "labels": {"mode": "stream"}}
+    """
+
+    def __init__(self, file):
+        """
+        Args:
+            file: the path of the file to append to, or a writable text file
+        """
+        self._owns_file = isinstance(file, (str, os.PathLike))
+        if self._owns_file:
+            file = open(file, "a", buffering=1)  # line buffered
+        self.file = file
+        self._lock = threading.Lock()
+
+    def record(self, kind, name, value, labels):
+        line = json.dumps({
+            "time": time.time(), "type": kind, "name": name,
+            "value": value, "labels": labels,
+        })
+        with self._lock:
+            self.file.write(line + "\n")
+
+    def close(self):
+        """Closes the file, if it was opened by this sink."""
+        with self._lock:
+            if self._owns_file:
+                self.file.close()
+            else:
+                self.file.flush()
+
+
+# the Conversations whose queue depths are reported as gauges
+_conversations = weakref.WeakSet()
+
+
+def _record(kind, name, value, labels, sink=None):
+    sink = sink or METRICS_SINK
+    if sink is None:
+        return
+    try:
+        sink.record(kind, name, value, labels)
+    except Exception:
+        print("ipfs_datatransmission: Exception in metrics sink:")
+        traceback.print_exc()
+
+
+def _count(name, value=1, **labels):
+    if METRICS_SINK is not None:
+        _record("counter", name, value, labels)
+
+
+def _observe(name, value, **labels):
+    if METRICS_SINK is not None:
+        _record("summary", name, value, labels)
+
+
+def _timer():
+    """Returns the current time for `_observe_since()`, or None if no metrics
+    are collected, so that timing costs nothing then."""
+    return time.perf_counter() if METRICS_SINK is not None else None
+
+
+def _observe_since(name, start, **labels):
+    """Reports the seconds passed since `start`, a time from `_timer()`."""
+    if start is not None and METRICS_SINK is not None:
+        _record("summary", name, time.perf_counter() - start, labels)
+
+
+def _daemon_call(command, function, *args, **kwargs):
+    """Makes an HTTP call to the IPFS daemon, timing it.
+    Args:
+        command (str): the daemon's API command, e.g. "p2p/forward"
+        function (function): the `ipfs_api` function to call
+    """
+    start = _timer()
+    try:
+        return function(*args, **kwargs)
+    except Exception:
+        _count("daemon_request_errors_total", command=command)
+        raise
+    finally:
+        _observe_since("daemon_request_seconds", start, command=command)
+
+
+def _report_gauges(sink):
+    with _eventhandler_queues_lock:
+        eventhandler_queue_depth = sum(
+            len(queue) for queue in _eventhandler_queues.values())
+    with _port_forwards._lock:
+        port_forwards = len(_port_forwards._ports)
+    with _transmission_streams_lock:
+        streams = len(_transmission_streams)
+    messages = files = 0
+    for conversation in list(_conversations):
+        messages += conversation._message_flow.depth()
+        files += conversation._file_flow.depth()
+    for name, value, labels in [
+        ("threads", threading.active_count(), {}),
+        ("eventhandler_queue_depth", eventhandler_queue_depth, {}),
+        ("receiver_pool_idle", _receiver_pool.stats()["idle"], {}),
+        ("port_forwards", port_forwards, {}),
+        ("persistent_streams", streams, {}),
+        ("conversation_queue_depth", messages, {"queue": "messages"}),
+        ("conversation_queue_depth", files, {"queue": "files"}),
+    ]:
+        _record("gauge", name, value, labels, sink)
+
+
+# ----- Persistent Streams -----------------------------------------------------
+# Marks a transmission request as a request to open a persistent stream.
+# (Peers that don't support them fail to decode it as a peer ID and reject it.)
+_STREAM_REQUEST = bytes([255]) + b"stream" + bytes([255])
+# header of every message multiplexed on a persistent stream, and the content
+# of the acknowledgement the receiver returns for it
+_STREAM_MSG_ID = struct.Struct(">I")
+# Version 2 of the persistent stream protocol, negotiated when opening the
+# stream, adds a checksum to the header of every message and the result of
+# its verification to every acknowledgement.
+_STREAM_VERSION_2 = b"v2"
+# header: message ID, checksum algorithm ID (0 for none), checksum
+_STREAM_MSG_HEADER_V2 = struct.Struct(">IBI")
+# acknowledgement: message ID, whether the message was intact
+_STREAM_ACK_V2 = struct.Struct(">I?")
+_STREAM_ACCEPTED = b"Stream accepted."
+
+_transmission_streams = dict()  # (peer_id, req_lis_name): _TransmissionStream
+_transmission_stream_locks = dict()  # (peer_id, req_lis_name): Lock
+_transmission_streams_lock = threading.Lock()
+# listeners we know don't support persistent streams
+_transmission_streams_unsupported = set()
+
+
+def _close_transmission_stream(peer_id, req_lis_name):
+    with _transmission_streams_lock:
+        stream = _transmission_streams.get((peer_id, req_lis_name))
+    if stream:
+        stream.close()
+
+
+class _StreamClosed(Exception):
+    """Is raised when a persistent stream breaks down during a transmission."""
+
+
+def _get_transmission_stream(peer_id, req_lis_name, timeout_sec, max_retries):
+    """Returns the persistent stream to the specified peer's listener,
+    opening it if it doesn't exist yet.
+    Returns None if the peer doesn't support persistent streams."""
+    key = (peer_id, req_lis_name)
+    with _transmission_streams_lock:
+        stream = _transmission_streams.get(key)
+        if stream and not stream.closed:
+            return stream
+        if key in _transmission_streams_unsupported:
+            return None
+        lock = _transmission_stream_locks.setdefault(key, threading.Lock())
+    with lock:  # only one thread should open the stream
+        with _transmission_streams_lock:
+            stream = _transmission_streams.get(key)
+            if stream and not stream.closed:
+                return stream
+        stream = _open_transmission_stream(
+            peer_id, req_lis_name, timeout_sec, max_retries)
+        with _transmission_streams_lock:
+            if stream:
+                _transmission_streams[key] = stream
+            else:
+                _transmission_streams_unsupported.add(key)
+        return stream
+
+
+def _open_transmission_stream(peer_id, req_lis_name, timeout_sec, max_retries):
+    """Opens a persistent stream to the specified peer's listener.
+    Returns None if the peer doesn't support persistent streams."""
+    request_data = __add_integritybyte_to_buffer(
+        _STREAM_REQUEST + ipfs_api.my_id().encode() + _stream_request_suffix())
+    tries = 0
+    while max_retries == -1 or tries < max_retries:
+        tries += 1
+        if PRINT_LOG_TRANSMISSIONS:
+            print("Opening persistent stream to " + str(req_lis_name))
+        sock = _connect_to_listener(peer_id, req_lis_name)
+        # closing the port-forwarding only stops it from accepting
+        # new connections, the established stream stays open
+        _close_sending_connection(port=sock.getpeername()[1])
+        sock.settimeout(timeout_sec)
+        start = _timer()
+        try:
+            _tcp_send_all(sock, request_data)
+            reply = _tcp_recv_buffer_timeout(sock, BUFFER_SIZE,
+                                             timeout=timeout_sec)
+        except (OSError, TimeoutError):
+            sock.close()
+            _count("retries_total", operation="stream_open")
+            continue
+        _observe_since("transmission_phase_seconds", start, phase="handshake")
+        if reply.startswith(_STREAM_ACCEPTED):
+            sock.settimeout(None)
+            # don't let Nagle's algorithm delay our small messages and acks
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return _TransmissionStream(peer_id, req_lis_name, sock,
+                                       _parse_stream_accepted_reply(reply))
+        sock.close()
+        if reply.startswith(b"Transmission request"):
+            if PRINT_LOG_TRANSMISSIONS:
+                print(str(req_lis_name)
+                      + " doesn't support persistent streams")
+            return None
+    raise CommunicationTimeout(
+        "Received no response from peer while opening persistent stream.")
+
+
+class _TransmissionStream:
+    """A persistent libp2p stream to a peer's TransmissionListener, over which
+    many transmissions are multiplexed.
+    Each transmission is sent as a message prefixed with an ID, which the
+    receiver returns as acknowledgement, so that multiple threads can transmit
+    concurrently, and a single thread can keep several messages in flight
+    using `send()` and `wait()`.
+    If a checksum was negotiated, messages which the receiver reports as
+    corrupted are retransmitted once by `transmit()`.
+    """
+
+    def __init__(self, peer_id, req_lis_name, sock, checksum=None):
+        self.peer_id = peer_id
+        self.req_lis_name = req_lis_name
+        self.sock = sock
+        self.checksum = checksum
+        self.closed = False
+        self._send_lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self._pending = dict()  # msg_id: _StreamMessage, not yet acknowledged
+        self._next_msg_id = 0
+        self._reader = Thread(
+            target=self._read_acknowledgements, args=(),
+            name=f"DataTransmissionStream-{req_lis_name}", daemon=True)
+        self._reader.start()
+
+    def transmit(self, data, timeout_sec=TRANSM_SEND_TIMEOUT_SEC):
+        """Transmits the given data over this stream, blocking until the
+        receiver acknowledges it.
+        Returns:
+            bool: True (signal success)
+        """
+        if self.wait(self.send(data), timeout_sec):
+            return True
+        _count("retries_total", operation="stream_message")
+        if self.wait(self.send(data), timeout_sec):  # retry once
+            return True
+        raise DataTransmissionError(
+            "The transmitted data arrived corrupted at the peer.")
+
+    def send(self, data, file_range=None, prefix=b""):
+        """Sends the given data as a single message, without waiting for the
+        receiver to acknowledge it.
+        Args:
+            data (bytes): the data to send
+            file_range (tuple): (file, position) of a file which contains the
+                data at the given position, to send it straight from the file
+                with `socket.sendfile()` instead of from memory
+            prefix (bytes): data to send before `data`, in the same message,
+                which saves the caller from concatenating them
+        Returns:
+            _StreamMessage: the message, to pass to `wait()`
+        """
+        message = _StreamMessage(len(data))
+        with self._pending_lock:
+            if self.closed:
+                raise _StreamClosed()
+            msg_id = self._next_msg_id
+            self._next_msg_id = (self._next_msg_id + 1) % 2**32
+            message.msg_id = msg_id
+            self._pending[msg_id] = message
+        try:
+            with self._send_lock:
+                message.sent_at = time.monotonic()
+                prefix = _pack_stream_message_header(
+                    msg_id, data, self.checksum, prefix) + prefix
+                if file_range:
+                    _tcp_send_file(self.sock, *file_range, len(data),
+                                   prefix=prefix)
+                else:
+                    _tcp_send_all(self.sock, data, prefix=prefix)
+        except OSError:
+            self.close()
+            raise _StreamClosed()
+        if METRICS_SINK is not None:
+            _observe("transmission_phase_seconds",
+                     time.monotonic() - message.sent_at, phase="send")
+            _count("transmissions_total", mode="stream")
+            _count("bytes_sent_total", len(data), mode="stream")
+        return message
+
+    def wait(self, message, timeout_sec=TRANSM_SEND_TIMEOUT_SEC):
+        """Waits until the receiver acknowledges the given message.
+        Args:
+            message (_StreamMessage): a message returned by `send()`
+            timeout_sec (float): how long to wait before raising
+                CommunicationTimeout
+        Returns:
+            bool: whether the receiver reported the message as intact
+        """
+        if message.acknowledged.wait(timeout_sec) and message.acked_at:
+            _observe("transmission_phase_seconds",
+                     message.acked_at - message.sent_at, phase="ack")
+            return message.intact
+        with self._pending_lock:
+            self._pending.pop(message.msg_id, None)
+        if self.closed:
+            raise _StreamClosed()
+        raise CommunicationTimeout(
+            "Received no acknowledgement from peer for transmission on persistent stream.")
+
+    def _read_acknowledgements(self):
+        while True:
+            try:
+                frame, complete = _tcp_recv_frame(
+                    self.sock, max_size=CONTROL_FRAME_MAX_SIZE)
+            except (UnreadableReply, OSError):
+                break
+            if not complete:   # stream has been closed
+                break
+            msg_id, intact = _unpack_stream_ack(frame, self.checksum)
+            with self._pending_lock:
+                message = self._pending.pop(msg_id, None)
+            if message:
+                message.intact = intact
+                message.acked_at = time.monotonic()
+                message.acknowledged.set()
+        self.close()
+
+    def close(self):
+        """Closes this stream, failing any unacknowledged transmissions."""
+        with self._pending_lock:
+            if self.closed:
+                return
+            self.closed = True
+            pending = list(self._pending.values())
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        for message in pending:
+            message.acknowledged.set()
+        with _transmission_streams_lock:
+            key = (self.peer_id, self.req_lis_name)
+            if _transmission_streams.get(key) is self:
+                _transmission_streams.pop(key)
+
+
+class _StreamMessage:
+    """A message sent on a _TransmissionStream, awaiting acknowledgement."""
+
+    def __init__(self, size):
+        self.size = size
+        self.msg_id = None
+        self.acknowledged = Event()
+        self.intact = True
+        self.sent_at = None
+        self.acked_at = None  # set when the acknowledgement is received
+
+    @property
+    def rtt(self):
+        """The time between sending and acknowledgement, in seconds."""
+        return self.acked_at - self.sent_at
+
+
+##
+##
+##
+##
+##
+def _stream_request_suffix():
+    """Returns what we append to a request to open a persistent stream to
+    negotiate the stream protocol version and checksum."""
+    if not STREAM_CHECKSUMS:
+        return b""
+    return (bytes([255]) + _STREAM_VERSION_2
+            + bytes([255]) + ",".join(STREAM_CHECKSUMS).encode())
+
+
+def _parse_stream_request(data):
+    """Parses a request to open a persistent stream (without integrity byte).
+    Returns:
+        tuple(str, list): the sender's peer ID and the checksums it supports
+    """
+    fields = bytes(data[len(_STREAM_REQUEST):]).split(bytes([255]))
+    peer_id = fields[0].decode()
+    if len(fields) >= 3 and fields[1] == _STREAM_VERSION_2:
+        return peer_id, fields[2].decode().split(",")
+    return peer_id, []
+
+
+def _choose_stream_checksum(checksums):
+    """Returns the first of the given checksums that we support, or None."""
+    for checksum in checksums:
+        if checksum in STREAM_CHECKSUMS and checksum in _CHECKSUMS:
+            return checksum
+    return None
+
+
+def _stream_accepted_reply(checksum):
+    if not checksum:
+        return _STREAM_ACCEPTED
+    return (_STREAM_ACCEPTED + bytes([255]) + _STREAM_VERSION_2
+            + bytes([255]) + checksum.encode())
+
+
+def _parse_stream_accepted_reply(reply):
+    """Returns the checksum the receiver chose for a persistent stream."""
+    fields = bytes(reply[len(_STREAM_ACCEPTED):]).split(bytes([255]))
+    if len(fields) >= 3 and fields[1] == _STREAM_VERSION_2:
+        checksum = fields[2].decode()
+        if checksum in _CHECKSUMS:
+            return checksum
+    return None
+
+
+def _pack_stream_message_header(msg_id, data, checksum, prefix=b""):
+    """Returns the header for a persistent stream message with the given data,
+    to be sent as prefix of the data with `_tcp_send_all`.
+    Args:
+        prefix (bytes): data which will be sent between the header and `data`
+    """
+    if not checksum:
+        return _STREAM_MSG_ID.pack(msg_id)
+    algorithm_id, function = _CHECKSUMS[checksum]
+    value = function(data, function(prefix)) if prefix else function(data)
+    return _STREAM_MSG_HEADER_V2.pack(msg_id, algorithm_id, value)
+
+
+def _unpack_stream_message(frame, checksum):
+    """Parses and verifies a message received on a persistent stream,
+    stripping its header off the frame in place.
+    Args:
+        frame (bytearray): the received frame
+        checksum (str): the checksum negotiated for the stream, if any
+    Returns:
+        tuple(int, bytearray, bool): the message ID, the data, and whether
+            the data matches its checksum
+    """
+    if not checksum:
+        msg_id = _STREAM_MSG_ID.unpack_from(frame)[0]
+        del frame[:_STREAM_MSG_ID.size]  # doesn't copy the data
+        return msg_id, frame, True
+    msg_id, algorithm_id, value = _STREAM_MSG_HEADER_V2.unpack_from(frame)
+    del frame[:_STREAM_MSG_HEADER_V2.size]
+    data = frame
+    if algorithm_id == 0:
+        return msg_id, data, True
+    function = _CHECKSUMS_BY_ID.get(algorithm_id)
+    return msg_id, data, function is not None and function(data) == value
+
+
+def _pack_stream_ack(msg_id, checksum, intact):
+    if not checksum:
+        return _STREAM_MSG_ID.pack(msg_id)
+    return _STREAM_ACK_V2.pack(msg_id, intact)
+
+
+def _unpack_stream_ack(frame, checksum):
+    """Returns:
+        tuple(int, bool): the message ID, and whether it arrived intact
+    """
+    if not checksum:
+        return _STREAM_MSG_ID.unpack_from(frame)[0], True
+    return _STREAM_ACK_V2.unpack_from(frame)
+
+
+# ----- Checksums --------------------------------------------------------------
+def _sum_bytes(buffer):
+    """Returns the sum of all the bytes in the buffer, iterating in C."""
+    return sum(buffer)
+
+
+def _checksum_sum(data, value=0):
+    return (value + _sum_bytes(data)) & 0xFFFFFFFF
+
+
+# name: (algorithm ID used in message headers, function returning a 32-bit int)
+_CHECKSUMS = {
+    "sum": (1, _checksum_sum),
+    "adler32": (2, zlib.adler32),
+    "crc32": (3, zlib.crc32),
+}
+_CHECKSUMS_BY_ID = {
+    algorithm_id: function for algorithm_id, function in _CHECKSUMS.values()
+}
+
+
+# ----- Eventhandler Dispatch ---------------------------------------------------
+_eventhandler_pool = None
+_eventhandler_queues = dict()  # key: deque of pending (function, args)
+_eventhandler_queues_lock = threading.Lock()
+
+
+def _dispatch(key, function, *args):
+    """Calls the given eventhandler or callback in the way configured by
+    EVENTHANDLER_DISPATCH.
+    Args:
+        key: the object (listener, conversation etc.) the call belongs to;
+            calls with the same key are made one at a time and in order
+        function (function): the eventhandler or callback to call
+        *args: the parameters to call it with
+    """
+    if EVENTHANDLER_DISPATCH == "inline":
+        _call_eventhandler(function, args)
+    elif EVENTHANDLER_DISPATCH == "thread":
+        Thread(target=function, args=args,
+               name="DataTransmission-eventhandler").start()
+    else:
+        with _eventhandler_queues_lock:
+            queue = _eventhandler_queues.get(key)
+            if queue is not None:   # a worker is already processing this key
+                queue.append((function, args))
+                return
+            _eventhandler_queues[key] = deque([(function, args)])
+        _get_eventhandler_pool().submit(_process_eventhandler_queue, key)
+
+
+def _process_eventhandler_queue(key):
+    """Makes the pending eventhandler calls for the given key, in order."""
+    while True:
+        with _eventhandler_queues_lock:
+            queue = _eventhandler_queues[key]
+            if not queue:
+                del _eventhandler_queues[key]
+                return
+            function, args = queue.popleft()
+        _call_eventhandler(function, args)
+
+
+def _get_eventhandler_pool():
+    global _eventhandler_pool
+    with _eventhandler_queues_lock:
+        if not _eventhandler_pool:
+            _eventhandler_pool = ThreadPoolExecutor(
+                max_workers=EVENTHANDLER_POOL_SIZE,
+                thread_name_prefix="DataTransmission-eventhandler")
+    return _eventhandler_pool
+
+
+def _call_eventhandler(function, args):
+    try:
+        function(*args)
+    except Exception:
+        print("ipfs_datatransmission: Exception in eventhandler:")
+        traceback.print_exc()
+
+
+def _count_parameters(function):
+    """Returns the number of parameters the given function takes.
+    For plain functions and methods it is read from their code object, as
+    `inspect.signature` is slow, without keeping references to them."""
+    func = getattr(function, "__func__", function)  # unbound, for methods
+    if (not isinstance(func, FunctionType) or hasattr(func, "__wrapped__")
+            or hasattr(func, "__signature__")):
+        return len(signature(function).parameters)
+    code = func.__code__
+    n_params = code.co_argcount + code.co_kwonlyargcount
+    n_params += bool(code.co_flags & CO_VARARGS)
+    n_params += bool(code.co_flags & CO_VARKEYWORDS)
+    if func is not function and code.co_argcount:
+        n_params -= 1   # the bound method's self
+    return n_params
+
+
+# ----- Utilities ------------------------------------------------------------
+##
+##
+##
+##
+
+
+def __add_integritybyte_to_buffer(buffer):
+    # Adding an integrity byte that equals the sum of all the bytes in the buffer modulus 256
+    # to be able to detect data corruption:
+    return bytearray([_sum_bytes(buffer) % 256]) + buffer
+
+
+def _verify_integritybyte(buffer):
+    """Checks the integrity byte added by `__add_integritybyte_to_buffer`,
+    returning the buffer without it if it matches, otherwise None."""
+    if not buffer or (_sum_bytes(buffer) - buffer[0]) % 256 != buffer[0]:
+        return None
+    return buffer[1:]
+
+
+# turns a base 10 integer into a base 255 integer in  the form of an array of bytes where each byte represents a digit, and where no byte has the value 0
+def _to_b255_no_0s(number):
+    array = bytearray()
+    while number > 0:
+        number, digit = divmod(number, 255)
+        # digit + 1 in order to get a range of possible values from 1-255 instead of 0-254
+        array.append(digit + 1)
+    array.reverse()  # most significant digit first
+    return array
+
+
+def _from_b255_no_0s(array):
+    number = 0
+    for digit in array:
+        # digit - 1 to change the range from 1-255 to 0-254
+        number = number * 255 + digit - 1
+    return number
+
+
+def _split_by_255(data):
+    return [bytearray(part) for part in bytes(data).split(b"\xff")]
+
+
+# ----- Frame Codec ------------------------------------------------------------
+# Binary encoding for control messages, in which fields are length-prefixed
+# instead of separated by 0xFF bytes, so they can contain any bytes.
+# Legacy control messages never start with a 0 byte, so binary frames, which
+# do, can be told apart from them.
+# Binary frames are only sent to peers which advertise that they understand
+# them, see _BINARY_FRAMES_CAPABILITY, otherwise the legacy encoding is used.
+_FRAME_MARKER = 0
+_FRAME_VERSION = 1
+_FRAME_HEADER = struct.Struct(">BBB")  # marker, version, frame type
+# frame type: fields filesize, filename, metadata[, features]
+_FRAME_FILE_HEADER = 1
+# frame type: the features the receiver of a file supports, followed by the
+# blocks of the file it already has, as alternating fields block length and
+# SHA-256 hash, see FileTransmissionReceiver
+_FRAME_FILE_READY = 2
+# frame type: fields position, positioned: the position in the file from
+# which the sender continues a file transmission, and whether the blocks it
+# sends are prefixed with their positions
+_FRAME_FILE_RESUME = 3
+# features of file transmissions, a bitmask in file headers and FILE_READY
+# frames:
+_FILE_RESUMABLE = 1  # interrupted transmissions can be resumed
+_FILE_POSITIONED_BLOCKS = 2  # blocks may be prefixed with their positions
+_FILE_FEATURES = _FILE_RESUMABLE | _FILE_POSITIONED_BLOCKS
+# the prefix of positioned blocks: the block's position in the file
+_FILE_BLOCK_HEADER = struct.Struct(">Q")
+_FIELD_INT = 0
+_FIELD_BYTES = 1
+# appended to a conversation's join message by peers that understand binary
+# frames
+_BINARY_FRAMES_CAPABILITY = b"binary-frames"
+# appended to a conversation's join message by peers whose eventhandlers
+# process messages one at a time in the order they were received
+_ORDERED_DELIVERY_CAPABILITY = b"ordered-delivery"
+# frame type: fields are conversation messages sent together, see
+# Conversation.say()
+_FRAME_MESSAGE_BATCH = 4
+# appended to conversation requests by peers that understand message batches,
+# and to join messages if both peers do
+_MESSAGE_BATCHES_CAPABILITY = b"message-batches"
+
+
+def _encode_varint(number):
+    """Encodes a non-negative integer as an unsigned LEB128 varint."""
+    array = bytearray()
+    while number > 0x7F:
+        array.append(number & 0x7F | 0x80)
+        number >>= 7
+    array.append(number)
+    return array
+
+
+def _decode_varint(buffer, position=0):
+    """Decodes an unsigned LEB128 varint.
+    Returns:
+        tuple(int, int): the number and the position after the varint
+    """
+    number = 0
+    shift = 0
+    while True:
+        byte = buffer[position]
+        position += 1
+        number |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return number, position
+        shift += 7
+
+
+def _encode_frame(frame_type, *fields):
+    """Encodes a control message as a binary frame.
+    Args:
+        frame_type (int): what kind of message this is
+        *fields (int or bytes): the contents of the message
+    Returns:
+        bytearray: the encoded frame
+    """
+    frame = bytearray(_FRAME_HEADER.pack(
+        _FRAME_MARKER, _FRAME_VERSION, frame_type))
+    for field in fields:
+        if isinstance(field, int):
+            frame.append(_FIELD_INT)
+            frame += _encode_varint(field)
+        else:
+            frame.append(_FIELD_BYTES)
+            frame += _encode_varint(len(field))
+            frame += field
+    return frame
+
+
+def _decode_frame(frame):
+    """Decodes a binary frame encoded with `_encode_frame`, without copying
+    the contents of its fields.
+    Returns:
+        tuple(int, list): the frame type and the fields, which are ints or
+            memoryviews of the frame
+    Raises:
+        UnreadableReply: if the frame is malformed or of an unknown version
+    """
+    try:
+        marker, version, frame_type = _FRAME_HEADER.unpack_from(frame)
+        if marker != _FRAME_MARKER or version != _FRAME_VERSION:
+            raise UnreadableReply("Unsupported frame format.")
+        view = memoryview(frame)
+        fields = []
+        position = _FRAME_HEADER.size
+        while position < len(view):
+            field_type = view[position]
+            number, position = _decode_varint(view, position + 1)
+            if field_type == _FIELD_INT:
+                fields.append(number)
+            elif field_type == _FIELD_BYTES and position + number <= len(view):
+                fields.append(view[position:position + number])
+                position += number
+            else:
+                raise UnreadableReply("Malformed frame.")
+    except (struct.error, IndexError):
+        raise UnreadableReply("Malformed frame.") from None
+    return frame_type, fields
+
+
+def _is_binary_frame(data):
+    return len(data) > 0 and data[0] == _FRAME_MARKER
+
+
+_MESSAGE_BATCH_HEADER = _FRAME_HEADER.pack(
+    _FRAME_MARKER, _FRAME_VERSION, _FRAME_MESSAGE_BATCH)
+
+
+def _is_message_batch(data):
+    return data[:_FRAME_HEADER.size] == _MESSAGE_BATCH_HEADER
+
+
+def _encode_file_header(filesize, filename, metadata, binary=False,
+                        features=0):
+    """Encodes the message with which a file transmission is started.
+    Args:
+        binary (bool): whether to use a binary frame, otherwise the legacy
+            0xFF-separated encoding, which breaks if the metadata or the
+            encoded filesize contain 0xFF bytes
+        features (int): the `_FILE_*` features the sender supports
+            (binary frames only)
+    """
+    if binary:
+        fields = [filesize, filename.encode(), metadata]
+        if features:
+            fields.append(features)
+        return _encode_frame(_FRAME_FILE_HEADER, *fields)
+    return (_to_b255_no_0s(filesize) + bytearray([255])
+            + bytearray(filename.encode()) + bytearray([255]) + metadata)
+
+
+def _decode_file_header(data):
+    """Decodes a message encoded by `_encode_file_header` in either encoding.
+    Returns:
+        tuple(int, str, bytearray, int): the filesize, filename, metadata and
+            the `_FILE_*` features the sender supports
+    """
+    if _is_binary_frame(data):
+        frame_type, fields = _decode_frame(data)
+        if frame_type != _FRAME_FILE_HEADER:
+            raise UnreadableReply("Expected a file header.")
+        filesize, filename, metadata = fields[:3]
+        features = fields[3] if len(fields) > 3 else 0
+        return filesize, str(filename, 'utf-8'), bytearray(metadata), features
+    # the filename can't contain 0xFF bytes, but the metadata can
+    filesize, filename, metadata = bytes(data).split(b"\xff", 2)
+    return (_from_b255_no_0s(filesize), filename.decode('utf-8'),
+            bytearray(metadata), 0)
+
+
+def _encode_file_ready(features, blocks):
+    """Encodes the reply to a file header which supports `_FILE_*` features.
+    Args:
+        features (int): the `_FILE_*` features the receiver supports
+        blocks (list): (length:int, sha256:bytes) of the first blocks of the
+            file which the receiver already has
+    """
+    fields = [features]
+    for length, digest in blocks:
+        fields += [length, digest]
+    return _encode_frame(_FRAME_FILE_READY, *fields)
+
+
+def _decode_file_ready(data):
+    """Decodes a message encoded by `_encode_file_ready`.
+    Returns:
+        tuple(int, list): the features, and (length:int, sha256:bytes) for
+            each block
+    """
+    frame_type, fields = _decode_frame(data)
+    if frame_type != _FRAME_FILE_READY or len(fields) % 2 != 1:
+        raise UnreadableReply("Expected a file reception confirmation.")
+    return fields[0], [(fields[i], bytes(fields[i + 1]))
+                       for i in range(1, len(fields), 2)]
+
+
+def _encode_file_resume(position, positioned):
+    """Encodes the reply to `_encode_file_ready()`.
+    Args:
+        position (int): the position from which the file is transmitted
+        positioned (bool): whether the blocks are prefixed with their
+            positions
+    """
+    return _encode_frame(_FRAME_FILE_RESUME, position, int(positioned))
+
+
+def _decode_file_resume(data):
+    """Decodes a message encoded by `_encode_file_resume`.
+    Returns:
+        tuple(int, bool): the position and whether blocks are positioned
+    """
+    frame_type, fields = _decode_frame(data)
+    if frame_type != _FRAME_FILE_RESUME or len(fields) < 2:
+        raise UnreadableReply("Expected a file transmission position.")
+    return fields[0], bool(fields[1])
+
+
+def _preallocate(fd, size):
+    """Allocates disk space for a file of the given size, extending it if it
+    is smaller."""
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError as error:
+            if error.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                raise   # e.g. the disk is full
+    if os.fstat(fd).st_size < size:
+        os.ftruncate(fd, size)
+
+
+def _write_at(fd, data, position):
+    """Writes the data to a file at the given position, without changing the
+    file's current position if the operating system supports it."""
+    view = memoryview(data)
+    while view:
+        if hasattr(os, "pwrite"):
+            written = os.pwrite(fd, view, position)
+        else:
+            os.lseek(fd, position, os.SEEK_SET)
+            written = os.write(fd, view)
+        view = view[written:]
+        position += written
+
+
+# the most digits a frame's length header can have: 255**8 exceeds any length
+# that can be transmitted
+_FRAME_HEADER_MAX_DIGITS = 8
+# the most memory preallocated for a frame's data before it has arrived
+_FRAME_PREALLOCATION_MAX = 16777216  # 16MiB
+
+
+def _tcp_send_all(sock, data, prefix=b""):
+    """Sends the given data, prefixed with its length.
+    Args:
+        sock (socket.socket): the connection to send on
+        data (bytes): the data to send
+        prefix (bytes): a header to send as part of the data, which saves
+            the caller from copying the data to concatenate them
+    """
+    length = len(prefix) + len(data)
+    header = _to_b255_no_0s(length) + bytearray([0]) + prefix
+    if length <= BUFFER_SIZE:  # send small buffers in a single TCP segment
+        sock.sendall(header + data)
+        return
+    sock.sendall(header)
+    sock.sendall(data)
+
+
+def _tcp_send_file(sock, file, position, count, prefix=b""):
+    """Sends the given range of a file, prefixed with its length, letting the
+    operating system copy it to the connection directly where it supports
+    doing so.
+    Args:
+        sock (socket.socket): the connection to send on
+        file (file): the file to send from, opened in binary mode
+        position (int): the position in the file to start sending from
+        count (int): the number of bytes to send
+        prefix (bytes): a header to send as part of the data
+    """
+    sock.sendall(_to_b255_no_0s(len(prefix) + count) + bytearray([0]) + prefix)
+    if sock.sendfile(file, position, count) != count:
+        raise DataTransmissionError(
+            "The file got shorter while being transmitted.")
+
+
+def _tcp_recv_frame(sock, timeout=None, max_size=None):
+    """Receives a buffer sent with `_tcp_send_all`, reading it directly into a
+    buffer preallocated to the announced length.
+    The buffer is preallocated to at most `_FRAME_PREALLOCATION_MAX` bytes
+    and grows as more data arrives, so that a peer can't make us allocate
+    memory merely by announcing a large length.
+    While waiting for data, the thread sleeps in the operating system's I/O
+    readiness notification (epoll/kqueue/select) instead of polling the socket.
+    Args:
+        sock (socket.socket): the connection to receive from
+        timeout (float): how many seconds to wait for data until giving up,
+            waiting twice as long for the first data (default: wait forever)
+        max_size (int): the largest length to accept (default: any)
+    Raises:
+        UnreadableReply: if the length header is invalid or exceeds max_size
+    Returns:
+        tuple(bytearray, bool): the received data, and whether it is complete,
+            i.e. it is not cut off because the timeout was reached or the
+            connection was closed
+    """
+    header = bytearray()
+    data = None  # preallocated once the header has been received
+    length = 0
+    position = 0
+    selector = None
+    if timeout is None:
+        sock.setblocking(True)  # blocking reads wait on the OS without polling
+    else:
+        sock.setblocking(False)
+        selector = selectors.DefaultSelector()
+        selector.register(sock, selectors.EVENT_READ)
+        deadline = time.monotonic() + timeout * 2
+    try:
+        while data is None or position < length:
+            if selector and not selector.select(
+                    max(deadline - time.monotonic(), 0)):
+                if PRINT_LOG_TRANSMISSIONS:
+                    print("Timeout reached")
+                break
+            try:
+                if data is None:    # still receiving the length header
+                    # peek, so as not to consume data beyond this frame
+                    chunk = sock.recv(BUFFER_SIZE, socket.MSG_PEEK)
+                    n_bytes = len(chunk)
+                    end = chunk.find(0)
+                    chunk = sock.recv(n_bytes if end == -1 else end + 1)
+                else:
+                    n_bytes = sock.recv_into(view[position:])
+            except (BlockingIOError, InterruptedError):
+                continue
+            if not n_bytes:     # connection closed
+                break
+            if selector:
+                deadline = time.monotonic() + timeout
+            if data is not None:
+                position += n_bytes
+                if position == len(data) < length:
+                    view.release()
+                    data += bytes(min(len(data), length - len(data)))
+                    view = memoryview(data)
+                continue
+            header += chunk if end == -1 else chunk[:end]
+            if len(header) > _FRAME_HEADER_MAX_DIGITS:
+                raise UnreadableReply(
+                    "Received a frame with an invalid length header.")
+            if end == -1:
+                continue
+            length = _from_b255_no_0s(header)
+            if max_size is not None and length > max_size:
+                raise UnreadableReply(
+                    f"Received a frame of {length} bytes, more than the "
+                    f"{max_size} bytes accepted here.")
+            data = bytearray(min(length, _FRAME_PREALLOCATION_MAX))
+            view = memoryview(data)
+    finally:
+        if data is not None:
+            view.release()
+        if selector:
+            selector.close()
+            sock.setblocking(True)
+    if data is None:
+        return header, False
+    if position < length:
+        return data[:position], False
+    return data, True
+
+
+def _tcp_recv_all(sock, timeout=5, max_size=None):
+    """Receives a buffer sent with `_tcp_send_all`.
+    If some data has been received but then none for `timeout` seconds,
+    or if none has been received at all for twice `timeout`, gives up,
+    returning the data received so far.
+    Raises:
+        UnreadableReply: if the length header is invalid or exceeds max_size
+    Returns:
+        bytearray: the received data
+    """
+    data, complete = _tcp_recv_frame(sock, timeout, max_size)
+    return data
+
+
+def _tcp_recv_buffer_timeout(sock, buffer_size=BUFFER_SIZE, timeout=5):
+    """Waits until some data is received (or the connection is closed).
+    Raises:
+        TimeoutError: if no data is received within `timeout` seconds
+    Returns:
+        bytes: the received data (empty if the connection was closed)
+    """
+    sock.settimeout(timeout)
+    return sock.recv(buffer_size)
+
+
+# ----------IPFS Utilities-------------------------------------------
+connections_send = list()
+connections_listen = list()
+
+
+class _Forward:
+    """A sending connection (libp2p port-forwarding) in the `_PortForwards`
+    registry."""
+
+    def __init__(self, protocol, peer_id, port, owned=True):
+        self.protocol = protocol
+        self.peer_id = peer_id
+        self.port = port
+        self.owned = owned  # False if it was opened by another process
+        self.references = 0
+        self.idle_since = None
+
+
+class _PortForwards:
+    """Keeps track of the IPFS port-forwarding connections (sending and
+    listening) this process uses, so that instead of opening and closing one
+    for every transmission and probing `sending_ports` for a free port with an
+    HTTP request each, forwards to the same peer and protocol are shared and
+    free ports are known in advance.
+    A forward that nothing uses anymore is only closed once it has been idle
+    for `FORWARD_IDLE_TIMEOUT_SEC`, together with all other such forwards, so
+    that it can be reused by the next transmission in the meantime.
+    The registry is seeded from the IPFS daemon's list of connections
+    (`p2p.ls`) when first used, and reseeded whenever
+    `ipfs_api.http_client` is replaced.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._client = None     # the HTTP client the registry was seeded from
+        self._forwards = dict()     # (protocol, peer_id): _Forward
+        self._ports = dict()    # port: _Forward
+        self._free_ports = deque()
+        self._listeners = dict()    # protocol: port
+        self._cleanup_scheduled = False
+        # statistics
+        self.created = 0    # forwards opened
+        self.reused = 0     # forwards reused instead of opening new ones
+        self.closed = 0     # forwards closed
+
+    def _seed(self):
+        """Loads the IPFS daemon's current connections, if that hasn't been
+        done yet for the current `ipfs_api.http_client`."""
+        if self._client is ipfs_api.http_client:
+            return
+        self._client = ipfs_api.http_client
+        self._forwards.clear()
+        self._ports.clear()
+        self._listeners.clear()
+        used_ports = set()
+        for connection in _p2p_connections():
+            protocol = connection.get("Protocol", "")
+            if protocol.startswith("/x/"):
+                protocol = protocol[3:]
+            listen_address = connection.get("ListenAddress", "")
+            target_address = connection.get("TargetAddress", "")
+            if listen_address.startswith("/p2p/"):
+                port = _multiaddr_port(target_address)
+                if port is not None:
+                    self._listeners[protocol] = port
+                continue
+            port = _multiaddr_port(listen_address)
+            if port is None:
+                continue
+            used_ports.add(port)
+            if target_address.startswith("/p2p/"):
+                forward = _Forward(protocol, target_address[5:], port,
+                                   owned=False)
+                self._forwards.setdefault((protocol, forward.peer_id), forward)
+                self._ports[port] = forward
+        self._free_ports = deque(
+            port for port in sending_ports if port not in used_ports)
+
+    def acquire(self, peer_id, protocol):
+        """Returns a forward to the specified peer's protocol, opening one if
+        there isn't one yet. Release it with `release()` when done."""
+        with self._lock:
+            self._seed()
+            forward = self._forwards.get((protocol, peer_id))
+            if forward:
+                self.reused += 1
+            else:
+                forward = self._open(peer_id, protocol)
+            forward.references += 1
+            forward.idle_since = None
+            return forward
+
+    def _open(self, peer_id, protocol, port=None):
+        """Opens a forward on the specified port or the next free one."""
+        attempts = 1 if port else max(1, len(self._free_ports))
+        for i in range(attempts):
+            prt = port or self._allocate_port()
+            try:
+                _daemon_call("p2p/forward",
+                             ipfs_api.create_tcp_sending_connection,
+                             protocol, prt, peer_id)
+            except Exception as e:
+                if not port:
+                    # try again later, it may be freed by its user
+                    self._free_ports.append(prt)
+                if "bind: address already in use" in str(e):
+                    continue
+                raise IPFS_Error(str(e))
+            if PRINT_LOG_CONNECTIONS:
+                print(f"forwarding {prt} to \"{protocol}\" on {peer_id}")
+            forward = _Forward(protocol, peer_id, prt)
+            self._forwards[(protocol, peer_id)] = forward
+            self._ports[prt] = forward
+            self.created += 1
+            return forward
+        raise IPFS_Error("Failed to find free port for sending connection")
+
+    def _allocate_port(self):
+        """Returns a free port, closing the longest idle forward to free one
+        if all are in use."""
+        if not self._free_ports:
+            idle = [forward for forward in self._ports.values()
+                    if forward.owned and forward.idle_since is not None]
+            if not idle:
+                raise IPFS_Error(
+                    "Failed to find free port for sending connection")
+            self._close([min(idle, key=lambda forward: forward.idle_since)])
+        return self._free_ports.popleft()
+
+    def open_on_port(self, peer_id, protocol, port):
+        """Opens a forward on the specified port, replacing any that is
+        already there."""
+        with self._lock:
+            self._seed()
+            forward = self._ports.get(port)
+            if forward:
+                self._close([forward])
+            else:
+                _daemon_call("p2p/close",
+                             ipfs_api.close_tcp_sending_connection, port=port)
+            if port in self._free_ports:
+                self._free_ports.remove(port)
+            forward = self._forwards.get((protocol, peer_id))
+            if forward:
+                # the forward on the new port replaces it
+                del self._forwards[(protocol, peer_id)]
+            forward = self._open(peer_id, protocol, port)
+            forward.references += 1
+            return forward
+
+    def release(self, peer_id=None, protocol=None, port=None):
+        """Gives up a reference to the forward on the specified port, or to
+        the forward to the specified peer's protocol."""
+        with self._lock:
+            if port:
+                forward = self._ports.get(port)
+            else:
+                forward = self._forwards.get((protocol, peer_id))
+            if not forward or forward.references == 0:
+                return
+            forward.references -= 1
+            if forward.references == 0:
+                forward.idle_since = time.monotonic()
+                self._schedule_cleanup()
+
+    def discard(self, forward):
+        """Forgets a forward which turned out not to exist anymore, e.g.
+        because it was closed by another process."""
+        with self._lock:
+            if self._ports.get(forward.port) is forward:
+                del self._ports[forward.port]
+                self._free_ports.append(forward.port)
+            if self._forwards.get((forward.protocol, forward.peer_id)) is forward:
+                del self._forwards[(forward.protocol, forward.peer_id)]
+
+    def _schedule_cleanup(self):
+        if self._cleanup_scheduled:
+            return
+        self._cleanup_scheduled = True
+        timer = threading.Timer(FORWARD_IDLE_TIMEOUT_SEC, self._cleanup)
+        timer.daemon = True
+        timer.start()
+
+    def _cleanup(self):
+        """Closes all forwards which have been idle for at least
+        `FORWARD_IDLE_TIMEOUT_SEC`."""
+        with self._lock:
+            self._cleanup_scheduled = False
+            now = time.monotonic()
+            self._close([
+                forward for forward in self._ports.values()
+                if forward.owned and forward.idle_since is not None
+                and now - forward.idle_since >= FORWARD_IDLE_TIMEOUT_SEC
+            ])
+            if any(forward.owned and forward.idle_since is not None
+                   for forward in self._ports.values()):
+                self._schedule_cleanup()
+
+    def close_idle(self):
+        """Closes all forwards which aren't in use."""
+        with self._lock:
+            self._close([
+                forward for forward in self._ports.values()
+                if forward.owned and forward.references == 0
+            ])
+
+    def _close(self, forwards):
+        for forward in forwards:
+            self.discard(forward)
+            try:
+                _daemon_call("p2p/close",
+                             ipfs_api.close_tcp_sending_connection,
+                             port=forward.port)
+                self.closed += 1
+            except Exception as e:
+                if PRINT_LOG_CONNECTIONS:
+                    print(f"failed to close forward on {forward.port}: {e}")
+
+    def close_matching(self, peer_id=None, protocol=None, port=None):
+        """Closes the forwards matching all the given criteria immediately,
+        regardless of whether they're in use."""
+        with self._lock:
+            self._seed()
+            _daemon_call("p2p/close", ipfs_api.close_tcp_sending_connection,
+                         peer_id=peer_id, name=protocol, port=port)
+            for forward in list(self._ports.values()):
+                if ((peer_id is None or forward.peer_id == peer_id)
+                        and (protocol is None or forward.protocol == protocol)
+                        and (port is None or forward.port == port)):
+                    self.discard(forward)
+                    self.closed += 1
+
+    def listening_port(self, protocol):
+        """Returns the port of the listening connection registered for the
+        given protocol, or None."""
+        with self._lock:
+            self._seed()
+            return self._listeners.get(protocol)
+
+    def add_listener(self, protocol, port):
+        with self._lock:
+            self._listeners[protocol] = port
+
+    def remove_listeners(self, protocol=None, port=None):
+        with self._lock:
+            for prot, prt in list(self._listeners.items()):
+                if ((protocol is None or prot == protocol)
+                        and (port is None or prt == port)):
+                    del self._listeners[prot]
+
+
+_port_forwards = _PortForwards()
+atexit.register(_port_forwards.close_idle)
+
+
+class _ReceiverPool:
+    """A pool of listening sockets, each registered as an IPFS listening
+    connection whose protocol is its port number, on which
+    TransmissionListeners receive the transmissions announced by
+    transmission requests.
+    Instead of registering a new listening connection for every transmission
+    and closing it afterwards, the sockets are recycled, so that accepting a
+    transmission request makes no HTTP calls to the IPFS daemon unless the
+    pool is exhausted.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._client = None     # the HTTP client the sockets are registered on
+        self._idle = deque()    # sockets ready to receive a transmission
+        self._prewarming = False
+        # statistics
+        self.hits = 0   # requests served from the pool
+        self.misses = 0     # requests for which a socket had to be registered
+        self._accept_latency_total = 0.0
+        self._accept_latency_max = 0.0
+
+    def _check_client(self):
+        """Forgets the pooled sockets if `ipfs_api.http_client` has been
+        replaced, as their listening connections aren't registered on it."""
+        if self._client is ipfs_api.http_client:
+            return
+        self._client = ipfs_api.http_client
+        while self._idle:
+            self._idle.popleft().close()
+
+    def acquire(self):
+        """Returns a listening socket registered as an IPFS listening
+        connection, to be returned with `release()` after use."""
+        start_time = time.perf_counter()
+        with self._lock:
+            self._check_client()
+            sock = self._idle.popleft() if self._idle else None
+            if sock:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if sock:
+            _close_pending_connections(sock)
+        else:
+            sock = self._open()
+        latency = time.perf_counter() - start_time
+        _observe("receiver_pool_accept_seconds", latency)
+        with self._lock:
+            self._accept_latency_total += latency
+            self._accept_latency_max = max(self._accept_latency_max, latency)
+        return sock
+
+    def _open(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind((_ipfs_host_ip(), 0))
+        port = sock.getsockname()[1]
+        try:
+            _create_listening_connection(str(port), port)
+        except:
+            sock.close()
+            raise
+        sock.listen()
+        return sock
+
+    def release(self, sock):
+        """Returns a socket to the pool, or closes it if the pool is full."""
+        with self._lock:
+            if (self._client is ipfs_api.http_client
+                    and len(self._idle) < RECEIVER_POOL_SIZE):
+                sock.settimeout(None)
+                self._idle.append(sock)
+                return
+        self._close(sock)
+
+    def _close(self, sock):
+        port = sock.getsockname()[1]
+        sock.close()
+        try:
+            _close_listening_connection(str(port), port)
+        except IPFS_Error as error:
+            if PRINT_LOG_CONNECTIONS:
+                print(f"failed to close listening connection {port}: {error}")
+
+    def prewarm(self):
+        """Fills the pool up to RECEIVER_POOL_SIZE sockets in the
+        background."""
+        with self._lock:
+            self._check_client()
+            if self._prewarming or len(self._idle) >= RECEIVER_POOL_SIZE:
+                return
+            self._prewarming = True
+        Thread(target=self._prewarm, name="DataTransmission-receiver-pool",
+               daemon=True).start()
+
+    def _prewarm(self):
+        try:
+            while True:
+                with self._lock:
+                    if len(self._idle) >= RECEIVER_POOL_SIZE:
+                        return
+                sock = self._open()
+                with self._lock:
+                    self._idle.append(sock)
+        except Exception as error:
+            if PRINT_LOG_CONNECTIONS:
+                print(f"failed to prewarm receiver pool: {error}")
+        finally:
+            self._prewarming = False
+
+    def close(self):
+        """Closes all pooled sockets and their listening connections."""
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+        for sock in idle:
+            self._close(sock)
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "idle": len(self._idle),
+                "accept_latency_avg": (
+                    self._accept_latency_total / requests if requests else 0),
+                "accept_latency_max": self._accept_latency_max,
+            }
+
+
+def _close_pending_connections(sock):
+    """Closes any connections waiting to be accepted on a listening socket,
+    e.g. from a sender who connected too late for a previous transmission."""
+    sock.setblocking(False)
+    try:
+        while True:
+            conn, addr = sock.accept()
+            conn.close()
+    except OSError:     # none left
+        pass
+    finally:
+        sock.setblocking(True)
+
+
+_receiver_pool = _ReceiverPool()
+atexit.register(_receiver_pool.close)
+
+# the libp2p protocol of the demultiplexer's IPFS listening connection
+_DEMUX_PROTOCOL = "ipfs-datatransmission-demux"
+# the longest listener name a connection can be routed by
+_DEMUX_ROUTE_MAX_SIZE = 1024
+
+
+class _Demultiplexer:
+    """Hosts many listeners on a single socket, registered as a single IPFS
+    listening connection (`_DEMUX_PROTOCOL`), with a single thread which
+    accepts all incoming connections using a selector (see LISTENER_DEMUX).
+    Senders start every connection with a frame naming the listener it is
+    for (see `_connect_to_listener`), by which the connection is routed to
+    the handler the listener registered for its name.
+    Connections are only handed to a handler, on a new thread, once their
+    name has been received, so peers which are slow to send it occupy no
+    thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._routes = {}   # listener name: (handler, threaded)
+        # routes which are removed once they have served one connection,
+        # name: (handler, threaded, expiry time)
+        self._routes_once = {}
+        self._next_token = 65536    # not to be confused with port numbers
+        self._client = None     # the HTTP client our listening connection is
+        self._sock = None
+        self._selector = None
+        self._pending = {}  # connections whose name hasn't arrived yet
+        self.port = 0
+
+    def register(self, name, handler, threaded=True):
+        """Routes the connections for the listener of the given name to the
+        given handler, replacing any handler already registered for it.
+        Args:
+            name (str): the name of the listener
+            handler (function): is passed each connection (socket.socket),
+                which it is responsible for closing
+            threaded (bool): whether to call the handler on a new thread for
+                each connection, or on the demultiplexer's thread, in which
+                case it mustn't block
+        Returns:
+            int: the port of the demultiplexer's socket
+        """
+        with self._lock:
+            self._routes[name] = (handler, threaded)
+        self._start()
+        return self.port
+
+    def register_once(self, handler, timeout, threaded=True):
+        """Routes a single connection to the given handler, for a
+        newly generated name.
+        Args:
+            handler (function): see `register()`
+            timeout (float): how many seconds the route is kept for if no
+                connection arrives
+            threaded (bool): see `register()`
+        Returns:
+            str: the name senders must connect to
+        """
+        with self._lock:
+            name = str(self._next_token)
+            self._next_token += 1
+            self._routes_once[name] = (
+                handler, threaded, time.monotonic() + timeout)
+        self._start()
+        return name
+
+    def unregister(self, name, handler=None):
+        """Stops routing connections for the listener of the given name,
+        if it is still routed to the given handler (default: any)."""
+        with self._lock:
+            route = self._routes.get(name)
+            if route and (handler is None or route[0] == handler):
+                del self._routes[name]
+
+    def _start(self):
+        """Opens our socket and registers it as an IPFS listening connection
+        if that hasn't been done yet, or if `ipfs_api.http_client` has been
+        replaced."""
+        with self._start_lock:
+            if self._sock and self._client is ipfs_api.http_client:
+                return
+            if not self._sock:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.bind((_ipfs_host_ip(), 0))
+                sock.listen()
+                sock.setblocking(False)
+                self._selector = selectors.DefaultSelector()
+                self._selector.register(sock, selectors.EVENT_READ)
+                self._sock = sock
+                self.port = sock.getsockname()[1]
+                Thread(target=self._run, name="DataTransmissionDemultiplexer",
+                       daemon=True).start()
+            _create_listening_connection(_DEMUX_PROTOCOL, self.port)
+            self._client = ipfs_api.http_client
+
+    def _run(self):
+        sock = self._sock
+        while self._sock is sock:
+            try:
+                events = self._selector.select(timeout=1)
+            except (OSError, ValueError):   # closed
+                break
+            for key, mask in events:
+                if key.fileobj is sock:
+                    self._accept(sock)
+                else:
+                    self._read_route(key.fileobj)
+            self._expire()
+        for conn in list(self._pending):
+            self._drop(conn)
+        self._selector.close()
+
+    def _accept(self, sock):
+        while True:
+            try:
+                conn, addr = sock.accept()
+            except OSError:     # none left, or closed
+                return
+            conn.setblocking(False)
+            self._pending[conn] = [
+                time.monotonic() + 2 * TRANSM_RECV_TIMEOUT_SEC, bytearray()]
+            self._selector.register(conn, selectors.EVENT_READ)
+
+    def _read_route(self, conn):
+        """Reads some of the frame naming the listener a connection is for,
+        without reading beyond it, routing the connection once it has been
+        received completely."""
+        received = self._pending[conn][1]
+        try:
+            chunk = conn.recv(
+                _FRAME_HEADER_MAX_DIGITS + 1 + _DEMUX_ROUTE_MAX_SIZE,
+                socket.MSG_PEEK)
+            if not chunk:   # connection closed
+                raise ConnectionError("connection closed before routing")
+            data = received + chunk
+            end = data.find(0)
+            if end == -1:
+                if len(data) > _FRAME_HEADER_MAX_DIGITS:
+                    raise UnreadableReply(
+                        "Received a frame with an invalid length header.")
+                received += conn.recv(len(chunk))
+                return
+            length = _from_b255_no_0s(data[:end])
+            if length > _DEMUX_ROUTE_MAX_SIZE:
+                raise UnreadableReply(
+                    f"Received a listener name of {length} bytes.")
+            frame_length = end + 1 + length
+            received += conn.recv(
+                min(frame_length - len(received), len(chunk)))
+            if len(received) < frame_length:
+                return
+            name = received[end + 1:].decode()
+        except (BlockingIOError, InterruptedError):
+            return
+        except (UnreadableReply, OSError, ValueError) as error:
+            if PRINT_LOG_CONNECTIONS:
+                print(f"demultiplexer: dropping connection: {error}")
+            self._drop(conn)
+            return
+        self._selector.unregister(conn)
+        del self._pending[conn]
+        with self._lock:
+            route = self._routes.get(name)
+            if not route:
+                route = self._routes_once.pop(name, None)
+        if not route:
+            if PRINT_LOG_CONNECTIONS:
+                print(f"demultiplexer: no listener named \"{name}\"")
+            conn.close()
+            return
+        handler, threaded = route[:2]
+        conn.setblocking(True)
+        if threaded:
+            Thread(target=handler, args=(conn,),
+                   name=f"DataTransmissionDemux-{name}").start()
+            return
+        try:
+            handler(conn)
+        except Exception:
+            traceback.print_exc()
+
+    def _drop(self, conn):
+        self._selector.unregister(conn)
+        del self._pending[conn]
+        conn.close()
+
+    def _expire(self):
+        """Closes connections whose listener name hasn't arrived in time,
+        and forgets one-time routes no connection arrived for."""
+        now = time.monotonic()
+        for conn, (deadline, received) in list(self._pending.items()):
+            if now > deadline:
+                self._drop(conn)
+        with self._lock:
+            for name, route in list(self._routes_once.items()):
+                if now > route[2]:
+                    del self._routes_once[name]
+
+    def close(self):
+        """Closes our socket and IPFS listening connection, and lets our
+        thread close the connections whose listener name hasn't arrived yet.
+        """
+        with self._start_lock:
+            sock = self._sock
+            if not sock:
+                return
+            self._sock = None
+            port = self.port
+        sock.close()
+        try:
+            _close_listening_connection(_DEMUX_PROTOCOL, port)
+        except IPFS_Error as error:
+            if PRINT_LOG_CONNECTIONS:
+                print(f"failed to close listening connection {port}: {error}")
+
+
+_demultiplexer = _Demultiplexer()
+atexit.register(_demultiplexer.close)
+
+
+def _p2p_connections():
+    """Returns the IPFS daemon's libp2p stream-mounting connections."""
+    try:
+        result = _daemon_call("p2p/ls", ipfs_api.http_client.p2p.ls)
+    except Exception as e:
+        if PRINT_LOG_CONNECTIONS:
+            print(f"failed to list IPFS connections: {e}")
+        return []
+    if isinstance(result, list):
+        result = result[0] if result else {}
+    return result.get("Listeners") or []
+
+
+def _multiaddr_port(multiaddr):
+    """Returns the TCP port of a multiaddr like /ip4/127.0.0.1/tcp/4001, or
+    None if it has none."""
+    parts = multiaddr.strip("/").split("/")
+    for i, part in enumerate(parts[:-1]):
+        if part == "tcp":
+            try:
+                return int(parts[i + 1])
+            except ValueError:
+                return None
+    return None
+
+
+def _create_sending_connection(peer_id: str, protocol: str, port=None):
+    """Connects to the specified peer's protocol through a port-forwarding,
+    which is reused if one already exists.
+    The port-forwarding must be released with `_close_sending_connection`
+    once the connection is no longer needed.
+    Args:
+        int port: the port on which to open the port-forwarding, replacing
+            any existing one; by default a free one is chosen
+    Returns:
+        socket.socket: the connection
+    """
+    start = _timer()
+    for attempt in range(2):
+        try:
+            if port:
+                forward = _port_forwards.open_on_port(peer_id, protocol, port)
+            else:
+                forward = _port_forwards.acquire(peer_id, protocol)
+        except IPFS_Error:
+            raise
+        except Exception as e:
+            raise IPFS_Error(str(e))
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.connect((_ipfs_host_ip(), forward.port))
+            _observe_since("transmission_phase_seconds", start,
+                           phase="connect")
+            return sock
+        except ConnectionRefusedError:
+            # the port-forwarding was closed behind our back
+            sock.close()
+            _port_forwards.discard(forward)
+    raise IPFS_Error(
+        f"Failed to connect to port-forwarding on {forward.port}")
+
+
+def _listener_protocol(name):
+    """Returns the libp2p protocol through which a peer's listener of the
+    given name is reached."""
+    return _DEMUX_PROTOCOL if LISTENER_DEMUX else name
+
+
+def _connect_to_listener(peer_id, name):
+    """Connects to the specified peer's listener (TransmissionListener,
+    receiving socket or BufferReceiver), through the peer's demultiplexer if
+    LISTENER_DEMUX is enabled.
+    The port-forwarding must be released with `_close_sending_connection`
+    for the protocol `_listener_protocol(name)` once the connection is no
+    longer needed.
+    Returns:
+        socket.socket: the connection
+    """
+    sock = _create_sending_connection(peer_id, _listener_protocol(name))
+    if LISTENER_DEMUX:
+        try:
+            _tcp_send_all(sock, name.encode())
+        except OSError:
+            sock.close()
+            _close_sending_connection(peer_id, _DEMUX_PROTOCOL)
+            raise
+    return sock
+
+
+def _create_listening_connection(protocol, port, force=True):
+    """
+    Args:
+        bool force: whether or not already existing conflicting connections should be closed.
+    """
+    registered_port = _port_forwards.listening_port(protocol)
+    if registered_port == port:
+        # already registered, e.g. by a previous run of this program
+        if PRINT_LOG_CONNECTIONS:
+            print(f"already listening as \"{protocol}\" on {port}")
+        connections_listen.append((protocol, port))
+        return port
+    if registered_port is not None and force:
+        _close_listening_connection(name=protocol)
+    try:
+        _daemon_call("p2p/listen", ipfs_api.create_tcp_listening_connection,
+                     protocol, port)
+        if PRINT_LOG_CONNECTIONS:
+            print(f"listening fas \"{protocol}\" on {port}")
+    except:
+        if force:
+            _close_listening_connection(name=protocol)
+        try:
+            time.sleep(0.1)
+            _count("retries_total", operation="listening_connection")
+            _daemon_call("p2p/listen",
+                         ipfs_api.create_tcp_listening_connection,
+                         protocol, port)
+            if PRINT_LOG_CONNECTIONS:
+                print(f"listening as \"{protocol}\" on {port}")
+        except:
+            raise IPFS_Error(
+                "Error registering listening connection to IPFS: "
+                f"/x/{protocol}/ip4/{_ipfs_host_ip()}/udp/{port}"
+            )
+
+    _port_forwards.add_listener(protocol, port)
+    connections_listen.append((protocol, port))
     return port
 
 
 def _close_sending_connection(peer_id=None, name=None, port=None):
+    """Releases the port-forwarding on the specified port, or to the
+    specified peer's protocol, which is closed once it has been idle for
+    `FORWARD_IDLE_TIMEOUT_SEC`.
+    If only `peer_id` or only `name` is given, all matching port-forwardings
+    are closed immediately instead.
+    """
     try:
-        ipfs_api.close_tcp_sending_connection(
-            peer_id=peer_id, name=name, port=port)
+        if port or (peer_id and name):
+            _port_forwards.release(peer_id, name, port)
+        else:
+            _port_forwards.close_matching(peer_id, name)
     except Exception as e:
         raise IPFS_Error(str(e))
 
 
 def _close_listening_connection(name=None, port=None):
     try:
-        ipfs_api.close_tcp_listening_connection(
-            name=name, port=port)
+        _daemon_call("p2p/close", ipfs_api.close_tcp_listening_connection,
+                     name=name, port=port)
+        _port_forwards.remove_listeners(name, port)
     except Exception as e:
         raise IPFS_Error(str(e))
@@ -0,0 +1,1351 @@
+"""
+An asyncio flavour of ipfs_datatransmission, for transmitting data,
+conversing and transmitting files over the Interplanetary File System's
+P2P network (libp2p).
+All sockets are served by the running event loop instead of a thread per
+listener, transmission and callback, so it scales to many concurrent
+conversations.
+It uses the same wire format as ipfs_datatransmission, so peers using either
+module can communicate with each other.
+
+Calls to the IPFS daemon's HTTP API are run in the event loop's default
+executor.
+Eventhandlers and callbacks can be coroutine functions or normal functions.
+Normal functions are called on the event loop's thread, so they mustn't block.
+
+To use it you must have IPFS running on your computer.
+Configure IPFS to enable all this:
+ipfs config --json Experimental.Libp2pStreamMounting true
+
+Usage:
+```
+async def on_message_received(conv, data):
+    print(data)
+
+async with await start_conversation(
+    "my-conv", peer_id, "their-conv-listener", on_message_received
+) as conv:
+    await conv.say(b"Hello there!")
+    async for message in conv:
+        ...
+```
+"""
+import asyncio
+import os
+import shutil
+import traceback
+from datetime import datetime, UTC
+from inspect import isawaitable, signature
+import ipfs_api
+from ipfs_api import _ipfs_host_ip
+import ipfs_datatransmission
+from ipfs_datatransmission import (
+    AESGCMCipher,
+    ChaCha20Poly1305Cipher,
+    CommunicationTimeout,
+    ConvListenTimeout,
+    DataTransmissionError,
+    DecryptionError,
+    InvalidPeer,
+    StreamCipher,
+    UnreadableReply,
+    _BINARY_FRAMES_CAPABILITY,
+    _STREAM_ACCEPTED,
+    _STREAM_REQUEST,
+    _choose_stream_checksum,
+    _pack_stream_ack,
+    _pack_stream_message_header,
+    _parse_stream_accepted_reply,
+    _parse_stream_request,
+    _stream_accepted_reply,
+    _stream_request_suffix,
+    _unpack_stream_ack,
+    _unpack_stream_message,
+    _FRAME_HEADER_MAX_DIGITS,
+    _decode_file_header,
+    _encode_file_header,
+    _encryption_functions,
+    _from_b255_no_0s,
+    _split_by_255,
+    _to_b255_no_0s,
+    _verify_integritybyte,
+)
+
+PRINT_LOG = False  # whether or not to print debug in output terminal
+
+
+# -------------- User Functions ----------------------------------------------
+
+
+async def transmit_data(
+        data: bytes,
+        peer_id: str,
+        req_lis_name: str,
+        timeout_sec: int = None,
+        max_retries: int = None,
+        persistent: bool = False):
+    """
+    Transmits the input data (a bytearray of any length) to the computer with
+    the specified IPFS peer ID.
+    Args:
+        data (bytearray): the data to be transmitted to the receiver
+        peer_id (str): the IPFS peer ID of the recipient
+        req_lis_name (str): the name of the transmission listener on the
+            recipient computer to send the data to
+        timeout_sec (int): connection attempt timeout, multiplied with the
+            maximum number of retries will result in the total time required
+            for a failed attempt
+        max_retries (int): how often the transmission should be reattempted
+            when the timeout is reached
+        persistent (bool): whether to reuse a persistent libp2p stream to the
+            recipient's listener, see `ipfs_datatransmission.transmit_data`
+    Returns:
+        bool: whether or not the transmission succeeded
+    """
+    if timeout_sec is None:
+        timeout_sec = ipfs_datatransmission.TRANSM_SEND_TIMEOUT_SEC
+    if max_retries is None:
+        max_retries = ipfs_datatransmission.TRANSM_REQ_MAX_RETRIES
+    if peer_id == await _run_blocking(ipfs_api.my_id):
+        raise InvalidPeer(
+            message="You cannot use your own IPFS peer ID as the recipient.")
+
+    if persistent:
+        # try twice, in case a previously opened stream has broken down
+        for attempt in range(2):
+            stream = await _get_transmission_stream(
+                peer_id, req_lis_name, timeout_sec, max_retries)
+            if not stream:  # recipient doesn't support persistent streams
+                break
+            try:
+                return await stream.transmit(data, timeout_sec)
+            except _StreamClosed:
+                if attempt == 1:
+                    raise CommunicationTimeout(
+                        "The persistent stream to the peer broke down.")
+
+    their_trsm_port = await _send_transmission_request(
+        peer_id, req_lis_name, timeout_sec, max_retries)
+    reader, writer = await _open_sending_connection(peer_id, their_trsm_port)
+    try:
+        await _send_all(writer, data)
+        response = await asyncio.wait_for(
+            reader.read(ipfs_datatransmission.BUFFER_SIZE), timeout_sec)
+    except asyncio.TimeoutError:
+        raise CommunicationTimeout(
+            "Received no response from peer after transmitting data.") from None
+    finally:
+        writer.close()
+        await _close_sending_connection(writer)
+    if response != b"Finished!":
+        raise UnreadableReply()
+    return True
+
+
+async def close_transmission_streams(peer_id: str = None):
+    """Closes the persistent streams opened by
+    `transmit_data(persistent=True)`.
+    Args:
+        peer_id (str): only close the streams to this peer (default: all)
+    """
+    for key, stream in list(_transmission_streams.items()):
+        if not peer_id or key[0] == peer_id:
+            await stream.close()
+
+
+async def listen_for_transmissions(listener_name, eventhandler=None):
+    """
+    Listens for incoming transmission requests (senders requesting to transmit
+    data to us) and sets up the machinery needed to receive those
+    transmissions.
+    Call `.terminate()` on the returned TransmissionListener object when you
+    no longer need it to clean up IPFS connection configurations.
+
+    Args:
+        listener_name (str): the name of this TransmissionListener
+        eventhandler (function): the function that should be called when a
+            transmission of data is received. Eventhandler calls are made one
+            at a time in the order the transmissions were received.
+            If not specified, the received transmissions can be iterated over
+            with `async for data, peer_id in listener`.
+            Parameters: data (bytearray), peer_id (str)
+    Returns:
+        TransmissionListener: listener object which can be terminated with
+            `.terminate()`
+    """
+    listener = TransmissionListener(listener_name, eventhandler)
+    await listener.start()
+    return listener
+
+
+class TransmissionListener:
+    """
+    Listens for incoming transmission requests (senders requesting to transmit
+    data to us) and sets up the machinery needed to receive those
+    transmissions.
+    Call `.terminate()` on TransmissionListener objects when you no longer
+    need them to clean up IPFS connection configurations.
+    """
+    _terminate = False
+
+    def __init__(self, listener_name, eventhandler=None):
+        """
+        Args:
+            listener_name (str): the name of this TransmissionListener
+            eventhandler (function): the function that should be called when
+                a transmission of data is received.
+                Parameters: data (bytearray), peer_id (str)
+        """
+        self._listener_name = listener_name
+        self.eventhandler = eventhandler
+        self.port = 0  # not yet set
+        self._server = None
+        self._route = None  # our handler in ipfs_datatransmission's demultiplexer
+        self._streams = set()  # writers of persistent streams we serve
+        # received transmissions, delivered in order by self._deliver()
+        self._received = asyncio.Queue()
+        self._delivery = None
+
+    async def start(self):
+        """Start listening for transmission requests."""
+        if ipfs_datatransmission.LISTENER_DEMUX:
+            self._route = _demux_handler(self._handle_request)
+            self.port = await _run_blocking(
+                ipfs_datatransmission._demultiplexer.register,
+                self._listener_name, self._route, False)
+        else:
+            self._server = await asyncio.start_server(
+                self._handle_request, await _run_blocking(_ipfs_host_ip), 0)
+            self.port = self._server.sockets[0].getsockname()[1]
+            await _run_blocking(
+                ipfs_datatransmission._create_listening_connection,
+                self._listener_name, self.port)
+        if self.eventhandler:
+            self._delivery = asyncio.create_task(self._deliver())
+        if PRINT_LOG:
+            print(self._listener_name
+                  + ": Listening for transmission requests")
+
+    async def _handle_request(self, reader, writer):
+        try:
+            data, complete = await _recv_frame(
+                reader, ipfs_datatransmission.TRANSM_RECV_TIMEOUT_SEC,
+                ipfs_datatransmission.CONTROL_FRAME_MAX_SIZE)
+        except (UnreadableReply, OSError) as error:
+            if PRINT_LOG:
+                print(self._listener_name + ": " + str(error))
+            writer.close()
+            return
+        if self._terminate:
+            writer.close()
+            return
+        if data[1:1 + len(_STREAM_REQUEST)] == _STREAM_REQUEST:
+            await self._serve_stream(reader, writer, data)
+            return
+        port = await self._receive_transmission_request(data)
+        if port:
+            writer.write(f"Transmission request accepted.{port}".encode())
+        else:
+            writer.write(b"Transmission request not accepted.")
+        await writer.drain()
+        writer.close()
+
+    async def _receive_transmission_request(self, data):
+        """Sets up a server to receive the requested transmission on,
+        returning its port."""
+        data = _verify_integritybyte(data)
+        if data is None:
+            if PRINT_LOG:
+                print(self._listener_name
+                      + ": Received a buffer with a non-matching integrity buffer")
+            return None
+        try:
+            peer_id = data.decode()
+        except UnicodeDecodeError:
+            if PRINT_LOG:
+                print(self._listener_name
+                      + ": Could not decode transmission request.")
+            return None
+        server = None
+        port = None
+        received = False
+
+        async def close():
+            if not server:  # route in the demultiplexer, which expires
+                return
+            server.close()
+            await _run_blocking(
+                ipfs_datatransmission._close_listening_connection,
+                str(port), port)
+
+        async def receive_transmission(reader, writer):
+            nonlocal received
+            if received:    # only one transmission per request
+                writer.close()
+                return
+            received = True
+            data, complete = await _recv_frame(
+                reader, ipfs_datatransmission.TRANSM_RECV_TIMEOUT_SEC)
+            # enqueue before acknowledging to preserve the order of delivery
+            self._on_received(data, peer_id)
+            writer.write(b"Finished!")
+            await writer.drain()
+            writer.close()
+            await close()
+
+        async def close_if_unused():
+            await asyncio.sleep(
+                2 * ipfs_datatransmission.TRANSM_RECV_TIMEOUT_SEC)
+            if not received:
+                await close()
+
+        if ipfs_datatransmission.LISTENER_DEMUX:
+            return await _run_blocking(
+                ipfs_datatransmission._demultiplexer.register_once,
+                _demux_handler(receive_transmission),
+                2 * ipfs_datatransmission.TRANSM_RECV_TIMEOUT_SEC, False)
+        server = await asyncio.start_server(
+            receive_transmission, await _run_blocking(_ipfs_host_ip), 0)
+        port = server.sockets[0].getsockname()[1]
+        await _run_blocking(ipfs_datatransmission._create_listening_connection,
+                            str(port), port)
+        _create_task(close_if_unused())
+        return port
+
+    async def _serve_stream(self, reader, writer, data):
+        """Receives the transmissions multiplexed on a persistent stream,
+        acknowledging each one."""
+        data = _verify_integritybyte(data)
+        if data is None:
+            writer.close()
+            return
+        peer_id, checksums = _parse_stream_request(data)
+        checksum = _choose_stream_checksum(checksums)
+        writer.write(_stream_accepted_reply(checksum))
+        await writer.drain()
+        self._streams.add(writer)
+        try:
+            while not self._terminate:
+                frame, complete = await _recv_frame(reader)
+                if not complete:   # sender closed the stream
+                    break
+                msg_id, data, intact = _unpack_stream_message(frame, checksum)
+                if intact:
+                    self._on_received(data, peer_id)
+                await _send_all(writer,
+                                _pack_stream_ack(msg_id, checksum, intact))
+        except (UnreadableReply, OSError):
+            pass
+        self._streams.discard(writer)
+        writer.close()
+
+    def _on_received(self, data, peer_id):
+        self._received.put_nowait((data, peer_id))
+
+    async def _deliver(self):
+        """Calls the eventhandler for each received transmission in turn."""
+        while True:
+            data, peer_id = await self._received.get()
+            await _call_eventhandler(self.eventhandler, data, peer_id)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        """Returns the next received transmission as (data, peer_id)."""
+        if self._terminate:
+            raise StopAsyncIteration
+        item = await self._received.get()
+        if item is None:    # terminated
+            raise StopAsyncIteration
+        return item
+
+    async def terminate(self):
+        """Stop listening for transmissions and clean up IPFS connection
+        configurations."""
+        if self._terminate:
+            return
+        self._terminate = True
+        self._received.put_nowait(None)  # stop iterators
+        if self._delivery:
+            self._delivery.cancel()
+        for writer in list(self._streams):
+            writer.close()
+        if self._route:
+            ipfs_datatransmission._demultiplexer.unregister(
+                self._listener_name, self._route)
+            return
+        if not self._server:
+            return
+        self._server.close()
+        await _run_blocking(ipfs_datatransmission._close_listening_connection,
+                            self._listener_name, self.port)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.terminate()
+
+
+async def start_conversation(conv_name,
+                             peer_id,
+                             others_req_listener,
+                             data_received_eventhandler=None,
+                             file_eventhandler=None,
+                             file_progress_callback=None,
+                             encryption_callbacks=None,
+                             timeout_sec=None,
+                             max_retries=None,
+                             dir=".",
+                             persistent=False):
+    """Starts a conversation object with which 2 peers can repetatively make
+    data transmissions to each other asynchronously and bidirectionally.
+    See `ipfs_datatransmission.start_conversation` for the parameters.
+    Use the returned Conversation object as an async context manager or call
+    `await .terminate()` when you no longer need it to clean up IPFS
+    connection configurations.
+    Returns:
+        Conversation: an object through which messages and files can be sent
+    """
+    conv = Conversation()
+    await conv.start(conv_name,
+                     peer_id,
+                     others_req_listener,
+                     data_received_eventhandler,
+                     file_eventhandler=file_eventhandler,
+                     file_progress_callback=file_progress_callback,
+                     encryption_callbacks=encryption_callbacks,
+                     transm_send_timeout_sec=timeout_sec,
+                     transm_req_max_retries=max_retries,
+                     dir=dir,
+                     persistent=persistent
+                     )
+    return conv
+
+
+async def join_conversation(conv_name,
+                            peer_id,
+                            others_req_listener,
+                            data_received_eventhandler=None,
+                            file_eventhandler=None,
+                            file_progress_callback=None,
+                            encryption_callbacks=None,
+                            timeout_sec=None,
+                            max_retries=None,
+                            dir=".",
+                            persistent=False):
+    """Join a conversation object started by another peer.
+    See `ipfs_datatransmission.join_conversation` for the parameters.
+    Returns:
+        Conversation: an object through which messages and files can be sent
+    """
+    conv = Conversation()
+    await conv.join(conv_name,
+                    peer_id,
+                    others_req_listener,
+                    data_received_eventhandler,
+                    file_eventhandler=file_eventhandler,
+                    file_progress_callback=file_progress_callback,
+                    encryption_callbacks=encryption_callbacks,
+                    transm_send_timeout_sec=timeout_sec,
+                    transm_req_max_retries=max_retries,
+                    dir=dir,
+                    persistent=persistent
+                    )
+    return conv
+
+
+async def listen_for_conversations(listener_name: str, eventhandler=None):
+    """
+    Listen for incoming conversation requests.
+    Whenever a new conversation request is received, the specified eventhandler
+    is called which must then decide whether or not to join the conversation,
+    and then act upon that decision.
+    Args:
+        listener_name (str): the name which this ConversationListener should
+                        have (becomes its IPFS Libp2pStreamMounting protocol)
+        eventhandler (function): the function to be called when a conversation
+                        request is received. If not specified, the requests
+                        can be iterated over with
+                        `async for conv_name, peer_id in listener`.
+                        Parameters: (conv_name:str, peer_id:str)
+    Returns:
+        ConversationListener: an object which listens for incoming conversation
+                                requests
+    """
+    listener = ConversationListener(listener_name, eventhandler)
+    await listener.start()
+    return listener
+
+
+class Conversation:
+    """Communication object which allows 2 peers to repetatively make
+    data transmissions to each other asynchronously and bidirectionally.
+    Iterate over it with `async for data in conversation` to receive messages.
+    """
+    conv_name = ""
+    peer_id = ""
+    _transm_send_timeout_sec = None
+    _transm_req_max_retries = None
+    _persistent = False
+    _peer_binary_frames = False  # whether the peer understands binary frames
+    _listener = None
+    _encryption_callback = None
+    _decryption_callback = None
+    _terminate = False
+
+    def __init__(self):
+        self.started = asyncio.Event()
+        self._conversation_started = False
+        self.data_received_eventhandler = None
+        self.file_listener = None
+        self.file_eventhandler = None
+        self.file_progress_callback = None
+        self.message_queue = asyncio.Queue()
+        self._file_queue = asyncio.Queue()
+        self._last_coms_time = datetime.now(UTC)
+
+    def _configure(self, conv_name, peer_id, data_received_eventhandler,
+                   file_eventhandler, file_progress_callback,
+                   encryption_callbacks, transm_send_timeout_sec,
+                   transm_req_max_retries, persistent):
+        self.conv_name = conv_name
+        self.peer_id = peer_id
+        self.data_received_eventhandler = data_received_eventhandler
+        self.file_eventhandler = file_eventhandler
+        self.file_progress_callback = file_progress_callback
+        if encryption_callbacks:
+            (self._encryption_callback,
+             self._decryption_callback) = _encryption_functions(
+                encryption_callbacks)
+        if transm_send_timeout_sec is None:
+            transm_send_timeout_sec = (
+                ipfs_datatransmission.TRANSM_SEND_TIMEOUT_SEC)
+        if transm_req_max_retries is None:
+            transm_req_max_retries = (
+                ipfs_datatransmission.TRANSM_REQ_MAX_RETRIES)
+        self._transm_send_timeout_sec = transm_send_timeout_sec
+        self._transm_req_max_retries = transm_req_max_retries
+        self._persistent = persistent
+
+    async def _start_listeners(self, dir, encryption_callbacks):
+        self._listener = await listen_for_transmissions(self.conv_name,
+                                                        self._hear)
+        self.file_listener = await listen_for_file_transmissions(
+            f"{self.conv_name}:files",
+            self._file_received,
+            progress_handler=self._on_file_progress_received,
+            dir=dir,
+            encryption_callbacks=encryption_callbacks
+        )
+
+    async def start(self,
+                    conv_name,
+                    peer_id,
+                    others_req_listener,
+                    data_received_eventhandler=None,
+                    file_eventhandler=None,
+                    file_progress_callback=None,
+                    encryption_callbacks=None,
+                    transm_send_timeout_sec=None,
+                    transm_req_max_retries=None,
+                    dir=".",
+                    persistent=False):
+        """Initialises this conversation object so that it can be used,
+        returning when the other peer joins the conversation.
+        See `ipfs_datatransmission.Conversation.start` for the parameters.
+        """
+        if peer_id == await _run_blocking(ipfs_api.my_id):
+            raise InvalidPeer(
+                message="You cannot use your own IPFS peer ID as your conversation partner.")
+        self._configure(conv_name, peer_id, data_received_eventhandler,
+                        file_eventhandler, file_progress_callback,
+                        encryption_callbacks, transm_send_timeout_sec,
+                        transm_req_max_retries, persistent)
+        await self._start_listeners(dir, encryption_callbacks)
+        data = bytearray("I want to start a conversation".encode(
+            'utf-8')) + bytearray([255]) + bytearray(conv_name.encode('utf-8'))
+        try:
+            await transmit_data(data,
+                                peer_id,
+                                others_req_listener,
+                                self._transm_send_timeout_sec,
+                                self._transm_req_max_retries,
+                                persistent=self._persistent
+                                )
+            self._last_coms_time = datetime.now(UTC)
+            await asyncio.wait_for(self.started.wait(),
+                                   self._transm_send_timeout_sec)
+        except asyncio.TimeoutError:
+            await self.terminate()
+            raise CommunicationTimeout(
+                f"Successfully transmitted conversation request but received no reply within timeout of {self._transm_send_timeout_sec}s.") from None
+        except Exception:
+            await self.terminate()
+            raise
+        return True     # signal success
+
+    async def join(self,
+                   conv_name,
+                   peer_id,
+                   others_trsm_listener,
+                   data_received_eventhandler=None,
+                   file_eventhandler=None,
+                   file_progress_callback=None,
+                   encryption_callbacks=None,
+                   transm_send_timeout_sec=None,
+                   transm_req_max_retries=None,
+                   dir=".",
+                   persistent=False):
+        """Joins a conversation which another peer started, given their peer
+        ID and conversation's transmission-listener's name.
+        See `ipfs_datatransmission.Conversation.join` for the parameters.
+        """
+        self._configure(conv_name, peer_id, data_received_eventhandler,
+                        file_eventhandler, file_progress_callback,
+                        encryption_callbacks, transm_send_timeout_sec,
+                        transm_req_max_retries, persistent)
+        await self._start_listeners(dir, encryption_callbacks)
+        self.others_trsm_listener = others_trsm_listener
+        data = bytearray("I'm listening".encode(
+            'utf-8')) + bytearray([255]) + bytearray(conv_name.encode('utf-8'))
+        data += bytearray([255]) + _BINARY_FRAMES_CAPABILITY
+        self._conversation_started = True
+        await transmit_data(data, peer_id, others_trsm_listener,
+                            persistent=self._persistent)
+        self._last_coms_time = datetime.now(UTC)
+        return True  # signal success
+
+    async def _hear(self, data, peer_id):
+        """
+        Receives this conversation's data transmissions.
+        Forwards it to the user's data_received_eventhandler if the
+        conversation has already started,
+        otherwise processes the conversation initiation codes.
+        """
+        if self._terminate or not data:
+            return
+        self._last_coms_time = datetime.now(UTC)
+
+        if not self._conversation_started:
+            info = _split_by_255(data)
+            if bytearray(info[0]) == bytearray("I'm listening".encode('utf-8')):
+                self.others_trsm_listener = info[1].decode('utf-8')
+                self._peer_binary_frames = _BINARY_FRAMES_CAPABILITY in info[2:]
+                self._conversation_started = True
+                self.started.set()
+            elif PRINT_LOG:
+                print(self.conv_name +
+                      ": received unrecognisable buffer, expected join confirmation")
+            return
+        if self._decryption_callback:
+            data = self._decryption_callback(data)
+        self.message_queue.put_nowait(data)
+        if self.data_received_eventhandler:
+            await _call_eventhandler(self.data_received_eventhandler,
+                                     self, data)
+
+    async def listen(self, timeout=None):
+        """Waits until the conversation peer sends a message, then returns
+        that message.
+        Args:
+            timeout (int): how many seconds to wait until giving up and
+                            raising an exception
+        Returns:
+            bytearray: received data, None if the conversation was terminated
+        """
+        if self._terminate:
+            return None
+        try:
+            return await asyncio.wait_for(self.message_queue.get(), timeout)
+        except asyncio.TimeoutError:
+            raise ConvListenTimeout("Didn't receive any data.") from None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        """Returns the next message received in this conversation."""
+        data = await self.listen()
+        if data is None:
+            raise StopAsyncIteration
+        return data
+
+    async def _file_received(self, peer, filepath, metadata):
+        """Receives this conversation's file transmissions."""
+        self._last_coms_time = datetime.now(UTC)
+        self._file_queue.put_nowait(
+            {'filepath': filepath, 'metadata': metadata})
+        if self.file_eventhandler:
+            await _call_eventhandler(self.file_eventhandler,
+                                     self, filepath, metadata)
+
+    async def listen_for_file(self, abs_timeout=None, no_coms_timeout=None):
+        """
+        Args:
+            abs_timeout (int): how many seconds to wait for file reception to
+                finish until giving up and raising an exception
+            no_coms_timeout (int): how many seconds of no signal from peer
+                until giving up and raising an exception
+        Returns:
+            dict: the path (key 'filepath') and metadata (key 'metadata') of
+                the received file, None if the conversation was terminated
+        """
+        start_time = datetime.now(UTC)
+        while not self._terminate:
+            timeouts = []
+            if abs_timeout:
+                timeouts.append(
+                    abs_timeout - (datetime.now(UTC) - start_time).total_seconds())
+            if no_coms_timeout:
+                timeouts.append(
+                    no_coms_timeout - (datetime.now(UTC) - self._last_coms_time).total_seconds())
+            try:
+                return await asyncio.wait_for(
+                    self._file_queue.get(),
+                    max(min(timeouts), 0) if timeouts else None)
+            except asyncio.TimeoutError:
+                if abs_timeout and (datetime.now(UTC) - start_time).total_seconds() > abs_timeout:
+                    raise ConvListenTimeout(
+                        "Didn't receive any files.") from None
+                elif (datetime.now(UTC) - self._last_coms_time).total_seconds() > no_coms_timeout:
+                    raise CommunicationTimeout(
+                        "Communication timeout reached while waiting for file.") from None
+        return None
+
+    async def files(self):
+        """Async iterator over the files received in this conversation,
+        yielding a dict with the keys 'filepath' and 'metadata' for each."""
+        while True:
+            file = await self.listen_for_file()
+            if file is None:
+                return
+            yield file
+
+    async def _on_file_progress_received(self, peer_id: str, filename: str,
+                                         filesize: str, progress):
+        self._last_coms_time = datetime.now(UTC)
+        if self.file_progress_callback:
+            await call_progress_callback(self.file_progress_callback, peer_id,
+                                         filename, filesize, progress)
+
+    async def say(self,
+                  data,
+                  timeout_sec=None,
+                  max_retries=None
+                  ):
+        """
+        Transmits the provided data (a bytearray of any length) to this
+        conversation's peer.
+        Args:
+            bytearray data: the data to be transmitted to the receiver
+            timeout_sec: connection attempt timeout, multiplied with the
+                        maximum number of retries will result in the
+                        total time required for a failed attempt
+            max_retries: how often the transmission should be reattempted
+                        when the timeout is reached
+        Returns:
+            bool success: whether or not the transmission succeeded
+        """
+        await self.started.wait() if not self._conversation_started else None
+        if self._encryption_callback:
+            data = self._encryption_callback(data)
+        await transmit_data(data, self.peer_id, self.others_trsm_listener,
+                            timeout_sec, max_retries,
+                            persistent=self._persistent)
+        self._last_coms_time = datetime.now(UTC)
+        return True
+
+    async def transmit_file(self,
+                            filepath,
+                            metadata=bytearray(),
+                            progress_handler=None,
+                            block_size=None,
+                            transm_send_timeout_sec=None,
+                            transm_req_max_retries=None
+                            ):
+        """
+        Transmits the provided file to the other computer in this
+        conversation, returning when the transmission is finished.
+        """
+        await self.started.wait() if not self._conversation_started else None
+
+        async def _progress_handler(peer_id, filename, filesize, progress):
+            self._last_coms_time = datetime.now(UTC)
+            if progress_handler:
+                await call_progress_callback(progress_handler, peer_id,
+                                             filename, filesize, progress)
+        encryption_callbacks = None
+        if self._encryption_callback:
+            encryption_callbacks = (self._encryption_callback,
+                                    self._decryption_callback)
+        return await transmit_file(
+            filepath,
+            self.peer_id,
+            f"{self.others_trsm_listener}:files",
+            metadata,
+            _progress_handler,
+            encryption_callbacks=encryption_callbacks,
+            block_size=block_size,
+            transm_send_timeout_sec=transm_send_timeout_sec,
+            transm_req_max_retries=transm_req_max_retries,
+            persistent=self._persistent)
+
+    async def terminate(self):
+        """Stop the conversation and clean up IPFS connection configurations.
+        """
+        if self._terminate:
+            return
+        self._terminate = True
+        self.message_queue.put_nowait(None)  # stop iterators
+        self._file_queue.put_nowait(None)
+        if self._listener:
+            await self._listener.terminate()
+        if self.file_listener:
+            await self.file_listener.terminate()
+        if self._persistent and self._conversation_started:
+            stream = _transmission_streams.get(
+                (self.peer_id, self.others_trsm_listener))
+            if stream:
+                await stream.close()
+
+    async def close(self):
+        """Stop the conversation and clean up IPFS connection configurations.
+        """
+        await self.terminate()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.terminate()
+
+
+class ConversationListener:
+    """
+    Object which listens to incoming conversation requests.
+    Whenever a new conversation request is received, the specified eventhandler
+    is called which must then decide whether or not to join the conversation,
+    and then act upon that decision.
+    """
+
+    def __init__(self, listener_name, eventhandler=None):
+        self._listener_name = listener_name
+        self.eventhandler = eventhandler
+        self._listener = TransmissionListener(listener_name,
+                                              self._on_request_received)
+        self._requests = asyncio.Queue()
+
+    async def start(self):
+        await self._listener.start()
+
+    async def _on_request_received(self, data, peer_id):
+        info = _split_by_255(data)
+        if info[0] == bytearray("I want to start a conversation".encode('utf-8')):
+            conv_name = info[1].decode('utf-8')
+            if self.eventhandler:
+                await _call_eventhandler(self.eventhandler, conv_name, peer_id)
+            else:
+                self._requests.put_nowait((conv_name, peer_id))
+        elif PRINT_LOG:
+            print(f"ConvLisReceived {self._listener_name}: Received unreadable request")
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        """Returns the next conversation request as (conv_name, peer_id)."""
+        item = await self._requests.get()
+        if item is None:    # terminated
+            raise StopAsyncIteration
+        return item
+
+    async def terminate(self):
+        """Stop listening for conversation requests and clean up IPFS
+        connection configurations.
+        """
+        self._requests.put_nowait(None)
+        await self._listener.terminate()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.terminate()
+
+
+async def transmit_file(filepath,
+                        peer_id,
+                        others_req_listener,
+                        metadata=bytearray(),
+                        progress_handler=None,
+                        encryption_callbacks=None,
+                        block_size=None,
+                        transm_send_timeout_sec=None,
+                        transm_req_max_retries=None,
+                        persistent=False
+                        ):
+    """Transmits the provided file to the specified peer, returning when the
+    transmission is finished.
+    See `ipfs_datatransmission.transmit_file` for the parameters.
+    Returns:
+        bool: True (signal success)
+    """
+    if block_size is None:
+        block_size = ipfs_datatransmission.BLOCK_SIZE
+    if transm_send_timeout_sec is None:
+        transm_send_timeout_sec = ipfs_datatransmission.TRANSM_SEND_TIMEOUT_SEC
+    filename = os.path.basename(filepath)
+    filesize = os.path.getsize(filepath)
+
+    async def report_progress(progress):
+        if progress_handler:
+            await call_progress_callback(progress_handler, peer_id, filename,
+                                         filesize, progress)
+
+    conversation = Conversation()
+    await conversation.start(
+        filename + "_conv",
+        peer_id,
+        others_req_listener,
+        encryption_callbacks=encryption_callbacks,
+        transm_send_timeout_sec=transm_send_timeout_sec,
+        transm_req_max_retries=transm_req_max_retries,
+        persistent=persistent
+    )
+    try:
+        await conversation.say(_encode_file_header(
+            filesize, filename, metadata,
+            binary=conversation._peer_binary_frames))
+        await report_progress(0)
+        reply = await conversation.listen(transm_send_timeout_sec)
+        if _split_by_255(reply)[0].decode('utf-8') != "ready":
+            raise UnreadableReply()
+        position = 0
+        with open(filepath, "rb") as reader:
+            while position < filesize:
+                data = await _run_blocking(
+                    reader.read, min(block_size, filesize - position))
+                position += len(data)
+                await conversation.say(data)
+                await report_progress(position / filesize)
+    finally:
+        await conversation.terminate()
+    return True
+
+
+async def listen_for_file_transmissions(listener_name,
+                                        eventhandler,
+                                        progress_handler=None,
+                                        dir=".",
+                                        encryption_callbacks=None):
+    """Listens to incoming file transmission requests.
+    Whenever a file is received, the specified eventhandler is called.
+    Call `await .terminate()` on the returned ConversationListener object when
+    you no longer need it to clean up IPFS connection configurations.
+    See `ipfs_datatransmission.listen_for_file_transmissions` for the
+    parameters.
+    Returns:
+        ConversationListener: an object which listens for incoming file
+                            requests
+    """
+    async def request_handler(conv_name, peer_id):
+        receiver = FileTransmissionReceiver(eventhandler, progress_handler, dir)
+        receiver.conv = Conversation()
+        await receiver.conv.join(conv_name,
+                                 peer_id,
+                                 conv_name,
+                                 receiver.on_data_received,
+                                 encryption_callbacks=encryption_callbacks
+                                 )
+
+    return await listen_for_conversations(listener_name, request_handler)
+
+
+class FileTransmissionReceiver:
+    """Object for receiving a file transmission (after a file transmission
+    request hast been received and accepted)
+    """
+    transmission_started = False
+    writtenbytes = 0
+    status = "receiving"  # "finished"
+
+    def __init__(self, eventhandler, progress_handler=None, dir="."):
+        self.eventhandler = eventhandler
+        self.progress_handler = progress_handler
+        self.dir = dir
+        self.conv = None
+        self.writer = None
+
+    async def _report_progress(self, progress):
+        if self.progress_handler:
+            await call_progress_callback(self.progress_handler,
+                                         self.conv.peer_id, self.filename,
+                                         self.filesize, progress)
+
+    async def on_data_received(self, conv, data):
+        if not self.transmission_started:
+            try:
+                self.filesize, self.filename, self.metadata, _ = \
+                    _decode_file_header(data)
+            except (ValueError, UnicodeDecodeError, UnreadableReply):
+                if PRINT_LOG:
+                    print("Received unreadable data on FileTransmissionListener ")
+                return
+            self.writer = open(os.path.join(
+                self.dir, self.filename + ".PART"), "wb")
+            self.transmission_started = True
+            await self._report_progress(0)
+            if self.filesize == 0:
+                await self.finish()
+            else:
+                await self.conv.say("ready".encode())
+            return
+
+        await _run_blocking(self.writer.write, data)
+        self.writtenbytes += len(data)
+        await self._report_progress(self.writtenbytes / self.filesize)
+        if self.writtenbytes == self.filesize:
+            await self.finish()
+        elif self.writtenbytes > self.filesize:
+            self.writer.close()
+            raise UnreadableReply(
+                "Something weird happened, filesize is larger than expected.")
+
+    async def finish(self):
+        self.writer.close()
+        shutil.move(os.path.join(self.dir, self.filename + ".PART"),
+                    os.path.join(self.dir, self.filename))
+        self.status = "finished"
+        await self.conv.close()
+        if self.eventhandler:
+            filepath = os.path.abspath(os.path.join(self.dir, self.filename))
+            if len(signature(self.eventhandler).parameters) == 3:
+                await _call_eventhandler(self.eventhandler, self.conv.peer_id,
+                                         filepath, self.metadata)
+            else:
+                await _call_eventhandler(self.eventhandler, self.conv.peer_id,
+                                         filepath)
+
+    async def terminate(self):
+        await self.conv.terminate()
+
+
+async def call_progress_callback(callback, peer_id, filename, filesize,
+                                 progress):
+    """Calls the specified callback function with part of all of the rest of
+    the parameters, depending on how many parameters the callback takes.
+    The callback can take between 1 and 4 parameters and can be a coroutine
+    function."""
+    n_params = len(signature(callback).parameters)
+    args = [(progress,), (filename, progress), (filename, filesize, progress),
+            (peer_id, filename, filesize, progress)][n_params - 1]
+    await _call_eventhandler(callback, *args)
+
+
+# ----- Persistent Streams -----------------------------------------------------
+_transmission_streams = dict()  # (peer_id, req_lis_name): _TransmissionStream
+_transmission_stream_locks = dict()  # (peer_id, req_lis_name): asyncio.Lock
+_transmission_streams_unsupported = set()
+
+
+class _StreamClosed(Exception):
+    """Is raised when a persistent stream breaks down during a transmission."""
+
+
+async def _get_transmission_stream(peer_id, req_lis_name, timeout_sec,
+                                   max_retries):
+    """Returns the persistent stream to the specified peer's listener,
+    opening it if it doesn't exist yet.
+    Returns None if the peer doesn't support persistent streams."""
+    key = (peer_id, req_lis_name)
+    stream = _transmission_streams.get(key)
+    if stream and not stream.closed:
+        return stream
+    if key in _transmission_streams_unsupported:
+        return None
+    # only one task should open the stream
+    async with _transmission_stream_locks.setdefault(key, asyncio.Lock()):
+        stream = _transmission_streams.get(key)
+        if stream and not stream.closed:
+            return stream
+        stream = await _open_transmission_stream(
+            peer_id, req_lis_name, timeout_sec, max_retries)
+        if stream:
+            _transmission_streams[key] = stream
+        else:
+            _transmission_streams_unsupported.add(key)
+        return stream
+
+
+async def _open_transmission_stream(peer_id, req_lis_name, timeout_sec,
+                                    max_retries):
+    """Opens a persistent stream to the specified peer's listener.
+    Returns None if the peer doesn't support persistent streams."""
+    request_data = ipfs_datatransmission.__add_integritybyte_to_buffer(
+        _STREAM_REQUEST + (await _run_blocking(ipfs_api.my_id)).encode()
+        + _stream_request_suffix())
+    tries = 0
+    while max_retries == -1 or tries < max_retries:
+        tries += 1
+        reader, writer = await _open_sending_connection(peer_id, req_lis_name)
+        # closing the port-forwarding only stops it from accepting
+        # new connections, the established stream stays open
+        await _close_sending_connection(writer)
+        try:
+            await _send_all(writer, request_data)
+            reply = await asyncio.wait_for(
+                reader.read(ipfs_datatransmission.BUFFER_SIZE), timeout_sec)
+        except (OSError, asyncio.TimeoutError):
+            writer.close()
+            continue
+        if reply.startswith(_STREAM_ACCEPTED):
+            return _TransmissionStream(peer_id, req_lis_name, reader, writer,
+                                       _parse_stream_accepted_reply(reply))
+        writer.close()
+        if reply.startswith(b"Transmission request"):
+            return None
+    raise CommunicationTimeout(
+        "Received no response from peer while opening persistent stream.")
+
+
+class _TransmissionStream:
+    """A persistent libp2p stream to a peer's TransmissionListener, over which
+    many transmissions are multiplexed.
+    See `ipfs_datatransmission._TransmissionStream`.
+    """
+
+    def __init__(self, peer_id, req_lis_name, reader, writer, checksum=None):
+        self.peer_id = peer_id
+        self.req_lis_name = req_lis_name
+        self.reader = reader
+        self.writer = writer
+        self.checksum = checksum
+        self.closed = False
+        self._pending = dict()  # msg_id: Future, for unacknowledged messages
+        self._next_msg_id = 0
+        self._reader_task = asyncio.create_task(
+            self._read_acknowledgements())
+
+    async def transmit(self, data, timeout_sec=None):
+        """Transmits the given data over this stream, returning when the
+        receiver acknowledges it.
+        Returns:
+            bool: True (signal success)
+        """
+        if timeout_sec is None:
+            timeout_sec = ipfs_datatransmission.TRANSM_SEND_TIMEOUT_SEC
+        if await self._transmit(data, timeout_sec):
+            return True
+        if await self._transmit(data, timeout_sec):  # retry once
+            return True
+        raise DataTransmissionError(
+            "The transmitted data arrived corrupted at the peer.")
+
+    async def _transmit(self, data, timeout_sec):
+        """Transmits the given data as a single message, returning when the
+        receiver acknowledges it.
+        Returns:
+            bool: whether the receiver reported the message as intact
+        """
+        if self.closed:
+            raise _StreamClosed()
+        msg_id = self._next_msg_id
+        self._next_msg_id = (self._next_msg_id + 1) % 2**32
+        acknowledged = asyncio.get_running_loop().create_future()
+        self._pending[msg_id] = acknowledged
+        try:
+            await _send_all(self.writer, data,
+                            prefix=_pack_stream_message_header(
+                                msg_id, data, self.checksum))
+            return await asyncio.wait_for(acknowledged, timeout_sec)
+        except OSError:
+            await self.close()
+            raise _StreamClosed()
+        except asyncio.TimeoutError:
+            raise CommunicationTimeout(
+                "Received no acknowledgement from peer for transmission on persistent stream.") from None
+        finally:
+            self._pending.pop(msg_id, None)
+
+    async def _read_acknowledgements(self):
+        while True:
+            try:
+                frame, complete = await _recv_frame(
+                    self.reader,
+                    max_size=ipfs_datatransmission.CONTROL_FRAME_MAX_SIZE)
+            except (UnreadableReply, OSError):
+                break
+            if not complete:   # stream has been closed
+                break
+            msg_id, intact = _unpack_stream_ack(frame, self.checksum)
+            acknowledged = self._pending.get(msg_id)
+            if acknowledged and not acknowledged.done():
+                acknowledged.set_result(intact)
+        await self.close()
+
+    async def close(self):
+        """Closes this stream, failing any unacknowledged transmissions."""
+        if self.closed:
+            return
+        self.closed = True
+        self.writer.close()
+        for acknowledged in self._pending.values():
+            if not acknowledged.done():
+                acknowledged.set_exception(_StreamClosed())
+        key = (self.peer_id, self.req_lis_name)
+        if _transmission_streams.get(key) is self:
+            _transmission_streams.pop(key)
+
+
+# ----- Utilities --------------------------------------------------------------
+_tasks = set()  # references to running tasks, so they aren't garbage-collected
+
+
+def _create_task(coroutine):
+    task = asyncio.create_task(coroutine)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+
+async def _run_blocking(function, *args):
+    """Runs a blocking function, such as a call to the IPFS daemon's HTTP API,
+    in the event loop's default executor."""
+    return await asyncio.get_running_loop().run_in_executor(None, function,
+                                                            *args)
+
+
+async def _call_eventhandler(eventhandler, *args):
+    """Calls the given eventhandler, awaiting it if it is a coroutine function,
+    printing instead of raising any exceptions it throws."""
+    try:
+        result = eventhandler(*args)
+        if isawaitable(result):
+            await result
+    except Exception:
+        print("ipfs_datatransmission_async: Exception in eventhandler:")
+        traceback.print_exc()
+
+
+async def _send_transmission_request(peer_id, req_lis_name, timeout_sec,
+                                     max_retries):
+    """Sends a transmission request to the recipient, returning the name of
+    the port the recipient is waiting for the transmission on."""
+    request_data = ipfs_datatransmission.__add_integritybyte_to_buffer(
+        (await _run_blocking(ipfs_api.my_id)).encode())
+    tries = 0
+    while max_retries == -1 or tries < max_retries:
+        tries += 1
+        reader, writer = await _open_sending_connection(peer_id, req_lis_name)
+        try:
+            await _send_all(writer, request_data)
+            reply = await asyncio.wait_for(
+                reader.read(ipfs_datatransmission.BUFFER_SIZE), timeout_sec)
+        except asyncio.TimeoutError:
+            raise CommunicationTimeout(
+                "Received no response from peer while sending transmission request.") from None
+        finally:
+            writer.close()
+            await _close_sending_connection(writer)
+        if reply:
+            their_trsm_port = reply[30:].decode()
+            if not their_trsm_port:
+                raise UnreadableReply()
+            return their_trsm_port
+    raise CommunicationTimeout(
+        "Received no response from peer while sending transmission request.")
+
+
+def _demux_handler(handler):
+    """Returns a handler for ipfs_datatransmission's demultiplexer, which
+    serves the connections passed to it on the running event loop, with the
+    given coroutine function like `asyncio.start_server()` does."""
+    loop = asyncio.get_running_loop()
+
+    async def serve(sock):
+        sock.setblocking(False)
+        reader, writer = await asyncio.open_connection(sock=sock)
+        await handler(reader, writer)
+
+    return lambda sock: loop.call_soon_threadsafe(_create_task, serve(sock))
+
+
+async def _open_sending_connection(peer_id, protocol):
+    """Sets up a libp2p port-forwarding to the specified peer's listener
+    (see `ipfs_datatransmission._connect_to_listener`) and connects to it.
+    Returns:
+        tuple(asyncio.StreamReader, asyncio.StreamWriter): the connection
+    """
+    sock = await _run_blocking(ipfs_datatransmission._connect_to_listener,
+                               peer_id, protocol)
+    sock.setblocking(False)
+    return await asyncio.open_connection(sock=sock)
+
+
+async def _close_sending_connection(writer):
+    """Closes the libp2p port-forwarding the given connection was made through.
+    Unlike closing it by peer ID and protocol, this doesn't interfere with
+    other concurrent transmissions to the same protocol.
+    """
+    port = writer.get_extra_info("peername")[1]
+    await _run_blocking(
+        lambda: ipfs_datatransmission._close_sending_connection(port=port))
+
+
+async def _send_all(writer, data, prefix=b""):
+    """Sends the given data framed like `ipfs_datatransmission._tcp_send_all`.
+    """
+    length = len(prefix) + len(data)
+    header = bytes(_to_b255_no_0s(length) + bytearray([0])) + prefix
+    # send small buffers in a single TCP segment
+    if length <= ipfs_datatransmission.BUFFER_SIZE:
+        writer.write(header + data)
+    else:
+        writer.write(header)
+        writer.write(data)
+    await writer.drain()
+
+
+async def _recv_frame(reader, timeout=None, max_size=None):
+    """Receives a buffer sent with `_send_all` or
+    `ipfs_datatransmission._tcp_send_all`, without reading beyond its end.
+    Args:
+        reader (asyncio.StreamReader): the connection to receive from
+        timeout (float): how many seconds to wait for data until giving up,
+            waiting twice as long for the first data (default: wait forever)
+        max_size (int): the largest length to accept (default: any)
+    Raises:
+        UnreadableReply: if the length header is invalid or exceeds max_size
+    Returns:
+        tuple(bytearray, bool): the received data, and whether it is complete
+    """
+    try:
+        header = await asyncio.wait_for(
+            reader.readuntil(b"\0"), timeout * 2 if timeout else None)
+    except asyncio.IncompleteReadError as error:  # connection closed
+        return bytearray(error.partial), False
+    except (asyncio.LimitOverrunError, asyncio.TimeoutError):
+        return bytearray(), False
+    if len(header) - 1 > _FRAME_HEADER_MAX_DIGITS:
+        raise UnreadableReply(
+            "Received a frame with an invalid length header.")
+    length = _from_b255_no_0s(header[:-1])
+    if max_size is not None and length > max_size:
+        raise UnreadableReply(
+            f"Received a frame of {length} bytes, more than the "
+            f"{max_size} bytes accepted here.")
+    # grows as the data arrives, instead of being preallocated to a length
+    # the peer may never send
+    data = bytearray()
+    while len(data) < length:
+        try:
+            chunk = await asyncio.wait_for(
+                reader.read(length - len(data)), timeout)
+        except asyncio.TimeoutError:
+            break
+        if not chunk:   # connection closed
+            break
+        data += chunk
+    return data, len(data) == length
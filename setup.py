@@ -26,7 +26,8 @@ setuptools.setup(
         "Programming Language :: Python :: 3",
         "Operating System :: OS Independent",
     ],
-    py_modules=['ipfs_api', 'ipfs_datatransmission', 'ipfs_lns',
+    py_modules=['ipfs_api', 'ipfs_datatransmission',
+                'ipfs_datatransmission_async', 'ipfs_lns',
                 'ipfs_cli', 'ipfs_peers', 'IPFS_API', 'IPFS_LNS', 'IPFS_DataTransmission'],
     packages=setuptools.find_packages(),
     python_requires=">=3.6",
@@ -0,0 +1,670 @@
+"""
+Benchmarks for ipfs_datatransmission.
+
+These run two peers in this process, communicating over the local stand-in for
+the IPFS daemon in mock_ipfs_daemon.py, so no IPFS node or Docker is needed.
+Because all traffic stays on localhost, the results measure the overhead of
+ipfs_datatransmission and its interaction with the daemon's HTTP API,
+not the network.
+
+Run this script from the tests directory:
+```
+python3 benchmark_datatransmission.py
+```
+To track performance across changes, save the results as JSON and compare
+later runs against them, which exits with status 1 if any result got worse by
+more than the tolerance (default 20%):
+```
+python3 benchmark_datatransmission.py --json baseline.json
+python3 benchmark_datatransmission.py --json new.json --compare baseline.json
+```
+Run `python3 benchmark_datatransmission.py --help` for further options.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import sys
+import warnings
+from datetime import datetime, UTC
+if True:
+    sys.path.insert(0, "..")
+    import ipfs_api
+    import ipfs_datatransmission
+from mock_ipfs_daemon import MockIpfsDaemon, REMOTE_PEER_ID
+from test_with_mock_daemon import (
+    listen_for_file_transmissions_locally, wait_for)
+
+warnings.filterwarnings("ignore", category=FutureWarning)
+
+N_MESSAGES = 200
+MESSAGE_SIZE = 64
+TRANSMIT_SIZES = [64, 4096, 65536, 1024**2]
+
+daemon = None
+# the latency and bandwidth the mock daemon simulates, see MockIpfsDaemon
+DAEMON_OPTIONS = {}
+
+
+def prepare():
+    global daemon
+    if not daemon:
+        daemon = MockIpfsDaemon(**DAEMON_OPTIONS).start()
+        daemon.connect(ipfs_api)
+
+
+def bench_transmit_data(persistent, n_messages=N_MESSAGES,
+                        message_size=MESSAGE_SIZE):
+    """Measures how many messages per second `transmit_data` achieves, and
+    how long each call takes.
+    Returns:
+        dict: messages/sec, the average, median, 95th percentile and maximum
+            seconds per call, and daemon HTTP requests per message
+    """
+    prepare()
+    received = 0
+
+    def on_received(data, peer_id):
+        nonlocal received
+        received += 1
+    listener = ipfs_datatransmission.listen_for_transmissions(
+        "benchmark", on_received)
+    while not listener.port:
+        time.sleep(0.01)
+    data = bytes(message_size)
+    latencies = []
+    try:
+        http_requests = daemon.http_request_count()
+        start_time = time.perf_counter()
+        for i in range(n_messages):
+            call_time = time.perf_counter()
+            ipfs_datatransmission.transmit_data(
+                data, REMOTE_PEER_ID, "benchmark", persistent=persistent)
+            latencies.append(time.perf_counter() - call_time)
+        # the default pool dispatcher acknowledges messages before their
+        # eventhandler is called
+        assert wait_for(lambda: received == n_messages)
+        duration = time.perf_counter() - start_time
+        http_requests = daemon.http_request_count() - http_requests
+    finally:
+        ipfs_datatransmission.close_transmission_streams()
+        listener.terminate()
+    return {
+        "messages_per_sec": n_messages / duration,
+        **_latency_stats(latencies),
+        "http_requests_per_message": http_requests / n_messages,
+    }
+
+
+def _latency_stats(latencies):
+    latencies = sorted(latencies)
+    return {
+        "latency_avg": sum(latencies) / len(latencies),
+        "latency_p50": latencies[len(latencies) // 2],
+        "latency_p95": latencies[int(len(latencies) * 0.95)],
+        "latency_max": latencies[-1],
+    }
+
+
+def bench_daemon_info_cache(n_messages=N_MESSAGES):
+    """Measures how many HTTP requests to the daemon caching its peer ID and
+    API host (see `ipfs_api.DAEMON_INFO_TTL_SEC`) saves per transmission.
+    Returns:
+        dict: daemon HTTP requests/message without and with the cache, and
+            messages/sec with the cache
+    """
+    try:
+        ipfs_api.DAEMON_INFO_TTL_SEC = 0
+        uncached = bench_transmit_data(False, n_messages)
+    finally:
+        ipfs_api.DAEMON_INFO_TTL_SEC = 300
+    cached = bench_transmit_data(False, n_messages)
+    return {
+        "http_requests_per_message_uncached":
+            uncached["http_requests_per_message"],
+        "http_requests_per_message": cached["http_requests_per_message"],
+        "messages_per_sec_uncached": uncached["messages_per_sec"],
+        "messages_per_sec": cached["messages_per_sec"],
+    }
+
+
+SAY_MESSAGE_SIZES = [64, 512, 4096]
+
+
+def bench_conversation_say(coalesce, message_size=MESSAGE_SIZE,
+                           n_messages=N_MESSAGES, persistent=False):
+    """Measures the throughput and latency of `Conversation.say()` with and
+    without coalescing messages.
+    Returns:
+        dict: messages/sec, the average and maximum seconds from saying a
+            message to its delivery, and how many transmissions were made
+    """
+    prepare()
+    joined = []
+    send_times = []
+    latencies = []
+
+    def on_received(conv, data):
+        latencies.append(time.perf_counter() - send_times[len(latencies)])
+
+    def on_request(conv_name, peer_id):
+        joined.append(ipfs_datatransmission.join_conversation(
+            conv_name + "-joiner", REMOTE_PEER_ID, conv_name, on_received,
+            persistent=persistent))
+    conv_listener = ipfs_datatransmission.listen_for_conversations(
+        "benchmark-conv-listener", on_request)
+    conv = ipfs_datatransmission.start_conversation(
+        "benchmark-conv", REMOTE_PEER_ID, "benchmark-conv-listener",
+        persistent=persistent, coalesce=coalesce)
+    try:
+        assert wait_for(lambda: joined)
+        transmissions = 0
+        listener = joined[0]._listener
+        hear = listener.eventhandler
+
+        def count_transmissions(data, peer_id):
+            nonlocal transmissions
+            transmissions += 1
+            hear(data, peer_id)
+        listener.eventhandler = count_transmissions
+        data = bytes(message_size)
+        start_time = time.perf_counter()
+        for i in range(n_messages):
+            send_times.append(time.perf_counter())
+            conv.say(data)
+        assert wait_for(lambda: len(latencies) == n_messages)
+        duration = time.perf_counter() - start_time
+    finally:
+        conv.terminate()
+        for other in joined:
+            other.terminate()
+        conv_listener.terminate()
+        ipfs_datatransmission.close_transmission_streams()
+    return {
+        "messages_per_sec": n_messages / duration,
+        "latency_avg": sum(latencies) / n_messages,
+        "latency_max": max(latencies),
+        "transmissions": transmissions,
+    }
+
+
+FILE_SIZE = 32 * 1024**2
+FILE_SIZES = [1024**2, 8 * 1024**2, FILE_SIZE]
+
+
+def bench_transmit_file(pipelined, block_size=None, file_size=FILE_SIZE,
+                        stripes=1):
+    """Measures the throughput of `transmit_file`.
+    Returns:
+        dict: MiB/sec, and the final window and block sizes
+    """
+    prepare()
+    with tempfile.TemporaryDirectory() as tempdir:
+        filepath = os.path.join(tempdir, "benchmark.bin")
+        with open(filepath, "wb") as file:
+            file.write(os.urandom(file_size))
+        received = []
+        listener = listen_for_file_transmissions_locally(
+            "benchmark-files",
+            lambda peer_id, path, metadata: received.append(path), tempdir)
+        try:
+            start_time = time.perf_counter()
+            transmitter = ipfs_datatransmission.transmit_file(
+                filepath, REMOTE_PEER_ID, "benchmark-files",
+                block_size=block_size, pipelined=pipelined, stripes=stripes)
+            while not received or transmitter.status == "transmitting":
+                time.sleep(0.001)
+            duration = time.perf_counter() - start_time
+        finally:
+            listener.terminate()
+    return {
+        "mib_per_sec": file_size / duration / 1024**2,
+        "window_size": transmitter.window_size,
+        "block_size": transmitter.block_size,
+    }
+
+
+def _legacy_integritybyte(buffer):
+    """The per-byte loop `__add_integritybyte_to_buffer` used to run."""
+    sum = 0
+    for byte in buffer:
+        sum += byte
+        if sum > 65000:
+            sum = sum % 256
+    return sum % 256
+
+
+CHECKSUM_SIZES = [4 * 1024, 64 * 1024, 1024**2, 16 * 1024**2, 64 * 1024**2]
+
+
+def bench_checksums(sizes=CHECKSUM_SIZES):
+    """Measures the throughput of the checksums that can verify transmitted
+    data, compared to the legacy integrity byte calculation.
+    Returns:
+        dict: {checksum: {buffer size: MiB/s}}
+    """
+    checksums = {
+        "legacy loop": _legacy_integritybyte,
+        "integrity byte": lambda data: ipfs_datatransmission._sum_bytes(
+            data) % 256,
+    }
+    for name, (algorithm_id, function) in (
+            ipfs_datatransmission._CHECKSUMS.items()):
+        checksums[name] = function
+    results = {}
+    for name, function in checksums.items():
+        results[name] = {}
+        for size in sizes:
+            if name == "legacy loop" and size > 1024**2:
+                continue    # far too slow to be worth waiting for
+            data = os.urandom(size)
+            repetitions = max(1, 16 * 1024**2 // size)
+            start_time = time.perf_counter()
+            for i in range(repetitions):
+                function(data)
+            duration = time.perf_counter() - start_time
+            results[name][size] = size * repetitions / duration / 1024**2
+    return results
+
+
+CIPHER_BLOCK_SIZES = [64 * 1024, 1024**2, 4 * 1024**2]
+
+
+def bench_ciphers(sizes=CIPHER_BLOCK_SIZES):
+    """Measures how fast file blocks are encrypted by StreamCiphers, which
+    encrypt the block header and block into a reused buffer, compared to
+    whole-buffer encryption callbacks, which are passed their concatenation.
+    Returns:
+        dict: {method: {block size: MiB/s}}, empty if the cryptography
+            package isn't installed
+    """
+    dt = ipfs_datatransmission
+    if dt.Cipher is None:
+        return {}
+    from cryptography.hazmat.primitives.ciphers.aead import (
+        AESGCM, ChaCha20Poly1305)
+    key = os.urandom(32)
+    header = dt._FILE_BLOCK_HEADER.pack(0)
+    methods = {}
+    for name, aead, cipher in (
+            ("ChaCha20-Poly1305", ChaCha20Poly1305(key),
+             dt.ChaCha20Poly1305Cipher(key)),
+            ("AES-GCM", AESGCM(key), dt.AESGCMCipher(key))):
+        def callback(data, aead=aead):
+            nonce = os.urandom(12)
+            return nonce + aead.encrypt(nonce, header + data, None)
+
+        def stream_cipher(data, cipher=cipher, buffer=bytearray()):
+            cipher.encrypt_into(buffer, header, data).release()
+        methods[f"{name} callback"] = callback
+        methods[f"{name} StreamCipher"] = stream_cipher
+    results = {}
+    for name, method in methods.items():
+        results[name] = {}
+        for size in sizes:
+            data = os.urandom(size)
+            repetitions = max(1, 64 * 1024**2 // size)
+            start_time = time.perf_counter()
+            for i in range(repetitions):
+                method(data)
+            duration = time.perf_counter() - start_time
+            results[name][size] = size * repetitions / duration / 1024**2
+    return results
+
+
+def _legacy_to_b255_no_0s(number):
+    """The previous implementation of `_to_b255_no_0s`."""
+    array = bytearray([])
+    while (number > 0):
+        array.insert(0, int(number % 255 + 1))
+        number -= number % 255
+        number = number / 255
+    return array
+
+
+def _legacy_split_by_255(bytes):
+    """The previous implementation of `_split_by_255`."""
+    result = list()
+    pos = 0
+    collected = list()
+    while pos < len(bytes):
+        if bytes[pos] == 255:
+            result.append(bytearray(collected))
+            collected = list()
+        else:
+            collected.append(bytes[pos])
+        pos += 1
+    result.append(bytearray(collected))
+    return result
+
+
+def bench_codec(repetitions=20000):
+    """Measures the encoding and decoding throughput of the framing codecs.
+    Returns:
+        dict: {operation: operations/sec}
+    """
+    dt = ipfs_datatransmission
+    length = 1024**3 + 12345
+    metadata = bytearray(os.urandom(64).replace(b"\xff", b""))
+    legacy_header = dt._encode_file_header(length, "file.txt", metadata)
+    binary_header = dt._encode_file_header(length, "file.txt", metadata,
+                                           binary=True)
+    operations = {
+        "length prefix: legacy encode":
+            lambda: _legacy_to_b255_no_0s(length),
+        "length prefix: encode": lambda: dt._to_b255_no_0s(length),
+        "length prefix: decode":
+            lambda: dt._from_b255_no_0s(dt._to_b255_no_0s(length)),
+        "file header: legacy split":
+            lambda: _legacy_split_by_255(legacy_header),
+        "file header: split": lambda: dt._split_by_255(legacy_header),
+        "file header: binary encode": lambda: dt._encode_file_header(
+            length, "file.txt", metadata, binary=True),
+        "file header: binary decode":
+            lambda: dt._decode_file_header(binary_header),
+    }
+    results = {}
+    for name, operation in operations.items():
+        start_time = time.perf_counter()
+        for i in range(repetitions):
+            operation()
+        results[name] = repetitions / (time.perf_counter() - start_time)
+    return results
+
+
+class BenchmarkResults:
+    """Collects the results of benchmarks as records, which can be saved as
+    JSON and compared with those of another run."""
+
+    def __init__(self):
+        self.records = []
+
+    def add(self, benchmark, params, metrics):
+        """
+        Args:
+            benchmark (str): the benchmark's name, e.g. "transmit_data"
+            params (dict): the parameters it was run with
+            metrics (dict): the measured values, see HIGHER_IS_BETTER and
+                LOWER_IS_BETTER
+        """
+        self.records.append(
+            {"benchmark": benchmark, "params": params, "metrics": metrics})
+
+    def to_json(self):
+        return {
+            "environment": _environment(),
+            "results": self.records,
+        }
+
+    def save(self, path):
+        with open(path, "w") as file:
+            json.dump(self.to_json(), file, indent=2)
+
+    def compare(self, baseline, tolerance=0.2):
+        """Compares these results with those of a previous run.
+        Args:
+            baseline (dict): the previous run's results, as saved by `save()`
+            tolerance (float): by how much of its baseline a metric may get
+                worse before it counts as a regression
+        Returns:
+            list: a (benchmark, params, metric, baseline, value) tuple for
+                every regression
+        """
+        baseline_records = {
+            _record_key(record): record["metrics"]
+            for record in baseline["results"]
+        }
+        regressions = []
+        for record in self.records:
+            baseline_metrics = baseline_records.get(_record_key(record))
+            if not baseline_metrics:
+                continue
+            for metric, value in record["metrics"].items():
+                old_value = baseline_metrics.get(metric)
+                if not old_value:
+                    continue
+                if metric in HIGHER_IS_BETTER:
+                    regressed = value < old_value * (1 - tolerance)
+                elif metric in LOWER_IS_BETTER:
+                    regressed = value > old_value * (1 + tolerance)
+                else:   # informational, e.g. the auto-tuned window size
+                    continue
+                if regressed:
+                    regressions.append((record["benchmark"], record["params"],
+                                        metric, old_value, value))
+        return regressions
+
+
+# the metrics by which results are compared
+HIGHER_IS_BETTER = {"messages_per_sec", "mib_per_sec", "operations_per_sec"}
+LOWER_IS_BETTER = {"latency_avg", "latency_p50", "latency_p95",
+                   "latency_max", "http_requests_per_message"}
+
+
+def _record_key(record):
+    return (record["benchmark"],
+            json.dumps(record["params"], sort_keys=True))
+
+
+def _environment():
+    """Returns information about the environment the benchmarks ran in,
+    to tell apart results that aren't comparable."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "daemon": DAEMON_OPTIONS,
+        "time": datetime.now(UTC).isoformat(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+BENCHMARKS = ["transmit_data", "daemon_info_cache", "conversation_say", "transmit_file",
+              "transmit_file_striped", "checksums", "ciphers", "codec"]
+
+
+def run_benchmarks(benchmarks=BENCHMARKS, n_messages=N_MESSAGES,
+                   transmit_sizes=TRANSMIT_SIZES, file_sizes=FILE_SIZES):
+    """Runs the given benchmarks, printing their results.
+    Returns:
+        BenchmarkResults: the results
+    """
+    results = BenchmarkResults()
+    if "transmit_data" in benchmarks:
+        print(f"transmit_data, {n_messages} messages:")
+        for message_size in transmit_sizes:
+            for persistent in (False, True):
+                result = bench_transmit_data(persistent, n_messages,
+                                             message_size)
+                results.add("transmit_data", {
+                    "message_size": message_size, "persistent": persistent,
+                }, result)
+                mode = "persistent stream" if persistent else "stream per message"
+                print(f"  {_format_size(message_size):>7} {mode:20} "
+                      f"{result['messages_per_sec']:9.1f} messages/s  "
+                      f"latency p50 {result['latency_p50'] * 1000:6.2f} ms, "
+                      f"p95 {result['latency_p95'] * 1000:6.2f} ms  "
+                      f"{result['http_requests_per_message']:5.2f} daemon "
+                      "HTTP requests/message")
+
+    if "daemon_info_cache" in benchmarks:
+        result = bench_daemon_info_cache(n_messages)
+        results.add("daemon_info_cache", {}, result)
+        print(f"daemon info cache, transmit_data, {n_messages} messages:")
+        print(f"  uncached {result['http_requests_per_message_uncached']:5.2f} "
+              "daemon HTTP requests/message "
+              f"{result['messages_per_sec_uncached']:9.1f} messages/s")
+        print(f"  cached   {result['http_requests_per_message']:5.2f} "
+              "daemon HTTP requests/message "
+              f"{result['messages_per_sec']:9.1f} messages/s")
+
+    if "conversation_say" in benchmarks:
+        print(f"Conversation.say, {n_messages} messages:")
+        for message_size in SAY_MESSAGE_SIZES:
+            for persistent, coalesce in ((False, False), (True, False),
+                                         (False, True), (True, True)):
+                result = bench_conversation_say(
+                    coalesce, message_size, n_messages, persistent=persistent)
+                results.add("conversation_say", {
+                    "message_size": message_size, "persistent": persistent,
+                    "coalesce": coalesce,
+                }, result)
+                mode = "persistent" if persistent else "per message"
+                coalescing = "coalesced" if coalesce else "single"
+                print(f"  {message_size:5} B {mode:11} {coalescing:9} "
+                      f"{result['messages_per_sec']:9.1f} messages/s  latency "
+                      f"avg {result['latency_avg'] * 1000:6.1f} ms, "
+                      f"max {result['latency_max'] * 1000:6.1f} ms  "
+                      f"{result['transmissions']:4} transmissions")
+
+    if "transmit_file" in benchmarks:
+        for file_size in file_sizes:
+            print(f"transmit_file, {_format_size(file_size)}:")
+            for pipelined, block_size, zero_copy in (
+                    (False, ipfs_datatransmission.BLOCK_SIZE, False),
+                    (False, ipfs_datatransmission.BLOCK_SIZE, True),
+                    (True, ipfs_datatransmission.BLOCK_SIZE, True),
+                    (True, None, False),
+                    (True, None, True)):
+                ipfs_datatransmission.FILE_ZERO_COPY = zero_copy
+                result = bench_transmit_file(pipelined, block_size, file_size)
+                results.add("transmit_file", {
+                    "file_size": file_size, "pipelined": pipelined,
+                    "block_size": block_size, "zero_copy": zero_copy,
+                }, result)
+                mode = "pipelined" if pipelined else "sequential"
+                tuning = "auto-tuned" if block_size is None else "fixed"
+                copying = "zero-copy" if zero_copy else "copying"
+                print(f"  {mode:10} {tuning:10} {copying:9} "
+                      f"{result['mib_per_sec']:8.1f} MiB/s  "
+                      f"window {result['window_size']:2} blocks of "
+                      f"{_format_size(result['block_size'])}")
+        ipfs_datatransmission.FILE_ZERO_COPY = True
+
+    if "transmit_file_striped" in benchmarks:
+        file_size = max(file_sizes)
+        print(f"transmit_file, {_format_size(file_size)}, striped:")
+        for stripes in (1, 2, 4, 8):
+            result = bench_transmit_file(True, None, file_size,
+                                         stripes=stripes)
+            results.add("transmit_file_striped", {
+                "file_size": file_size, "stripes": stripes,
+            }, result)
+            print(f"  {stripes} stripes {result['mib_per_sec']:8.1f} MiB/s  "
+                  f"window {result['window_size']:2} blocks of "
+                  f"{_format_size(result['block_size'])} per stripe")
+
+    if "checksums" in benchmarks:
+        print("checksums, throughput in MiB/s:")
+        throughputs_by_name = bench_checksums()
+        print(f"  {'':16}" + "".join(
+            f"{_format_size(size):>10}" for size in CHECKSUM_SIZES))
+        for name, throughputs in throughputs_by_name.items():
+            print(f"  {name:16}" + "".join(
+                f"{throughputs[size]:10.0f}" if size in throughputs else f"{'-':>10}"
+                for size in CHECKSUM_SIZES))
+            for size, throughput in throughputs.items():
+                results.add("checksum", {"algorithm": name, "size": size},
+                            {"mib_per_sec": throughput})
+
+    if "ciphers" in benchmarks:
+        throughputs_by_name = bench_ciphers()
+        if throughputs_by_name:
+            print("file block encryption, throughput in MiB/s:")
+            print(f"  {'':30}" + "".join(
+                f"{_format_size(size):>10}" for size in CIPHER_BLOCK_SIZES))
+            for name, throughputs in throughputs_by_name.items():
+                print(f"  {name:30}" + "".join(
+                    f"{throughputs[size]:10.0f}" for size in CIPHER_BLOCK_SIZES))
+                for size, throughput in throughputs.items():
+                    results.add("cipher", {"method": name, "size": size},
+                                {"mib_per_sec": throughput})
+
+    if "codec" in benchmarks:
+        print("framing codec, operations/s:")
+        for name, operations_per_sec in bench_codec().items():
+            print(f"  {name:30} {operations_per_sec:12.0f}")
+            results.add("codec", {"operation": name},
+                        {"operations_per_sec": operations_per_sec})
+    return results
+
+
+def _format_size(size):
+    if size >= 1024**2:
+        return f"{size // 1024**2} MiB"
+    if size >= 1024:
+        return f"{size // 1024} KiB"
+    return f"{size} B"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks ipfs_datatransmission with two peers in this "
+        "process, communicating over a local stand-in for the IPFS daemon.")
+    parser.add_argument(
+        "--json", metavar="PATH",
+        help="save the results and information about the environment as JSON")
+    parser.add_argument(
+        "--compare", metavar="PATH",
+        help="compare the results with those saved by a previous run, "
+        "exiting with status 1 if any got worse by more than the tolerance")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2,
+        help="the fraction by which a result may get worse before it counts "
+        "as a regression (default: 0.2)")
+    parser.add_argument(
+        "--only", metavar="BENCHMARK", nargs="+", choices=BENCHMARKS,
+        default=BENCHMARKS, help="the benchmarks to run (default: all)")
+    parser.add_argument(
+        "--quick", action="store_true",
+        help="use fewer messages and smaller files, for a quick check")
+    parser.add_argument(
+        "--api-latency", type=float, default=0, metavar="SEC",
+        help="latency to add to every HTTP request to the daemon")
+    parser.add_argument(
+        "--latency", type=float, default=0, metavar="SEC",
+        help="one-way latency to add to the libp2p streams between the peers")
+    parser.add_argument(
+        "--bandwidth", type=float, default=None, metavar="MIB_PER_SEC",
+        help="bandwidth to which to limit each direction of every libp2p "
+        "stream between the peers")
+    args = parser.parse_args()
+    DAEMON_OPTIONS.update(
+        api_latency_sec=args.api_latency, stream_latency_sec=args.latency,
+        stream_bandwidth=args.bandwidth and args.bandwidth * 1024**2)
+
+    if args.quick:
+        results = run_benchmarks(args.only, n_messages=50,
+                                 transmit_sizes=[64, 65536],
+                                 file_sizes=[4 * 1024**2])
+    else:
+        results = run_benchmarks(args.only)
+    if daemon:
+        daemon.stop()
+    if args.json:
+        results.save(args.json)
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        regressions = results.compare(baseline, args.tolerance)
+        for benchmark, params, metric, old_value, value in regressions:
+            print(f"REGRESSION {benchmark} {json.dumps(params)}: {metric} "
+                  f"{old_value:.6g} -> {value:.6g}")
+        if regressions:
+            sys.exit(1)
+        print(f"no regressions compared to {args.compare}")
+
+
+if __name__ == "__main__":
+    main()
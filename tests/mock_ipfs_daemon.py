@@ -0,0 +1,795 @@
+"""
+A lightweight, in-process stand-in for the IPFS daemon's HTTP RPC API, for
+testing and benchmarking ipfs_api and ipfs_datatransmission without a running
+IPFS node or Docker.
+
+It implements libp2p stream-mounting (`/p2p/*`) by forwarding TCP connections
+locally: every peer ID is treated as this node itself, so a sending connection
+to any peer reaches this daemon's own listening connections.
+That way two peers can be simulated in a single process, as long as the
+sending peer addresses the receiver by any peer ID other than `PEER_ID`.
+For the same reason, messages published with `/pubsub/pub` are delivered to
+this daemon's own subscribers, and every peer can be found, connected to and
+pinged.
+
+Content added with `/add` is kept in memory and can be read with `/cat` and
+`/get` and pinned with `/pin/*`. Its CIDs are derived from the content, but
+don't match those a real IPFS node would produce.
+
+To measure how the toolkit performs over slower connections, latency can be
+injected into every HTTP request (`api_latency_sec`), and latency and a
+bandwidth limit into every libp2p stream and pubsub message
+(`stream_latency_sec`, `stream_bandwidth`). These can be changed at any time,
+and apply to streams opened afterwards.
+
+Usage:
+```
+daemon = MockIpfsDaemon()
+daemon.start()
+daemon.connect(ipfs_api)  # make ipfs_api use this daemon
+...
+daemon.stop()
+```
+"""
+import base64
+import gzip
+import hashlib
+import io
+import json
+import queue
+import select
+import socket
+import tarfile
+import threading
+import time
+from collections.abc import Iterator
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from urllib.parse import parse_qs, unquote, urlparse
+
+PEER_ID = "12D3KooWMockDaemonPeerIDxxxxxxxxxxxxxxxxxxxxxxxxxxxx"
+REMOTE_PEER_ID = "12D3KooWMockRemotePeerIDxxxxxxxxxxxxxxxxxxxxxxxxxxx"
+VERSION = "0.29.0"
+
+
+class DaemonError(Exception):
+    """Is returned to the HTTP client as an IPFS error response."""
+
+    def __init__(self, message: str):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+def _parse_tcp_multiaddr(multiaddr: str):
+    """Returns the (host, port) of a multiaddr like /ip4/127.0.0.1/tcp/4001"""
+    parts = multiaddr.strip("/").split("/")
+    return parts[1], int(parts[3])
+
+
+def _pipe(source: socket.socket, sink: socket.socket, finished: list,
+          latency_sec: float = 0, bandwidth: float = None):
+    """Copies data from one socket to another until the source is closed.
+    The sockets are closed once the data flow in both directions has ended,
+    i.e. when the second of the two pipes of a stream finishes.
+    Args:
+        latency_sec (float): how long the data takes to arrive
+        bandwidth (float): the most bytes per second to copy
+    """
+    chunks = None
+    if latency_sec or bandwidth:
+        # a bounded buffer, like the network's, so that the sender is slowed
+        # down too if it sends faster than the bandwidth allows
+        chunks = queue.Queue(maxsize=64)
+        Thread(target=_deliver,
+               args=(chunks, source, sink, finished, latency_sec, bandwidth),
+               name="MockIpfsDaemon-stream", daemon=True).start()
+    try:
+        while True:
+            data = source.recv(65536)
+            if not data:
+                break
+            if chunks:
+                chunks.put((time.monotonic(), data))
+            else:
+                sink.sendall(data)
+    except OSError:
+        pass
+    if chunks:
+        chunks.put(None)
+    else:
+        _finish_pipe(source, sink, finished)
+
+
+def _deliver(chunks: queue.Queue, source: socket.socket, sink: socket.socket,
+             finished: list, latency_sec: float, bandwidth: float):
+    """Sends the chunks of data received by `_pipe()` once they would have
+    arrived over a link of the given latency and bandwidth."""
+    link_free_at = 0    # when the link has finished transmitting the last chunk
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            received_at, data = chunk
+            link_free_at = max(received_at, link_free_at)
+            if bandwidth:
+                link_free_at += len(data) / bandwidth
+            delay = link_free_at + latency_sec - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            sink.sendall(data)
+    except OSError:
+        # unblock the reader, which puts the end of the stream into the queue
+        while chunks.get() is not None:
+            pass
+    _finish_pipe(source, sink, finished)
+
+
+def _finish_pipe(source: socket.socket, sink: socket.socket, finished: list):
+    try:
+        sink.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+    finished.append(source)
+    if len(finished) == 2:
+        source.close()
+        sink.close()
+
+
+def _parse_multipart(content_type: str, body: bytes):
+    """Returns the (filename, content type, content) of each part of a
+    multipart/form-data request body, as sent by `ipfshttpclient2.multipart`.
+    """
+    boundary = content_type.split("boundary=", 1)[1].split(";")[0]
+    boundary = b"--" + boundary.strip('"').encode()
+    parts = []
+    for part in body.split(boundary)[1:]:
+        if part.startswith(b"--"):  # the end of the body
+            break
+        head, _, content = part.partition(b"\r\n\r\n")
+        headers = {}
+        for line in head.decode().split("\r\n"):
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        filename = ""
+        disposition = headers.get("content-disposition", "")
+        if 'filename="' in disposition:
+            filename = unquote(
+                disposition.split('filename="', 1)[1].split('"', 1)[0])
+        if content.endswith(b"\r\n"):
+            content = content[:-2]
+        parts.append((filename, headers.get("content-type", ""), content))
+    return parts
+
+
+def _check_multiaddr(multiaddr: str):
+    parts = multiaddr.strip("/").split("/")
+    if not multiaddr.startswith("/") or len(parts) < 2:
+        raise DaemonError(f"invalid multiaddr \"{multiaddr}\"")
+
+
+def _read_body(request):
+    """Reads the body of an HTTP request, which ipfshttpclient2 sends in
+    chunked transfer encoding when streaming files."""
+    if request.headers.get("Transfer-Encoding", "").lower() == "chunked":
+        body = bytearray()
+        while True:
+            size = int(request.rfile.readline().split(b";")[0], 16)
+            if size == 0:
+                while request.rfile.readline() not in (b"\r\n", b"\n", b""):
+                    pass    # trailers
+                return bytes(body)
+            body += request.rfile.read(size)
+            request.rfile.readline()
+    length = int(request.headers.get("Content-Length") or 0)
+    return request.rfile.read(length) if length else b""
+
+
+def _decode_multibase(data: str):
+    """Decodes the base64url multibase encoding in which the pubsub API
+    passes topics and message data."""
+    data = data[1:]
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _encode_multibase(data: bytes):
+    return "u" + base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+_BASE58_ALPHABET = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+
+
+def _cid(data: bytes):
+    """Returns a CIDv0 (the base58 encoded SHA2-256 multihash) of the data."""
+    number = int.from_bytes(b"\x12\x20" + hashlib.sha256(data).digest(), "big")
+    cid = ""
+    while number:
+        number, digit = divmod(number, 58)
+        cid = _BASE58_ALPHABET[digit] + cid
+    return cid
+
+
+def _client_disconnected(sock: socket.socket):
+    """Checks whether the HTTP client has closed the connection."""
+    readable, _, _ = select.select([sock], [], [], 0)
+    if not readable:
+        return False
+    try:
+        return sock.recv(1, socket.MSG_PEEK) == b""
+    except OSError:
+        return True
+
+
+class _Forwarder:
+    """A sending connection: accepts TCP connections on a local port and
+    forwards each of them to the listener registered for its protocol."""
+
+    def __init__(self, daemon, protocol: str, listen_address: str,
+                 target_address: str):
+        self.daemon = daemon
+        self.protocol = protocol
+        self.listen_address = listen_address
+        self.target_address = target_address
+        host, port = _parse_tcp_multiaddr(listen_address)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # like IPFS (go) listeners, allow rebinding ports in TIME_WAIT
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self.sock.bind((host, port))
+        except OSError:
+            self.sock.close()
+            raise DaemonError(
+                f"failed to listen on {listen_address}: listen tcp4 "
+                f"{host}:{port}: bind: address already in use")
+        self.sock.listen()
+        Thread(target=self._accept, name=f"MockIpfsDaemon-forward-{port}",
+               daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:  # closed
+                return
+            target = self.daemon._find_listener(self.protocol)
+            if not target:
+                conn.close()    # the remote peer doesn't support the protocol
+                continue
+            try:
+                remote = socket.create_connection(
+                    _parse_tcp_multiaddr(target.target_address))
+            except OSError:
+                conn.close()
+                continue
+            # like IPFS (go) connections, don't delay small writes
+            for sock in (conn, remote):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            finished = []
+            for source, sink in ((conn, remote), (remote, conn)):
+                Thread(target=_pipe, args=(
+                    source, sink, finished, self.daemon.stream_latency_sec,
+                    self.daemon.stream_bandwidth
+                ), name="MockIpfsDaemon-stream", daemon=True).start()
+
+    def close(self):
+        # like IPFS, this only stops accepting new connections,
+        # already established streams stay open
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)  # wakes up accept()
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class _Listener:
+    """A listening connection registration."""
+
+    def __init__(self, protocol: str, target_address: str):
+        self.protocol = protocol
+        self.listen_address = f"/p2p/{PEER_ID}"
+        self.target_address = target_address
+
+    def close(self):
+        pass
+
+
+class MockIpfsDaemon:
+    """An in-process stand-in for the IPFS daemon's HTTP RPC API."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0,
+                 api_latency_sec: float = 0, stream_latency_sec: float = 0,
+                 stream_bandwidth: float = None):
+        """
+        Args:
+            api_latency_sec (float): how long every HTTP request is delayed
+            stream_latency_sec (float): how long data takes to arrive on
+                libp2p streams, and pubsub messages to be delivered
+            stream_bandwidth (float): the most bytes per second transmitted in
+                each direction of every libp2p stream, None for no limit
+        """
+        self.api_latency_sec = api_latency_sec
+        self.stream_latency_sec = stream_latency_sec
+        self.stream_bandwidth = stream_bandwidth
+        self.forwarders = []
+        self.listeners = []
+        self.objects = {}   # CID: the file's content, or {name: CID} for dirs
+        self.pins = {}  # CID: pin type
+        self.subscriptions = {}  # topic: [queue of (deliver_at, message)]
+        self.swarm_peers = set()
+        self.swarm_filters = set()
+        self._pubsub_seqno = 0
+        self._stopped = False
+        self._lock = threading.Lock()
+        self.request_counts = {}    # endpoint: number of HTTP requests
+        daemon = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                daemon._handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.host, self.port = self._server.server_address[:2]
+        self._thread = None
+
+    @property
+    def multiaddr(self):
+        """The multiaddr of this daemon's HTTP RPC API."""
+        return f"/ip4/{self.host}/tcp/{self.port}/http"
+
+    def start(self):
+        self._thread = Thread(target=self._server.serve_forever,
+                              name="MockIpfsDaemon", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped = True    # ends pubsub subscriptions
+        self._server.shutdown()
+        self._server.server_close()
+        with self._lock:
+            for connection in self.forwarders + self.listeners:
+                connection.close()
+            self.forwarders.clear()
+            self.listeners.clear()
+
+    def connect(self, ipfs_api):
+        """Make the given ipfs_api module use this daemon."""
+        ipfs_api.http_client = ipfs_api.ipfshttpclient.client.Client(
+            addr=self.multiaddr)
+
+    def http_request_count(self, endpoint: str = None):
+        """Returns the number of HTTP requests this daemon has served, either
+        in total or for the specified endpoint, e.g. `/p2p/forward`."""
+        with self._lock:
+            if endpoint:
+                return self.request_counts.get(endpoint, 0)
+            return sum(self.request_counts.values())
+
+    def _find_listener(self, protocol):
+        with self._lock:
+            for listener in self.listeners:
+                if listener.protocol == protocol:
+                    return listener
+        return None
+
+    def _handle(self, request):
+        url = urlparse(request.path)
+        endpoint = url.path.split("/api/v0", 1)[-1]
+        params = parse_qs(url.query)
+        args = params.pop("arg", [])
+        body = _read_body(request)
+        content_type = request.headers.get("Content-Type", "")
+        files = []
+        if content_type.startswith("multipart/"):
+            files = _parse_multipart(content_type, body)
+        with self._lock:
+            self.request_counts[endpoint] = self.request_counts.get(
+                endpoint, 0) + 1
+        if self.api_latency_sec:
+            time.sleep(self.api_latency_sec)
+        command = getattr(
+            self, "_cmd_" + endpoint.strip("/").replace("/", "_"), None)
+        try:
+            if not command:
+                raise DaemonError(f"unknown command \"{endpoint}\"")
+            result = command(args, {k: v[-1] for k, v in params.items()},
+                             files)
+            status = 200
+        except DaemonError as error:
+            result = {"Message": str(error), "Code": 0, "Type": "error"}
+            status = 500
+        if isinstance(result, Iterator):
+            self._stream(request, result)
+            return
+        if isinstance(result, bytes):
+            content_type = "text/plain"
+            body = result
+        else:
+            content_type = "application/json"
+            body = b"" if result is None else json.dumps(result).encode()
+        request.send_response(status)
+        request.send_header("Content-Type", content_type)
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def _stream(self, request, items: Iterator):
+        """Sends the items as a stream of JSON objects, like the responses of
+        commands which produce their output gradually.
+        An item None doesn't get sent, but checks whether the client is still
+        connected, ending the stream otherwise."""
+        request.send_response(200)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Transfer-Encoding", "chunked")
+        request.end_headers()
+        try:
+            for item in items:
+                if item is None:
+                    if _client_disconnected(request.connection):
+                        break
+                    continue
+                data = json.dumps(item).encode() + b"\n"
+                request.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                request.wfile.flush()
+            else:
+                request.wfile.write(b"0\r\n\r\n")
+                return
+        except OSError:
+            pass
+        finally:
+            if hasattr(items, "close"):
+                items.close()
+        request.close_connection = True
+
+    def _store(self, content, only_hash=False):
+        """Stores a file's content, or a directory as a dict of its entries'
+        names and CIDs, returning its CID."""
+        if isinstance(content, dict):
+            cid = _cid(b"directory" + json.dumps(content, sort_keys=True).encode())
+        else:
+            cid = _cid(b"file" + content)
+        if not only_hash:
+            with self._lock:
+                self.objects[cid] = content
+        return cid
+
+    def _resolve(self, path: str):
+        """Returns the content of the object at an IPFS path like
+        /ipfs/CID/directory/file or CID."""
+        parts = [part for part in path.split("/") if part]
+        if parts and parts[0] == "ipfs":
+            parts = parts[1:]
+        if not parts:
+            raise DaemonError(f"invalid path \"{path}\"")
+        with self._lock:
+            content = self.objects.get(parts[0])
+            for name in parts[1:]:
+                if not isinstance(content, dict) or name not in content:
+                    content = None
+                    break
+                content = self.objects.get(content[name])
+        if content is None:
+            raise DaemonError(f"{path}: block was not found locally (offline)")
+        return content
+
+    def _reachable(self, cid: str, reachable: set):
+        """Adds the CIDs of the object and all objects it links to."""
+        reachable.add(cid)
+        content = self.objects.get(cid)
+        if isinstance(content, dict):
+            for child in content.values():
+                self._reachable(child, reachable)
+        return reachable
+
+    # ---------- commands ----------
+
+    def _cmd_id(self, args, opts, files):
+        return {
+            "ID": args[0] if args else PEER_ID,
+            "PublicKey": "",
+            "Addresses": [f"/ip4/127.0.0.1/tcp/4001/p2p/{PEER_ID}"],
+            "AgentVersion": f"kubo/{VERSION}/mock",
+            "ProtocolVersion": "ipfs/0.1.0",
+            "Protocols": [],
+        }
+
+    def _cmd_version(self, args, opts, files):
+        return {"Version": VERSION, "Commit": "", "Repo": "15",
+                "System": "mock", "Golang": ""}
+
+    def _cmd_p2p_forward(self, args, opts, files):
+        protocol, listen_address, target_address = args[:3]
+        forwarder = _Forwarder(self, protocol, listen_address, target_address)
+        with self._lock:
+            self.forwarders.append(forwarder)
+
+    def _cmd_p2p_listen(self, args, opts, files):
+        protocol, target_address = args[:2]
+        with self._lock:
+            for listener in self.listeners:
+                if listener.protocol == protocol:
+                    raise DaemonError("listener already registered")
+            self.listeners.append(_Listener(protocol, target_address))
+
+    def _cmd_p2p_close(self, args, opts, files):
+        def matches(connection):
+            if opts.get("protocol") and connection.protocol != opts["protocol"]:
+                return False
+            if (opts.get("listen-address")
+                    and connection.listen_address != opts["listen-address"]):
+                return False
+            if (opts.get("target-address")
+                    and connection.target_address != opts["target-address"]):
+                return False
+            return True
+        close_all = opts.get("all", "").lower() == "true"
+        if not close_all and not any(opts.get(key) for key in (
+                "protocol", "listen-address", "target-address")):
+            raise DaemonError(
+                "expected at least one of: protocol, listen-address, "
+                "target-address")
+        with self._lock:
+            closed = [
+                connection for connection in self.forwarders + self.listeners
+                if close_all or matches(connection)
+            ]
+            for connection in closed:
+                connection.close()
+            self.forwarders = [c for c in self.forwarders if c not in closed]
+            self.listeners = [c for c in self.listeners if c not in closed]
+        return len(closed)
+
+    def _cmd_p2p_ls(self, args, opts, files):
+        with self._lock:
+            return {"Listeners": [
+                {
+                    "Protocol": connection.protocol,
+                    "ListenAddress": connection.listen_address,
+                    "TargetAddress": connection.target_address,
+                }
+                for connection in self.forwarders + self.listeners
+            ]}
+
+    def _cmd_add(self, args, opts, files):
+        only_hash = opts.get("only-hash", "").lower() == "true"
+        entries = []
+        directories = {}    # path: {name: CID}
+        for filename, content_type, content in files:
+            path = filename.strip("/")
+            parent = path
+            while "/" in parent:   # make sure all ancestors are known
+                parent = parent.rsplit("/", 1)[0]
+                directories.setdefault(parent, {})
+            if content_type == "application/x-directory":
+                directories.setdefault(path, {})
+                continue
+            cid = self._store(content, only_hash)
+            entries.append({"Name": path, "Hash": cid,
+                            "Size": str(len(content))})
+            if "/" in path:
+                parent, name = path.rsplit("/", 1)
+                directories[parent][name] = cid
+        # directories after their contents, the outermost last
+        for path in sorted(directories, key=lambda path: -path.count("/")):
+            cid = self._store(directories[path], only_hash)
+            entries.append({"Name": path, "Hash": cid, "Size": "0"})
+            if "/" in path:
+                parent, name = path.rsplit("/", 1)
+                directories[parent][name] = cid
+        if (entries and not only_hash
+                and opts.get("pin", "true").lower() == "true"):
+            with self._lock:
+                self.pins[entries[-1]["Hash"]] = "recursive"
+        return iter(entries)
+
+    def _cmd_cat(self, args, opts, files):
+        content = self._resolve(args[0])
+        if isinstance(content, dict):
+            raise DaemonError("this dag node is a directory")
+        offset = int(opts.get("offset") or 0)
+        length = opts.get("length")
+        return content[offset:offset + int(length) if length else None]
+
+    def _cmd_get(self, args, opts, files):
+        content = self._resolve(args[0])
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w") as archive:
+            self._add_to_archive(
+                archive, args[0].rstrip("/").split("/")[-1], content)
+        if opts.get("compress", "").lower() == "true":
+            return gzip.compress(buffer.getvalue())
+        return buffer.getvalue()
+
+    def _add_to_archive(self, archive, name, content):
+        info = tarfile.TarInfo(name)
+        if isinstance(content, dict):
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            archive.addfile(info)
+            for child, cid in content.items():
+                self._add_to_archive(archive, name + "/" + child,
+                                     self.objects[cid])
+        else:
+            info.size = len(content)
+            info.mode = 0o644
+            archive.addfile(info, io.BytesIO(content))
+
+    def _cmd_pin_add(self, args, opts, files):
+        for path in args:
+            self._resolve(path)
+        with self._lock:
+            for path in args:
+                self.pins[path.strip("/").split("/")[-1]] = "recursive"
+        return {"Pins": args}
+
+    def _cmd_pin_rm(self, args, opts, files):
+        with self._lock:
+            for cid in args:
+                if cid not in self.pins:
+                    raise DaemonError("not pinned or pinned indirectly")
+            for cid in args:
+                del self.pins[cid]
+        return {"Pins": args}
+
+    def _cmd_pin_ls(self, args, opts, files):
+        with self._lock:
+            keys = {
+                cid: {"Type": pin_type} for cid, pin_type in self.pins.items()
+                if not args or cid in args
+            }
+        return {"Keys": keys}
+
+    def _cmd_repo_gc(self, args, opts, files):
+        with self._lock:
+            reachable = set()
+            for cid in self.pins:
+                self._reachable(cid, reachable)
+            removed = [cid for cid in self.objects if cid not in reachable]
+            for cid in removed:
+                del self.objects[cid]
+        return iter([{"Key": {"/": cid}} for cid in removed])
+
+    def _cmd_pubsub_pub(self, args, opts, files):
+        topic = _decode_multibase(args[0]).decode()
+        data = files[0][2] if files else b""
+        with self._lock:
+            self._pubsub_seqno += 1
+            message = {
+                "from": PEER_ID,
+                "data": _encode_multibase(data),
+                "seqno": _encode_multibase(
+                    self._pubsub_seqno.to_bytes(8, "big")),
+                "topicIDs": [_encode_multibase(topic.encode())],
+            }
+            deliver_at = time.monotonic() + self.stream_latency_sec
+            for subscriber in self.subscriptions.get(topic, []):
+                subscriber.put((deliver_at, message))
+
+    def _cmd_pubsub_sub(self, args, opts, files):
+        topic = _decode_multibase(args[0]).decode()
+        messages = queue.Queue()
+        with self._lock:
+            self.subscriptions.setdefault(topic, []).append(messages)
+
+        def stream():
+            try:
+                while not self._stopped:
+                    try:
+                        deliver_at, message = messages.get(timeout=0.1)
+                    except queue.Empty:
+                        yield None  # checks whether the client is still there
+                        continue
+                    delay = deliver_at - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    yield message
+            finally:
+                with self._lock:
+                    self.subscriptions[topic].remove(messages)
+                    if not self.subscriptions[topic]:
+                        del self.subscriptions[topic]
+        return stream()
+
+    def _cmd_pubsub_ls(self, args, opts, files):
+        with self._lock:
+            return {"Strings": [
+                _encode_multibase(topic.encode())
+                for topic in self.subscriptions
+            ]}
+
+    def _cmd_pubsub_peers(self, args, opts, files):
+        # the other peers subscribed to a topic are this node itself
+        with self._lock:
+            topics = ([_decode_multibase(args[0]).decode()] if args
+                      else list(self.subscriptions))
+            subscribed = any(topic in self.subscriptions for topic in topics)
+        return {"Strings": [REMOTE_PEER_ID] if subscribed else []}
+
+    def _peer_info(self, peer_id):
+        return {"ID": peer_id, "Addrs": [f"/ip4/{self.host}/tcp/4001"]}
+
+    def _cmd_routing_findpeer(self, args, opts, files):
+        return iter([{"Extra": "", "ID": "", "Type": 2,
+                      "Responses": [self._peer_info(args[0])]}])
+
+    def _cmd_routing_findprovs(self, args, opts, files):
+        with self._lock:
+            found = args[0].strip("/").split("/")[-1] in self.objects
+        responses = [{"Extra": "", "ID": PEER_ID, "Type": 0,
+                      "Responses": None}]   # querying the DHT
+        if found:
+            responses.append({"Extra": "", "ID": "", "Type": 4,
+                              "Responses": [self._peer_info(PEER_ID)]})
+        return iter(responses)
+
+    def _cmd_swarm_connect(self, args, opts, files):
+        with self._lock:
+            for multiaddr in args:
+                self.swarm_peers.add(multiaddr.split("/p2p/")[-1])
+        return {"Strings": [f"connect {multiaddr.split('/p2p/')[-1]} success"
+                            for multiaddr in args]}
+
+    def _cmd_swarm_disconnect(self, args, opts, files):
+        with self._lock:
+            for multiaddr in args:
+                self.swarm_peers.discard(multiaddr.split("/p2p/")[-1])
+        return {"Strings": [f"disconnect {multiaddr.split('/p2p/')[-1]} success"
+                            for multiaddr in args]}
+
+    def _cmd_swarm_peers(self, args, opts, files):
+        with self._lock:
+            return {"Peers": [
+                {"Addr": f"/ip4/{self.host}/tcp/4001", "Peer": peer_id,
+                 "Latency": "", "Muxer": "", "Direction": 0, "Streams": None}
+                for peer_id in sorted(self.swarm_peers)
+            ]}
+
+    def _cmd_swarm_addrs(self, args, opts, files):
+        with self._lock:
+            return {"Addrs": {
+                peer_id: [f"/ip4/{self.host}/tcp/4001"]
+                for peer_id in self.swarm_peers
+            }}
+
+    def _cmd_swarm_filters(self, args, opts, files):
+        with self._lock:
+            return {"Strings": sorted(self.swarm_filters)}
+
+    def _cmd_swarm_filters_add(self, args, opts, files):
+        # like IPFS, applies the filters until it comes across an invalid one
+        with self._lock:
+            for multiaddr in args:
+                _check_multiaddr(multiaddr)
+                self.swarm_filters.add(multiaddr)
+        return {"Strings": args}
+
+    def _cmd_swarm_filters_rm(self, args, opts, files):
+        with self._lock:
+            for multiaddr in args:
+                _check_multiaddr(multiaddr)
+                self.swarm_filters.discard(multiaddr)
+        return {"Strings": args}
+
+    def _cmd_ping(self, args, opts, files):
+        count = int(opts.get("count") or 10)
+        # a round trip over a libp2p stream
+        round_trip_ns = int(self.stream_latency_sec * 2 * 1e9)
+
+        def stream():
+            yield {"Success": True, "Time": 0,
+                   "Text": f"PING {args[0]}."}
+            for i in range(count):
+                time.sleep(self.stream_latency_sec * 2)
+                yield {"Success": True, "Time": round_trip_ns, "Text": ""}
+            yield {"Success": True, "Time": 0, "Text":
+                   f"Average latency: {round_trip_ns / 1e6:.2f}ms"}
+        return stream()
@@ -18,6 +18,9 @@ run the following commands to stop and remove the unterminated container:
     docker stop $(docker ps -aqf "name=^IPFS-Toolkit-Test$")
     docker rm $(docker ps -aqf "name=^IPFS-Toolkit-Test$")
 ```
+
+For reproducible measurements that need neither Docker nor a network, see
+benchmark_datatransmission.py.
 """
 
 # import ipfs_datatransmission
@@ -63,7 +66,7 @@ TEST_DATA = bytearray([0]*102400)
 
 def test_transmission_speed(buffer_size):
     python_code = "import ipfs_datatransmission;import time;"
-    python_code += f"ipfs_datatransmission.DEF_BUFFER_SIZE={buffer_size};"
+    python_code += f"ipfs_datatransmission.BUFFER_SIZE={buffer_size};"
     python_code += "listener=None;"
     python_code += "on_receive = lambda data, peer_id:listener.terminate();"
     python_code += "listener = ipfs_datatransmission.listen_for_transmissions('speed-test', on_receive);"
@@ -0,0 +1,1199 @@
+"""
+Tests for ipfs_datatransmission which run two peers in this process,
+communicating over the local stand-in for the IPFS daemon in
+mock_ipfs_daemon.py, so no IPFS node or Docker is needed.
+"""
+import asyncio
+import gc
+import hashlib
+import inspect
+import io
+import json
+import socket
+import threading
+import time
+import os
+import weakref
+import tempfile
+import sys
+import warnings
+from termcolor import colored
+if True:
+    sys.path.insert(0, "..")
+    import ipfs_api
+    import ipfs_datatransmission
+    import ipfs_datatransmission_async
+from mock_ipfs_daemon import MockIpfsDaemon, REMOTE_PEER_ID
+
+warnings.filterwarnings("ignore", category=FutureWarning)
+
+daemon = None
+
+
+def prepare():
+    global daemon
+    if not daemon:
+        daemon = MockIpfsDaemon().start()
+        daemon.connect(ipfs_api)
+
+
+def mark(success):
+    """
+    Returns a check or cross character depending on the input success.
+    """
+    if success:
+        mark = colored("✓", "green")
+    else:
+        mark = colored("✗", "red")
+
+    return mark
+
+
+def wait_for(condition, timeout_sec=5):
+    """Waits till the given function returns True or the timeout is reached.
+    Returns:
+        bool: whether or not the condition was met
+    """
+    for i in range(int(timeout_sec * 100)):
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def listen_for_file_transmissions_locally(listener_name, eventhandler, dir,
+                                          encryption_callbacks=None):
+    """Like `ipfs_datatransmission.listen_for_file_transmissions`, but as both
+    peers are this node, joins the sender's conversation via REMOTE_PEER_ID and
+    under a different name."""
+    def request_handler(conv_name, peer_id):
+        receiver = ipfs_datatransmission.FileTransmissionReceiver()
+        conv = ipfs_datatransmission.Conversation()
+        receiver.setup(conv, eventhandler, dir=dir)
+        conv.join(conv_name + "-receiver", REMOTE_PEER_ID, conv_name,
+                  receiver.on_data_received,
+                  encryption_callbacks=encryption_callbacks)
+    return ipfs_datatransmission.ConversationListener(
+        listener_name, request_handler)
+
+
+def test_transmit_data():
+    prepare()
+    received = []
+    listener = ipfs_datatransmission.listen_for_transmissions(
+        "test-transmission", lambda data, peer_id: received.append(data))
+    wait_for(lambda: listener.port)
+    ipfs_datatransmission.transmit_data(
+        b"Hello there!", REMOTE_PEER_ID, "test-transmission")
+    success = wait_for(lambda: received == [b"Hello there!"])
+    listener.terminate()
+    print(mark(success), "transmit_data")
+    assert success
+
+
+def test_transmit_large_data():
+    prepare()
+    received = []
+    listener = ipfs_datatransmission.listen_for_transmissions(
+        "test-large-transmission", lambda data, peer_id: received.append(data))
+    wait_for(lambda: listener.port)
+    data = os.urandom(5 * 1024 * 1024)
+    for persistent in (False, True):
+        ipfs_datatransmission.transmit_data(
+            data, REMOTE_PEER_ID, "test-large-transmission",
+            persistent=persistent)
+    success = wait_for(lambda: received == [data, data])
+    ipfs_datatransmission.close_transmission_streams()
+    listener.terminate()
+    print(mark(success), "transmit_data: large data")
+    assert success
+
+
+def test_malformed_frames():
+    prepare()
+    dt = ipfs_datatransmission
+    received = []
+    listener = dt.listen_for_transmissions(
+        "test-malformed", lambda data, peer_id: received.append(data))
+    wait_for(lambda: listener.port)
+    try:
+        # an overlong length header, and a length exceeding the listener's
+        # limit for requests, neither of which the listener tries to allocate
+        for header in (b"\xff" * 9, dt._to_b255_no_0s(1024**3)):
+            sock = socket.create_connection((dt._ipfs_host_ip(), listener.port))
+            sock.sendall(header + b"\x00")
+            sock.settimeout(5)
+            try:
+                sock.recv(1)
+            except OSError:
+                pass
+            sock.close()
+        dt.transmit_data(b"still listening", REMOTE_PEER_ID, "test-malformed")
+        success = wait_for(lambda: received == [b"still listening"])
+    finally:
+        listener.terminate()
+    print(mark(success), "malformed frames: listener survives")
+    assert success
+
+    # frames larger than the preallocation limit are received as they arrive
+    data = os.urandom(dt._FRAME_PREALLOCATION_MAX * 2 + 12345)
+    sender, receiver = socket.socketpair()
+    thread = threading.Thread(target=dt._tcp_send_all, args=(sender, data))
+    thread.start()
+    frame, complete = dt._tcp_recv_frame(receiver, timeout=5)
+    thread.join()
+    sender.close()
+    receiver.close()
+    success = complete and frame == data
+    print(mark(success), "malformed frames: large frame")
+    assert success
+
+
+def test_transmit_data_persistent():
+    prepare()
+    received = []
+    listener = ipfs_datatransmission.listen_for_transmissions(
+        "test-persistent", lambda data, peer_id: received.append(data))
+    wait_for(lambda: listener.port)
+    messages = [f"message {i}".encode() for i in range(20)]
+    forwards = daemon.http_request_count("/p2p/forward")
+    for message in messages:
+        ipfs_datatransmission.transmit_data(
+            message, REMOTE_PEER_ID, "test-persistent", persistent=True)
+    success = wait_for(lambda: sorted(received) == sorted(messages))
+    print(mark(success), "transmit_data: persistent stream")
+    assert success
+
+    success = daemon.http_request_count("/p2p/forward") - forwards == 1
+    print(mark(success), "transmit_data: persistent stream reused")
+    assert success
+
+    # the stream is reopened after the receiver closed it
+    listener.terminate()
+    received.clear()
+    listener = ipfs_datatransmission.listen_for_transmissions(
+        "test-persistent", lambda data, peer_id: received.append(data))
+    wait_for(lambda: listener.port)
+    ipfs_datatransmission.transmit_data(
+        b"again", REMOTE_PEER_ID, "test-persistent", persistent=True)
+    success = wait_for(lambda: received == [b"again"])
+    ipfs_datatransmission.close_transmission_streams()
+    listener.terminate()
+    print(mark(success), "transmit_data: persistent stream reopened")
+    assert success
+
+
+def test_port_forward_reuse():
+    prepare()
+    received = []
+    listener = ipfs_datatransmission.listen_for_transmissions(
+        "test-forward-reuse", lambda data, peer_id: received.append(data))
+    wait_for(lambda: listener.port)
+    try:
+        forwards = daemon.http_request_count("/p2p/forward")
+        for i in range(5):
+            ipfs_datatransmission.transmit_data(
+                b"hello", REMOTE_PEER_ID, "test-forward-reuse")
+        success = wait_for(lambda: len(received) == 5)
+        # one forward to the listener's protocol, and at most one for each
+        # of the receiver's transmission ports
+        forwards = daemon.http_request_count("/p2p/forward") - forwards
+        success = success and forwards <= 6
+        print(mark(success), "port-forwards: reused")
+        assert success
+
+        # a forward closed behind the registry's back is reopened
+        ipfs_api.close_tcp_sending_connection(
+            name="test-forward-reuse", peer_id=REMOTE_PEER_ID)
+        ipfs_datatransmission.transmit_data(
+            b"again", REMOTE_PEER_ID, "test-forward-reuse")
+        success = wait_for(lambda: len(received) == 6)
+        print(mark(success), "port-forwards: reopened after external close")
+        assert success
+
+        # idle forwards are closed together
+        idle_timeout = ipfs_datatransmission.FORWARD_IDLE_TIMEOUT_SEC
+        ipfs_datatransmission.FORWARD_IDLE_TIMEOUT_SEC = 0
+        try:
+            ipfs_datatransmission._port_forwards._cleanup()
+        finally:
+            ipfs_datatransmission.FORWARD_IDLE_TIMEOUT_SEC = idle_timeout
+    finally:
+        listener.terminate()
+    protocols = [
+        connection["Protocol"]
+        for connection in ipfs_datatransmission._p2p_connections()
+        if not connection["ListenAddress"].startswith("/p2p/")]
+    success = "/x/test-forward-reuse" not in protocols
+    print(mark(success), "port-forwards: idle forwards closed")
+    assert success
+
+
+def test_receiver_pool():
+    prepare()
+    received = []
+    listener = ipfs_datatransmission.listen_for_transmissions(
+        "test-receiver-pool", lambda data, peer_id: received.append(data))
+    wait_for(lambda: listener.port)
+    try:
+        wait_for(lambda: ipfs_datatransmission.receiver_pool_stats()["idle"]
+                 == ipfs_datatransmission.RECEIVER_POOL_SIZE)
+        # the first transmission waits for the listener to be registered
+        ipfs_datatransmission.transmit_data(
+            b"first", REMOTE_PEER_ID, "test-receiver-pool")
+        stats = ipfs_datatransmission.receiver_pool_stats()
+        listens = daemon.http_request_count("/p2p/listen")
+        for i in range(10):
+            ipfs_datatransmission.transmit_data(
+                f"message {i}".encode(), REMOTE_PEER_ID, "test-receiver-pool")
+        success = wait_for(lambda: len(received) == 11)
+        # every request was served by a recycled, already registered socket
+        new_stats = ipfs_datatransmission.receiver_pool_stats()
+        success &= new_stats["hits"] - stats["hits"] == 10
+        success &= new_stats["misses"] == stats["misses"]
+        success &= new_stats["accept_latency_max"] > 0
+        success &= daemon.http_request_count("/p2p/listen") == listens
+        success &= wait_for(lambda: ipfs_datatransmission.receiver_pool_stats()[
+            "idle"] == ipfs_datatransmission.RECEIVER_POOL_SIZE)
+    finally:
+        listener.terminate()
+    print(mark(success), "receiver pool: recycled sockets")
+    assert success
+
+
+def test_listener_demux():
+    prepare()
+    ipfs_datatransmission.LISTENER_DEMUX = True
+    names = [f"test-demux-{i}" for i in range(3)]
+    received = {name: [] for name in names}
+    buffers = []
+    listeners = []
+    try:
+        listens = daemon.http_request_count("/p2p/listen")
+        for name in names:
+            listeners.append(ipfs_datatransmission.listen_for_transmissions(
+                name, lambda data, peer_id, name=name:
+                    received[name].append(data)))
+        listeners.append(ipfs_datatransmission.listen_to_buffers(
+            buffers.append, "test-demux-buffers"))
+        for name in names:
+            for persistent in (False, True):
+                ipfs_datatransmission.transmit_data(
+                    name.encode(), REMOTE_PEER_ID, name, persistent=persistent)
+        sender = ipfs_datatransmission.BufferSender(
+            REMOTE_PEER_ID, "test-demux-buffers")
+        sender.send_buffer(b"buffer")
+        success = wait_for(lambda: all(
+            received[name] == [name.encode()] * 2 for name in names))
+        success &= wait_for(lambda: buffers == [b"buffer"])
+        sender.terminate()
+        ipfs_datatransmission.close_transmission_streams()
+        # all listeners share one socket and IPFS listening connection,
+        # and none has a thread of its own
+        demux_port = ipfs_datatransmission._demultiplexer.port
+        success &= all(listener.port == demux_port
+                       for listener in listeners[:len(names)])
+        success &= daemon.http_request_count("/p2p/listen") - listens <= 1
+        success &= not [thread for thread in threading.enumerate()
+                        if thread.name.startswith("DataTransmissionListener-test-demux")]
+        print(mark(success), "listener demultiplexer: transmit_data, buffers")
+        assert success
+
+        # connections for unknown listeners and garbage are dropped
+        for garbage in (b"\x05\x00none", b"\xff" * 20):
+            sock = ipfs_datatransmission._create_sending_connection(
+                REMOTE_PEER_ID, ipfs_datatransmission._DEMUX_PROTOCOL)
+            sock.sendall(garbage)
+            sock.settimeout(5)
+            success &= sock.recv(1) == b""
+            sock.close()
+        ipfs_datatransmission._close_sending_connection(
+            REMOTE_PEER_ID, ipfs_datatransmission._DEMUX_PROTOCOL)
+        ipfs_datatransmission.transmit_data(b"still there", REMOTE_PEER_ID,
+                                            names[0])
+        success &= wait_for(lambda: received[names[0]][-1] == b"still there")
+        print(mark(success), "listener demultiplexer: bad connections")
+        assert success
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            filepath = os.path.join(tempdir, "file.bin")
+            file_data = os.urandom(300000)
+            with open(filepath, "wb") as file:
+                file.write(file_data)
+            receive_dir = os.path.join(tempdir, "received")
+            os.mkdir(receive_dir)
+            files = []
+            listeners.append(listen_for_file_transmissions_locally(
+                "test-demux-files",
+                lambda peer_id, path, metadata: files.append(path),
+                receive_dir))
+            transmitter = ipfs_datatransmission.transmit_file(
+                filepath, REMOTE_PEER_ID, "test-demux-files")
+            success = wait_for(lambda: files, 20)
+            if success:
+                with open(files[0], "rb") as file:
+                    success = file.read() == file_data
+            success &= wait_for(lambda: transmitter.status == "finished")
+            print(mark(success), "listener demultiplexer: conversations, files")
+            assert success
+
+        async def run():
+            async with await ipfs_datatransmission_async.listen_for_transmissions(
+                    "test-demux-async") as listener:
+                await ipfs_datatransmission_async.transmit_data(
+                    b"async", REMOTE_PEER_ID, "test-demux-async")
+                data, peer_id = await anext(listener)
+            return data == b"async" and listener.port == demux_port
+        success = asyncio.run(run())
+        print(mark(success), "listener demultiplexer: async listener")
+        assert success
+    finally:
+        for listener in listeners:
+            listener.terminate()
+        ipfs_datatransmission.LISTENER_DEMUX = False
+
+
+def test_conversation_coalescing():
+    prepare()
+    joined = []
+
+    def on_request(conv_name, peer_id):
+        # all peers are this node, so reply to the requester via
+        # REMOTE_PEER_ID and listen under a different name
+        joined.append(ipfs_datatransmission.join_conversation(
+            conv_name + "-joiner", REMOTE_PEER_ID, conv_name, coalesce=True))
+    conv_listener = ipfs_datatransmission.listen_for_conversations(
+        "test-coalesce-listener", on_request)
+    conv = None
+    try:
+        conv = ipfs_datatransmission.start_conversation(
+            "test-coalesce", REMOTE_PEER_ID, "test-coalesce-listener",
+            coalesce=True)
+        assert wait_for(lambda: joined)
+        other = joined[0]
+        transmissions = []
+        for peer in (conv, other):
+            # count the transmissions each peer receives
+            peer._listener.eventhandler = (
+                lambda data, peer_id, peer=peer:
+                    transmissions.append(peer) or peer._hear(data, peer_id))
+        # including a message which looks like a batch of messages
+        messages = [f"message {i}".encode() for i in range(100)]
+        messages[50] = bytes(ipfs_datatransmission._encode_frame(
+            ipfs_datatransmission._FRAME_MESSAGE_BATCH, b"fake"))
+        for message in messages:
+            conv.say(message)
+        received = [other.listen(timeout=5) for message in messages]
+        success = (received == messages
+                   and transmissions.count(other) < len(messages) / 4)
+        print(mark(success), "conversation coalescing: batches")
+        assert success
+
+        # without waiting for the delay
+        ipfs_datatransmission.SAY_COALESCE_DELAY_SEC = 60
+        other.say(b"reply")
+        other.flush()
+        success = conv.listen(timeout=5) == b"reply"
+        success &= wait_for(lambda: transmissions.count(conv) == 1)
+        print(mark(success), "conversation coalescing: flush")
+        assert success
+    finally:
+        ipfs_datatransmission.SAY_COALESCE_DELAY_SEC = 0.005
+        for peer in [conv] + joined:
+            if peer:
+                peer.terminate()
+        conv_listener.terminate()
+
+
+def test_conversation_flow_control():
+    prepare()
+    joined = []
+    handled = []
+
+    def on_request(conv_name, peer_id):
+        joined.append(ipfs_datatransmission.join_conversation(
+            conv_name + "-joiner", REMOTE_PEER_ID, conv_name))
+    conv_listener = ipfs_datatransmission.listen_for_conversations(
+        "test-flow-listener", on_request)
+    ipfs_datatransmission.CONVERSATION_QUEUE_HIGH_WATERMARK = 5
+    ipfs_datatransmission.CONVERSATION_QUEUE_LOW_WATERMARK = 2
+    conv = None
+    try:
+        conv = ipfs_datatransmission.start_conversation(
+            "test-flow", REMOTE_PEER_ID, "test-flow-listener")
+        assert wait_for(lambda: joined)
+        other = joined[0]
+        said = []
+
+        def say_all():
+            for i in range(8):
+                conv.say(f"message {i}".encode())
+                said.append(i)
+        sender = threading.Thread(target=say_all)
+        sender.start()
+        # the receiver doesn't listen, so the sender is throttled once
+        # 5 messages are waiting
+        success = wait_for(
+            lambda: other.queue_stats()["messages"]["blocked"] == 1)
+        success &= len(said) == 5
+        success &= other.queue_stats()["messages"]["depth"] == 5
+        received = [other.listen(timeout=5) for i in range(8)]
+        sender.join()
+        success &= received == [f"message {i}".encode() for i in range(8)]
+        stats = other.queue_stats()["messages"]
+        success &= stats["depth"] == 0 and stats["dropped"] == 0
+        print(mark(success), "conversation flow control: throttling")
+        assert success
+
+        # with an eventhandler, the queue for listen() is only kept short
+        other.data_received_eventhandler = (
+            lambda conv, data: handled.append(data))
+        for i in range(8):
+            conv.say(f"message {i}".encode())
+        success = wait_for(lambda: len(handled) == 8)
+        stats = other.queue_stats()["messages"]
+        success &= (stats["dropped"] == 3 and stats["depth"] == 0
+                    and other.message_queue.qsize() == 5)
+        print(mark(success), "conversation flow control: bounded queue")
+        assert success
+    finally:
+        ipfs_datatransmission.CONVERSATION_QUEUE_HIGH_WATERMARK = 1000
+        ipfs_datatransmission.CONVERSATION_QUEUE_LOW_WATERMARK = 500
+        for peer in [conv] + joined:
+            if peer:
+                peer.terminate()
+        conv_listener.terminate()
+
+
+def test_metrics():
+    prepare()
+    records = []
+    received = []
+    ipfs_datatransmission.METRICS_SINK = (
+        ipfs_datatransmission.CallbackMetricsSink(
+            lambda *record: records.append(record)))
+    listener = None
+    try:
+        listener = ipfs_datatransmission.listen_for_transmissions(
+            "test-metrics", lambda data, peer_id: received.append(data))
+        wait_for(lambda: listener.port)
+        ipfs_datatransmission.transmit_data(
+            b"Hello there!", REMOTE_PEER_ID, "test-metrics")
+        ipfs_datatransmission.transmit_data(
+            b"persistent", REMOTE_PEER_ID, "test-metrics", persistent=True)
+        wait_for(lambda: len(received) == 2)
+        ipfs_datatransmission.report_metrics_gauges()
+
+        def values(name, **labels):
+            return [value for kind, nm, value, lbls in records
+                    if nm == name and labels.items() <= lbls.items()]
+        phases = {labels["phase"] for kind, name, value, labels in records
+                  if name == "transmission_phase_seconds"}
+        success = phases == {"connect", "handshake", "send", "ack"}
+        success &= values("bytes_sent_total", mode="single") == [12]
+        success &= values("bytes_sent_total", mode="stream") == [10]
+        success &= sum(values("bytes_received_total")) == 22
+        success &= bool(values("daemon_request_seconds",
+                               command="p2p/listen"))
+        success &= values("threads")[0] >= 1
+        print(mark(success), "metrics: callback sink")
+        assert success
+
+        sink = ipfs_datatransmission.PrometheusMetricsSink()
+        ipfs_datatransmission.METRICS_SINK = sink
+        for i in range(3):
+            ipfs_datatransmission.transmit_data(
+                b"again", REMOTE_PEER_ID, "test-metrics", persistent=True)
+        text = sink.text()
+        success = (
+            "# TYPE ipfs_datatransmission_bytes_sent_total counter\n"
+            'ipfs_datatransmission_bytes_sent_total{mode="stream"} 15\n'
+            in text)
+        success &= ('ipfs_datatransmission_transmission_phase_seconds_count'
+                    '{phase="ack"} 3\n' in text)
+        success &= "# TYPE ipfs_datatransmission_threads gauge\n" in text
+        print(mark(success), "metrics: Prometheus sink")
+        assert success
+
+        file = io.StringIO()
+        ipfs_datatransmission.METRICS_SINK = (
+            ipfs_datatransmission.JSONLinesMetricsSink(file))
+        ipfs_datatransmission.transmit_data(
+            b"json", REMOTE_PEER_ID, "test-metrics", persistent=True)
+        lines = [json.loads(line) for line in file.getvalue().splitlines()]
+        success = {"type": "counter", "name": "bytes_sent_total", "value": 4,
+                   "labels": {"mode": "stream"}}.items() <= next(
+            line for line in lines
+            if line["name"] == "bytes_sent_total").items()
+        print(mark(success), "metrics: JSON lines sink")
+        assert success
+    finally:
+        ipfs_datatransmission.METRICS_SINK = None
+        ipfs_datatransmission.close_transmission_streams()
+        if listener:
+            listener.terminate()
+
+
+def test_mock_daemon_api():
+    prepare()
+    with tempfile.TemporaryDirectory() as tempdir:
+        filepath = os.path.join(tempdir, "file.txt")
+        with open(filepath, "wb") as file:
+            file.write(b"Hello there!")
+        dirpath = os.path.join(tempdir, "dir")
+        os.makedirs(os.path.join(dirpath, "subdir"))
+        with open(os.path.join(dirpath, "subdir", "inner.txt"), "wb") as file:
+            file.write(b"inner")
+        cid = ipfs_api.publish(filepath)
+        dir_cid = ipfs_api.publish(dirpath)
+        success = ipfs_api.read(cid) == b"Hello there!"
+        success &= ipfs_api.predict_cid(filepath) == cid
+        ipfs_api.download(dir_cid, os.path.join(tempdir, "downloaded"))
+        with open(os.path.join(
+                tempdir, "downloaded", "subdir", "inner.txt"), "rb") as file:
+            success &= file.read() == b"inner"
+        success &= {cid, dir_cid} <= set(ipfs_api.pins(cids_only=True))
+        ipfs_api.remove(cid)
+        success &= cid not in ipfs_api.pins(cids_only=True)
+        success &= ipfs_api.find_providers(dir_cid) == [
+            ipfs_api.my_id()] and ipfs_api.find_providers(cid) == []
+    print(mark(success), "mock daemon: files and pins")
+    assert success
+
+    success = ipfs_api.get_peer_multiaddrs(REMOTE_PEER_ID) != []
+    success &= ipfs_api.connect_to_peer(
+        f"/ip4/127.0.0.1/tcp/4001/p2p/{REMOTE_PEER_ID}")
+    success &= ipfs_api.is_peer_connected(REMOTE_PEER_ID)
+    ipfs_api.add_swarm_filter("/ip4/10.0.0.0/ipcidr/8")
+    success &= ipfs_api.get_swarm_filters() == {"/ip4/10.0.0.0/ipcidr/8"}
+    ipfs_api.rm_swarm_filter("/ip4/10.0.0.0/ipcidr/8")
+    success &= ipfs_api.get_swarm_filters() == set()
+    print(mark(success), "mock daemon: peers and swarm")
+    assert success
+
+    received = []
+    listener = ipfs_api.pubsub_subscribe(
+        "test-topic", lambda message: received.append(message["data"]))
+    try:
+        success = wait_for(lambda: ipfs_api.pubsub_peers("test-topic"))
+        ipfs_api.pubsub_publish("test-topic", b"Hello there!")
+        success &= wait_for(lambda: received == [b"Hello there!"])
+    finally:
+        listener.terminate()
+    print(mark(success), "mock daemon: pubsub")
+    assert success
+
+
+def test_mock_daemon_shaping():
+    prepare()
+    received = []
+    listener = ipfs_datatransmission.listen_for_transmissions(
+        "test-shaping", lambda data, peer_id: received.append(data))
+    wait_for(lambda: listener.port)
+    try:
+        daemon.api_latency_sec = 0.05
+        start_time = time.perf_counter()
+        ipfs_api.http_client.version()
+        success = time.perf_counter() - start_time >= 0.05
+        daemon.api_latency_sec = 0
+        print(mark(success), "mock daemon: API latency")
+        assert success
+
+        daemon.stream_latency_sec = 0.05
+        ipfs_datatransmission.transmit_data(
+            b"warm-up", REMOTE_PEER_ID, "test-shaping", persistent=True)
+        start_time = time.perf_counter()
+        ipfs_datatransmission.transmit_data(
+            b"ping", REMOTE_PEER_ID, "test-shaping", persistent=True)
+        duration = time.perf_counter() - start_time
+        # one round trip: the message there and the acknowledgement back
+        success = 0.1 <= duration < 0.5
+        print(mark(success), "mock daemon: stream latency")
+        assert success
+
+        daemon.stream_latency_sec = 0
+        daemon.stream_bandwidth = 1024**2
+        ipfs_datatransmission.close_transmission_streams()
+        start_time = time.perf_counter()
+        ipfs_datatransmission.transmit_data(
+            bytes(512 * 1024), REMOTE_PEER_ID, "test-shaping",
+            persistent=True)
+        duration = time.perf_counter() - start_time
+        success = 0.45 <= duration < 2
+        print(mark(success), "mock daemon: stream bandwidth")
+        assert success
+    finally:
+        daemon.api_latency_sec = 0
+        daemon.stream_latency_sec = 0
+        daemon.stream_bandwidth = None
+        ipfs_datatransmission.close_transmission_streams()
+        listener.terminate()
+
+
+def test_daemon_info_cache():
+    prepare()
+    received = []
+    listener = ipfs_datatransmission.listen_for_transmissions(
+        "test-daemon-info", lambda data, peer_id: received.append(data))
+    wait_for(lambda: listener.port)
+    try:
+        ipfs_api.my_id()
+        id_requests = daemon.http_request_count("/id")
+        for i in range(5):
+            ipfs_datatransmission.transmit_data(
+                b"Hello there!", REMOTE_PEER_ID, "test-daemon-info")
+        success = wait_for(lambda: len(received) == 5)
+        success &= daemon.http_request_count("/id") == id_requests
+        print(mark(success), "daemon info cache: no /id requests")
+        assert success
+
+        ipfs_api.invalidate_daemon_info()
+        success = ipfs_api.my_id() == ipfs_api.my_id()
+        success &= daemon.http_request_count("/id") == id_requests + 1
+        # a new HTTP client may be connected to a different daemon
+        daemon.connect(ipfs_api)
+        ipfs_api.my_id()
+        success &= daemon.http_request_count("/id") == id_requests + 2
+        ipfs_api.DAEMON_INFO_TTL_SEC = 0
+        ipfs_api.my_id()
+        success &= daemon.http_request_count("/id") == id_requests + 3
+        print(mark(success), "daemon info cache: invalidation")
+        assert success
+    finally:
+        ipfs_api.DAEMON_INFO_TTL_SEC = 300
+        listener.terminate()
+
+
+def test_stream_checksums():
+    prepare()
+    received = []
+    listener = ipfs_datatransmission.listen_for_transmissions(
+        "test-checksums", lambda data, peer_id: received.append(data))
+    wait_for(lambda: listener.port)
+    for checksums in (["crc32"], ["adler32"], ["sum"], []):
+        ipfs_datatransmission.STREAM_CHECKSUMS = checksums
+        received.clear()
+        ipfs_datatransmission.transmit_data(
+            b"checked", REMOTE_PEER_ID, "test-checksums", persistent=True)
+        stream = ipfs_datatransmission._transmission_streams[
+            (REMOTE_PEER_ID, "test-checksums")]
+        success = (wait_for(lambda: received == [b"checked"])
+                   and stream.checksum == (checksums[0] if checksums else None))
+        ipfs_datatransmission.close_transmission_streams()
+        print(mark(success), f"persistent stream checksum: {checksums}")
+        assert success
+    ipfs_datatransmission.STREAM_CHECKSUMS = ["crc32", "adler32"]
+    listener.terminate()
+
+    message = ipfs_datatransmission._pack_stream_message_header(
+        7, b"data", "crc32") + b"data"
+    corrupted = bytearray(message)
+    corrupted[-1] ^= 1
+    success = (
+        ipfs_datatransmission._unpack_stream_message(
+            bytearray(message), "crc32") == (7, b"data", True)
+        and not ipfs_datatransmission._unpack_stream_message(
+            corrupted, "crc32")[2]
+    )
+    print(mark(success), "persistent stream checksum: detects corruption")
+    assert success
+
+
+def test_frame_codec():
+    metadata = bytearray(b"\xff\x00 metadata")
+    success = True
+    for filesize in (0, 254, 255**2 + 254, 2**40):
+        for binary, features in ((True, 3), (True, 0), (False, 0)):
+            header = ipfs_datatransmission._encode_file_header(
+                filesize, "file.txt", metadata, binary=binary,
+                features=features)
+            # the legacy encoding can't represent filesizes with a 255 digit
+            if not binary and 255 in ipfs_datatransmission._to_b255_no_0s(
+                    filesize):
+                continue
+            success &= ipfs_datatransmission._decode_file_header(header) == (
+                filesize, "file.txt", metadata, features)
+    print(mark(success), "frame codec: file header")
+    assert success
+
+    blocks = [(262144, bytes(range(32))), (12345, bytes(32))]
+    success = ipfs_datatransmission._decode_file_ready(
+        ipfs_datatransmission._encode_file_ready(3, blocks)) == (3, blocks)
+    success &= ipfs_datatransmission._decode_file_resume(
+        ipfs_datatransmission._encode_file_resume(12345, True)) == (12345, True)
+    print(mark(success), "frame codec: file resumption")
+    assert success
+
+    frame = ipfs_datatransmission._encode_frame(7, 300, b"abc", b"")
+    frame_type, fields = ipfs_datatransmission._decode_frame(frame)
+    success = frame_type == 7 and fields == [300, b"abc", b""]
+    try:
+        ipfs_datatransmission._decode_frame(frame[:-3])
+        success = False
+    except ipfs_datatransmission.UnreadableReply:
+        pass
+    print(mark(success), "frame codec: typed fields")
+    assert success
+
+
+def test_transmit_file():
+    prepare()
+    with tempfile.TemporaryDirectory() as tempdir:
+        filepath = os.path.join(tempdir, "file.bin")
+        file_data = os.urandom(3 * 1024 * 1024 + 12345)
+        with open(filepath, "wb") as file:
+            file.write(file_data)
+        receive_dir = os.path.join(tempdir, "received")
+        os.mkdir(receive_dir)
+        received = []
+        listener = listen_for_file_transmissions_locally(
+            "test-files",
+            lambda peer_id, path, metadata: received.append((path, metadata)),
+            receive_dir)
+        try:
+            for pipelined, block_size, zero_copy in ((False, 262144, True),
+                                                     (True, None, True),
+                                                     (True, None, False)):
+                ipfs_datatransmission.FILE_ZERO_COPY = zero_copy
+                received.clear()
+                transmitter = ipfs_datatransmission.transmit_file(
+                    filepath, REMOTE_PEER_ID, "test-files", metadata=b"\xffmeta",
+                    block_size=block_size, pipelined=pipelined)
+                success = wait_for(lambda: received, 20)
+                if success:
+                    path, metadata = received[0]
+                    with open(path, "rb") as file:
+                        success = file.read() == file_data and metadata == b"\xffmeta"
+                    os.remove(path)
+                success &= wait_for(lambda: transmitter.status == "finished")
+                if pipelined:
+                    success &= transmitter.window_size > 1
+                mode = "pipelined" if pipelined else "sequential"
+                copying = "zero-copy" if zero_copy else "copying"
+                print(mark(success), f"transmit_file: {mode}, {copying}")
+                assert success
+        finally:
+            ipfs_datatransmission.FILE_ZERO_COPY = True
+            listener.terminate()
+
+
+def test_transmit_file_striped():
+    prepare()
+    with tempfile.TemporaryDirectory() as tempdir:
+        filepath = os.path.join(tempdir, "file.bin")
+        file_data = os.urandom(4 * 1024 * 1024 + 12345)
+        with open(filepath, "wb") as file:
+            file.write(file_data)
+        receive_dir = os.path.join(tempdir, "received")
+        os.mkdir(receive_dir)
+        received = []
+        listener = listen_for_file_transmissions_locally(
+            "test-files-striped",
+            lambda peer_id, path, metadata: received.append(path),
+            receive_dir)
+        try:
+            for zero_copy in (True, False):
+                ipfs_datatransmission.FILE_ZERO_COPY = zero_copy
+                received.clear()
+                transmitter = ipfs_datatransmission.transmit_file(
+                    filepath, REMOTE_PEER_ID, "test-files-striped",
+                    block_size=131072, stripes=4)
+                success = wait_for(lambda: received, 20)
+                if success:
+                    with open(received[0], "rb") as file:
+                        success = file.read() == file_data
+                    os.remove(received[0])
+                success &= wait_for(lambda: transmitter.status == "finished")
+                copying = "zero-copy" if zero_copy else "copying"
+                print(mark(success), f"transmit_file: 4 stripes, {copying}")
+                assert success
+        finally:
+            ipfs_datatransmission.FILE_ZERO_COPY = True
+            listener.terminate()
+
+
+def test_resume_file_transmission():
+    prepare()
+    block_size = 262144
+    with tempfile.TemporaryDirectory() as tempdir:
+        filepath = os.path.join(tempdir, "file.bin")
+        file_data = os.urandom(2 * 1024 * 1024 + 12345)
+        with open(filepath, "wb") as file:
+            file.write(file_data)
+        receive_dir = os.path.join(tempdir, "received")
+        os.mkdir(receive_dir)
+        received = []
+        listener = listen_for_file_transmissions_locally(
+            "test-files-resume",
+            lambda peer_id, path, metadata: received.append(path),
+            receive_dir)
+        try:
+            for pipelined in (False, True):
+                # simulate an interrupted transmission: the receiver has four
+                # blocks, of which the third differs from the sender's file
+                # and the fourth got corrupted after being received
+                blocks = [file_data[i * block_size:(i + 1) * block_size]
+                          for i in range(4)]
+                blocks[2] = os.urandom(block_size)
+                part_path = os.path.join(receive_dir, "file.bin.PART")
+                with open(part_path, "wb") as file:
+                    file.write(b"".join(blocks[:3]) + os.urandom(block_size))
+                with open(part_path + ".checkpoint", "w") as file:
+                    file.write(f"{len(file_data)}\n")
+                    for i, block in enumerate(blocks):
+                        file.write(f"{i * block_size} {len(block)} "
+                                   f"{hashlib.sha256(block).hexdigest()}\n")
+
+                received.clear()
+                transmitter = ipfs_datatransmission.transmit_file(
+                    filepath, REMOTE_PEER_ID, "test-files-resume",
+                    block_size=block_size, pipelined=pipelined)
+                success = wait_for(lambda: received, 20)
+                if success:
+                    with open(received[0], "rb") as file:
+                        success = file.read() == file_data
+                    os.remove(received[0])
+                success &= transmitter.resumed_at == 2 * block_size
+                success &= not os.path.exists(part_path + ".checkpoint")
+                success &= wait_for(lambda: transmitter.status == "finished")
+                mode = "pipelined" if pipelined else "sequential"
+                print(mark(success), f"resume file transmission: {mode}")
+                assert success
+        finally:
+            listener.terminate()
+
+
+class _RecordingConversation:
+    """Stands in for the Conversation of a FileTransmissionReceiver,
+    recording what the receiver says."""
+    peer_id = REMOTE_PEER_ID
+
+    def __init__(self):
+        self.said = []
+
+    def say(self, data):
+        self.said.append(data)
+
+    def close(self):
+        pass
+
+
+def test_receive_blocks_out_of_order():
+    dt = ipfs_datatransmission
+    block_size = 65536
+    with tempfile.TemporaryDirectory() as tempdir:
+        file_data = os.urandom(5 * block_size + 123)
+        received = []
+        receiver = dt.FileTransmissionReceiver()
+        conv = _RecordingConversation()
+        receiver.setup(conv, lambda peer_id, path: received.append(path),
+                       dir=tempdir)
+        receiver.on_data_received(conv, dt._encode_file_header(
+            len(file_data), "file.bin", b"", binary=True,
+            features=dt._FILE_FEATURES))
+        features, offered_blocks = dt._decode_file_ready(conv.said[0])
+        success = features & dt._FILE_POSITIONED_BLOCKS and not offered_blocks
+        # the whole file has been allocated before any block is received
+        receiver.on_data_received(conv, dt._encode_file_resume(0, True))
+        success &= os.path.getsize(
+            os.path.join(tempdir, "file.bin.PART")) == len(file_data)
+        for position in reversed(range(0, len(file_data), block_size)):
+            receiver.on_data_received(conv, bytearray(
+                dt._FILE_BLOCK_HEADER.pack(position)
+                + file_data[position:position + block_size]))
+        if success and received:
+            with open(received[0], "rb") as file:
+                success = file.read() == file_data
+        else:
+            success = False
+    print(mark(success), "file reception: blocks out of order")
+    assert success
+
+
+def test_stream_ciphers():
+    if ipfs_datatransmission.Cipher is None:
+        print("skipping StreamCipher tests: cryptography isn't installed")
+        return
+    from cryptography.hazmat.primitives.ciphers.aead import (
+        AESGCM, ChaCha20Poly1305)
+    for cipher_type, reference in (
+            (ipfs_datatransmission.ChaCha20Poly1305Cipher, ChaCha20Poly1305),
+            (ipfs_datatransmission.AESGCMCipher, AESGCM)):
+        key = cipher_type.generate_key()
+        sender = cipher_type(key)
+        receiver = cipher_type(key)
+        success = True
+        buffer = bytearray()
+        for size in (0, 1, 16, 1000, 1024**2 + 1):
+            data = os.urandom(size)
+            message = sender.encrypt(data)
+            # compatible with the whole-message implementation
+            success &= reference(key).decrypt(
+                bytes(message[:12]), bytes(message[12:]), None) == data
+            success &= receiver.decrypt(message) == data
+            encrypted = sender.encrypt_into(buffer, data[:7], data[7:])
+            success &= receiver.decrypt(encrypted) == data
+            encrypted.release()
+        nonces = {bytes(sender.encrypt(b"")[:12]) for i in range(100)}
+        success &= len(nonces) == 100
+        message[-1] ^= 1
+        try:
+            receiver.decrypt(message)
+            success = False
+        except ipfs_datatransmission.DecryptionError:
+            pass
+        print(mark(success), f"stream cipher: {cipher_type.__name__}")
+        assert success
+
+
+def test_transmit_file_encrypted():
+    if ipfs_datatransmission.Cipher is None:
+        print("skipping encrypted file transmission test: "
+              "cryptography isn't installed")
+        return
+    prepare()
+    key = ipfs_datatransmission.ChaCha20Poly1305Cipher.generate_key()
+    with tempfile.TemporaryDirectory() as tempdir:
+        filepath = os.path.join(tempdir, "file.bin")
+        file_data = os.urandom(3 * 1024 * 1024 + 12345)
+        with open(filepath, "wb") as file:
+            file.write(file_data)
+        receive_dir = os.path.join(tempdir, "received")
+        os.mkdir(receive_dir)
+        received = []
+        listener = listen_for_file_transmissions_locally(
+            "test-files-encrypted",
+            lambda peer_id, path, metadata: received.append(path),
+            receive_dir,
+            ipfs_datatransmission.ChaCha20Poly1305Cipher(key))
+        try:
+            for pipelined, stripes in ((False, 1), (True, 1), (True, 3)):
+                received.clear()
+                transmitter = ipfs_datatransmission.transmit_file(
+                    filepath, REMOTE_PEER_ID, "test-files-encrypted",
+                    encryption_callbacks=(
+                        ipfs_datatransmission.ChaCha20Poly1305Cipher(key)),
+                    block_size=262144, pipelined=pipelined, stripes=stripes)
+                success = wait_for(lambda: received, 20)
+                if success:
+                    with open(received[0], "rb") as file:
+                        success = file.read() == file_data
+                    os.remove(received[0])
+                success &= wait_for(lambda: transmitter.status == "finished")
+                mode = "pipelined" if pipelined else "sequential"
+                print(mark(success),
+                      f"transmit_file: encrypted, {mode}, {stripes} stripes")
+                assert success
+        finally:
+            listener.terminate()
+
+
+def test_eventhandler_dispatch():
+    prepare()
+    for mode in ("pool", "inline"):
+        ipfs_datatransmission.EVENTHANDLER_DISPATCH = mode
+        received = []
+        listener = ipfs_datatransmission.listen_for_transmissions(
+            "test-dispatch", lambda data, peer_id: received.append(data))
+        wait_for(lambda: listener.port)
+        messages = [f"message {i}".encode() for i in range(50)]
+        for message in messages:
+            ipfs_datatransmission.transmit_data(
+                message, REMOTE_PEER_ID, "test-dispatch", persistent=True)
+        success = wait_for(lambda: received == messages)
+        ipfs_datatransmission.close_transmission_streams()
+        listener.terminate()
+        print(mark(success), f"eventhandler dispatch: {mode}, in order")
+        assert success
+    ipfs_datatransmission.EVENTHANDLER_DISPATCH = "pool"
+
+    # slow eventhandlers of several listeners receiving from concurrent
+    # senders: each listener's calls are made one at a time and in order,
+    # on the pool's threads only
+    lock = threading.Lock()
+    received = {}
+    running = {}
+    overlapped = []
+    thread_names = set()
+
+    def slow_eventhandler(name):
+        def eventhandler(data, peer_id):
+            with lock:
+                running[name] = running.get(name, 0) + 1
+                overlapped.append(running[name] > 1)
+                thread_names.add(threading.current_thread().name)
+            time.sleep(0.005)
+            with lock:
+                running[name] -= 1
+                received[name].append(data)
+        return eventhandler
+
+    names = [f"test-dispatch-{i}" for i in range(3)]
+    listeners = []
+    for name in names:
+        received[name] = []
+        listeners.append(ipfs_datatransmission.listen_for_transmissions(
+            name, slow_eventhandler(name)))
+    wait_for(lambda: all(listener.port for listener in listeners))
+    messages = [f"message {i}".encode() for i in range(30)]
+
+    def send(name):
+        for message in messages:
+            ipfs_datatransmission.transmit_data(
+                message, REMOTE_PEER_ID, name, persistent=True)
+    senders = [threading.Thread(target=send, args=(name,)) for name in names]
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join()
+    success = wait_for(lambda: all(
+        received[name] == messages for name in names), 10)
+    ipfs_datatransmission.close_transmission_streams()
+    for listener in listeners:
+        listener.terminate()
+    success &= not any(overlapped)
+    success &= all(name.startswith("DataTransmission-eventhandler_")
+                   for name in thread_names)
+    success &= len(thread_names) <= ipfs_datatransmission.EVENTHANDLER_POOL_SIZE
+    print(mark(success), "eventhandler dispatch: pool, concurrent senders")
+    assert success
+
+    # counting an eventhandler's parameters doesn't keep its object alive
+    conversation = ipfs_datatransmission.Conversation()
+    reference = weakref.ref(conversation)
+    success = ipfs_datatransmission._count_parameters(
+        conversation._file_received) == len(
+            inspect.signature(conversation._file_received).parameters)
+    del conversation
+    gc.collect()
+    success &= reference() is None
+    print(mark(success), "eventhandler dispatch: parameter counting")
+    assert success
+
+
+def test_async_transmit_data():
+    prepare()
+
+    async def run():
+        received = []
+        listener = await ipfs_datatransmission_async.listen_for_transmissions(
+            "test-async-transmission",
+            lambda data, peer_id: received.append(data))
+        messages = [f"message {i}".encode() for i in range(10)]
+        for persistent in (False, True):
+            await asyncio.gather(*[
+                ipfs_datatransmission_async.transmit_data(
+                    message, REMOTE_PEER_ID, "test-async-transmission",
+                    persistent=persistent)
+                for message in messages
+            ])
+        await ipfs_datatransmission_async.close_transmission_streams()
+        await listener.terminate()
+        return sorted(received) == sorted(messages + messages)
+    success = asyncio.run(run())
+    print(mark(success), "async transmit_data")
+    assert success
+
+
+def test_async_interoperability():
+    """Checks that the asyncio and threaded implementations understand each
+    other."""
+    prepare()
+    received = []
+    listener = ipfs_datatransmission.listen_for_transmissions(
+        "test-threaded-listener", lambda data, peer_id: received.append(data))
+    wait_for(lambda: listener.port)
+
+    async def send_to_threaded():
+        for persistent in (False, True):
+            await ipfs_datatransmission_async.transmit_data(
+                b"from async", REMOTE_PEER_ID, "test-threaded-listener",
+                persistent=persistent)
+        await ipfs_datatransmission_async.close_transmission_streams()
+    asyncio.run(send_to_threaded())
+    success = wait_for(lambda: received == [b"from async", b"from async"])
+    listener.terminate()
+    print(mark(success), "async transmit_data to threaded listener")
+    assert success
+
+    async def receive_from_threaded():
+        async with await ipfs_datatransmission_async.listen_for_transmissions(
+                "test-async-listener") as listener:
+            loop = asyncio.get_running_loop()
+            for persistent in (False, True):
+                await loop.run_in_executor(
+                    None, lambda: ipfs_datatransmission.transmit_data(
+                        b"from threads", REMOTE_PEER_ID, "test-async-listener",
+                        persistent=persistent))
+            received = [await anext(listener), await anext(listener)]
+        ipfs_datatransmission.close_transmission_streams()
+        return [data for data, peer_id in received]
+    success = asyncio.run(receive_from_threaded()) == [b"from threads"] * 2
+    print(mark(success), "threaded transmit_data to async listener")
+    assert success
+
+
+def test_async_conversation():
+    prepare()
+
+    async def run():
+        joined = asyncio.Queue()
+
+        async def on_request(conv_name, peer_id):
+            # all peers are this node, so reply to the requester via
+            # REMOTE_PEER_ID and listen under a different name
+            joined.put_nowait(
+                await ipfs_datatransmission_async.join_conversation(
+                    conv_name + "-joiner", REMOTE_PEER_ID, conv_name))
+        conv_listener = await ipfs_datatransmission_async.listen_for_conversations(
+            "test-async-conv-listener", on_request)
+        async with await ipfs_datatransmission_async.start_conversation(
+                "test-async-conv", REMOTE_PEER_ID, "test-async-conv-listener"
+        ) as conv:
+            async with await joined.get() as other_conv:
+                await conv.say(b"Hello there!")
+                message = await other_conv.listen(timeout=5)
+                await other_conv.say(b"Hi!")
+                async for reply in conv:
+                    break
+        await conv_listener.terminate()
+        return (message == b"Hello there!" and reply == b"Hi!"
+                and conv._peer_binary_frames)
+    success = asyncio.run(run())
+    print(mark(success), "async conversation")
+    assert success
+
+
+def run_tests():
+    print("\nStarting tests for IPFS-DataTransmission with mock daemon...")
+    prepare()
+    test_transmit_data()
+    test_transmit_large_data()
+    test_malformed_frames()
+    test_transmit_data_persistent()
+    test_port_forward_reuse()
+    test_receiver_pool()
+    test_listener_demux()
+    test_conversation_coalescing()
+    test_conversation_flow_control()
+    test_metrics()
+    test_mock_daemon_api()
+    test_mock_daemon_shaping()
+    test_daemon_info_cache()
+    test_stream_checksums()
+    test_frame_codec()
+    test_transmit_file()
+    test_transmit_file_striped()
+    test_resume_file_transmission()
+    test_receive_blocks_out_of_order()
+    test_stream_ciphers()
+    test_transmit_file_encrypted()
+    test_eventhandler_dispatch()
+    test_async_transmit_data()
+    test_async_interoperability()
+    test_async_conversation()
+    daemon.stop()
+
+
+if __name__ == "__main__":
+    run_tests()